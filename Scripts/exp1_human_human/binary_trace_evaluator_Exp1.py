@@ -3,7 +3,6 @@ import getopt # for command line arguments
 import os # for directory handling
 from pathlib import Path # for file handling
 import numpy as np # for numerical operations
-import pandas as pd
 import pingouin as pg # for t-test and BF10
 import matplotlib.pyplot as plt # for plotting
 from tqdm import trange
@@ -16,7 +15,11 @@ scripts_dir = os.path.dirname(script_dir)
 sys.path.insert(0, scripts_dir)
 
 #custom package
-from tools.traj_utils import get_binary_trace
+from tools.traj_utils import get_leave_one_out_heatmaps, get_streamed_trajectory, get_visited_trace, bin_size
+from tools.file_index import find_trial_files
+from tools.parallel import get_workers, run_parallel, iter_parallel
+from tools.results import make_results, set_result, write_results
+from tools.shared_trials import share_trials, find_dataset_files
 
 ############################### USER SETTINGS ##################################
 first_trial = 7
@@ -24,9 +27,75 @@ last_trial = 24 + 1
 
 ################################################################################
 
-def main():
+def get_trial_backgrounds(player, trial, all_sessions):
+    """
+    Work unit: the leave-one-out human heatmaps of one trial and player, shared by every AA type.
+
+    Returns:
+    background_heatmaps: np.array of shape (numSessions, ny, nx), the binary heatmap of all sessions but each
+    non-hidden session of all_sessions
+    has_background: np.array of bools, False for an evaluee without background data (no other session has the trial)
+    """
+    # Skip hidden files and directories (like .DS_Store)
+    sessions = [session for session in all_sessions if not session.startswith('.')]
+
+    # count the human data of every session once for the given trial and given player,
+    # each evaluee's background heatmap is then the total minus its own counts
+    session_histograms = np.zeros((len(sessions), int(90/bin_size), int(120/bin_size)))
+    has_data = np.zeros(len(sessions), dtype=bool)
+    for i, session in enumerate(sessions):
+        filePaths = find_trial_files('human', trial, session=session)
+        if len(filePaths) == 0:
+            continue
+        session_histograms[i] = get_streamed_trajectory(filePaths[0], 'p%d' % (player))[0] # read chunk by chunk
+        has_data[i] = True
+    has_background = np.array([np.any(np.delete(has_data, i)) for i in range(len(sessions))], dtype=bool)
+    return get_leave_one_out_heatmaps(session_histograms), has_background
+
+
+def score_AA_type(AA_type, player, trial, all_sessions, background_heatmaps, has_background):
+    """
+    Work unit: binary traces of the simulated HA of one AA type against the leave-one-out human heatmaps
+    of one trial and player (as returned by get_trial_backgrounds).
+
+    Returns:
+    list of (evaluee session, score) with score NaN if the simulation file is missing
+    """
+    sessions = [session for session in all_sessions if not session.startswith('.')]
+
+    #we can now compare this to the AA data
+    #get all simulation files of the given AA type that match the trial
+    simFiles = find_trial_files('simulation', trial, agent_type=AA_type)
+    if len(simFiles) == 0:
+        print(f"\n  Warning: No simulation file found for trial {trial} in {AA_type}. Skipping this trial.")
+        simData = None
+    else:
+        if len(simFiles) > 1:
+            print(f"\n  Warning: Multiple simulation files found for trial {trial} in {AA_type}. Using first match.")
+        # read the simulated trajectory once, chunk by chunk; its visited cells are scored against every background
+        simData = get_streamed_trajectory(simFiles[0], "hA%d" % player)
+        if simData is None:
+            print(f"Warning: Agent columns hA{player}x/hA{player}z not found in data. Returning 0.")
+
+    scores = []
+    for evaluee_session in all_sessions:
+        if evaluee_session.startswith('.'):
+            continue
+        i = sessions.index(evaluee_session)
+        if not has_background[i]:
+            continue # no background data for this evaluee
+
+        if len(simFiles) == 0:
+            scores.append((evaluee_session, np.nan))  # Mark as missing data
+        elif simData is None:
+            scores.append((evaluee_session, 0.0))
+        else:
+            scores.append((evaluee_session, get_visited_trace(background_heatmaps[i], simData[1])))
+    return scores
 
-    intermediary_columns = ["Session", "Player", "7", "8", "9", "10", "11", "12", "13", "14", "15", "16", "17", "18", "19", "20", "21", "22", "23", "24"]
+
+def main():
+    workers = get_workers()
 
     cwd = os.path.dirname(os.path.abspath(__file__))
     wd = Path(cwd).parents[1] # project working directory
@@ -39,66 +108,43 @@ def main():
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    AA_types = []
     for AA_type in (AA_SIM_types):
-        print("Processing AA type: ", AA_type)
-
         # Check if output file already exists
         output_file = os.path.join(output_dir, f"AA_scores_traces_Successive{AA_type}.csv")
         if os.path.exists(output_file):
             print(f"  Output file already exists: {output_file}")
             print(f"  Skipping {AA_type}...")
             continue
-
-        df = pd.DataFrame(index=range(len(all_sessions)*2), columns=intermediary_columns) # 2 for the two players
-        for count, evaluee_session in enumerate(all_sessions):
-            # Skip hidden files and directories (like .DS_Store)
-            if evaluee_session.startswith('.'):
-                continue
-            print("\n Evaluee session: ", count+1, " of ", len(all_sessions))
-            background_sessions = [session for session in all_sessions if session != evaluee_session and not session.startswith('.')]
-
-            for player in (0,1):
-
-                for trial in range(first_trial,last_trial):
-                    sys.stdout.write('\r'+"Processing trial "+ str(trial)+ " for player "+ str(player))
-                    X = np.array([])
-                    Z = np.array([])
-                    trial_ID = "{:02}".format(trial)
-                    filePaths = [[path for path in Path(os.path.join(humanDataDir, background_session)).rglob('*trialIdentifier'+trial_ID+'*')] for background_session in background_sessions]
-
-                    for filePath in filePaths:
-                        trialData = pd.read_csv(filePath[0])
-                        X = np.append(X, trialData['p%dx' % (player)].to_numpy())
-                        Z = np.append(Z, trialData['p%dz' % (player)].to_numpy())
-                        #now we have all the human data for the given trial and given player
-                        #we can now compare this to the AA data
-                        simDir = os.path.join(wd,'OtherResults', 'AA-AA_SimulationData', AA_type) #Directory of all simualtion data files
-
-                        #get all lowest level files in the directory simDir and get the one that matches the trial_ID
-                        simFiles = [path for path in Path(simDir).rglob('*trialIdentifier'+trial_ID+'*')]
-
-                        # Handle missing simulation files gracefully
-                        if len(simFiles) == 0:
-                            print(f"\n  Warning: No simulation file found for trial {trial} in {AA_type}. Skipping this trial.")
-                            df.loc[count*2 + player, "Session"] = evaluee_session
-                            df.loc[count*2 + player, "Player"] = player + 1
-                            df.loc[count*2 + player, str(trial)] = np.nan  # Mark as missing data
-                            continue
-                        elif len(simFiles) > 1:
-                            print(f"\n  Warning: Multiple simulation files found for trial {trial} in {AA_type}. Using first match.")
-
-                        simFile = simFiles[0]
-                        individual_trial_AA_score = get_binary_trace(X, Z, pd.read_csv(simFile), "hA%d" % player)
-                        df.loc[count*2 + player, "Session"] = evaluee_session
-                        df.loc[count*2 + player, "Player"] = player + 1 #player 0 is player 1, player 1 is player 2
-                        df.loc[count*2 + player, str(trial)] = individual_trial_AA_score
-
-        df.to_csv(output_file, index=False)
-        print(f"\n  Saved: {output_file}")
+        AA_types.append(AA_type)
+    if len(AA_types) == 0:
+        return
+
+    if workers > 1: # the trajectories are read once into shared memory, instead of by every worker
+        share_trials(find_dataset_files(['human', 'simulation'], range(first_trial,last_trial), AA_types))
+
+    # the human backgrounds do not depend on the AA type: they are built once per player and trial
+    trial_units = [(player, trial, all_sessions) for player in (0,1) for trial in range(first_trial,last_trial)]
+    backgrounds = run_parallel(get_trial_backgrounds, trial_units, workers=workers, desc="Backgrounds")
+
+    # then every AA type is scored against them, and its CSV is written as soon as its last unit is done
+    work_units = [(AA_type, player, trial, all_sessions) + background for AA_type in AA_types
+                  for (player, trial, _), background in zip(trial_units, backgrounds)]
+    # one row per entry of the data folder and player (hidden entries stay empty rows), one column per trial
+    scores_tables = {AA_type: make_results(all_sessions, (1, 2), range(first_trial, last_trial)) for AA_type in AA_types}
+    remaining_units = {AA_type: len(trial_units) for AA_type in AA_types}
+    for i, scores in iter_parallel(score_AA_type, work_units, workers=workers, desc="AA types"):
+        AA_type, player, trial = work_units[i][:3]
+        for evaluee_session, score in scores:
+            set_result(scores_tables[AA_type], evaluee_session, player + 1, trial, score) #player 0 is player 1, player 1 is player 2
+        remaining_units[AA_type] -= 1
+        if remaining_units[AA_type] == 0:
+            output_file = os.path.join(output_dir, f"AA_scores_traces_Successive{AA_type}.csv")
+            write_results(scores_tables[AA_type], output_file)
+            print(f"\n  Saved: {output_file}")
 
                 
 if __name__ == "__main__":
 
 
     main()
-    
\ No newline at end of file
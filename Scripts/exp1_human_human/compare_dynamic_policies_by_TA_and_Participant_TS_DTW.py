@@ -2,14 +2,16 @@
 """Given the dynamic policies for the human and the simulation, this script calculates the normalised DTW error between the human and the simulation for each trial and each participant."""
 
 import os
-import pandas as pd
 #import similaritymeasures
-from fastdtw import fastdtw
-from scipy.spatial.distance import euclidean
-import numpy as np
 #from utils import *
 from pathlib import Path # path functions
-from tqdm import trange # progress bar
+import sys # for path manipulation
+# Add parent directory to path to import tools
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from tools.parallel import get_workers, run_parallel # process pool for the per-trial work units
+from tools.policy_store import load_policies, get_policy # memory-mapped policy series
+from tools.dtw_utils import get_dtw_distances, get_dtw_mode, get_new_dtw_distances, add_dtw_distances, save_dtw_cache
+from tools.results import make_results, set_result, write_results # typed (session, player, trial) errors
 
 
 
@@ -28,83 +30,100 @@ lastTrial = 24 + 1 # +1 for python indexing
 policy_folder = os.path.join(wd, "OtherResults", "TS_Dynamic_Policy")
 
 
-human_sessions_directories = os.listdir(os.path.join(policy_folder, "Human")) # list of all sessions (ie, participants)
 columns=["Session", "Player", "3TAs", "4TAs", "5TAs"]
 intermediary_columns = ["Session", "Player", "7", "8", "9", "10", "11", "12", "13", "14", "15", "16", "17", "18", "19", "20", "21", "22", "23", "24"]
 
 output_dir = os.path.join(wd, "OtherResults", "DTW_TS_Errors")
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
 
-for simulation_key in trange(len(simulations)): # for each simulation type
 
-    #make a pd dataframe of length of human_sessions_directories, columns = columns
-    df = pd.DataFrame(index=range(len(human_sessions_directories)*2), columns=intermediary_columns) # 2 for the two players
+def get_DTW_errors(simulation, trial, human_session, dtw_mode='approximate'):
+    """
+    Work unit: normalised DTW errors between the human and the simulated dynamic policy of one trial.
 
-    print("Processing Simulation: ", simulations[simulation_key])
+    Returns:
+    (final_err_player_1, final_err_player_2), or None if either file is missing
+    dict of the DTW distances computed by this unit (see get_new_dtw_distances)
+    """
+    trial_ID = str(trial)
+    part_dir = Path(os.path.join(policy_folder, "Human", human_session))
 
-    simulation_sessions_directory = os.path.join(policy_folder, "Simulation", simulations[simulation_key])
+    #get the file path for the human file that has the trial data, matched with the trailIdentifier, using rglob
+    human_filePath = part_dir / ("trialIdentifier_"+trial_ID+".csv")
 
-    for trial in range(firstTrial, lastTrial):
-        print("Processing Trial: ", trial)
 
-        df_row = 0  # Track actual row position in dataframe
-        for hcount, human_session in enumerate(human_sessions_directories):
-            # Skip hidden files and directories (like .DS_Store)
-            if human_session.startswith('.'):
-                continue
-            print("Processing Session: ", human_session)
-            trial_ID = str(trial)
-            part_dir = Path(os.path.join(policy_folder, "Human", human_session))
+    simulation_filePath = os.path.join(policy_folder, "Simulation", simulation, "SessionSIM", "trialIdentifier_"+trial_ID+".csv")
 
-            #get the file path for the human file that has the trial data, matched with the trailIdentifier, using rglob
-            human_filePath = part_dir / ("trialIdentifier_"+trial_ID+".csv")
+    # read both policies from the packed policy store, without opening their CSVs
+    human_data = get_policy('human_policy', trial, human_session)
+    sim_data = get_policy('simulation_policy', trial, "SessionSIM", agent_type=simulation)
 
+    # Check if files exist before reading
+    if human_data is None:
+        print(f"\nWarning: Human file not found: {human_filePath}. Skipping...")
+        return None, {}
+    if sim_data is None:
+        print(f"\nWarning: Simulation file not found: {simulation_filePath}. Skipping...")
+        return None, {}
 
-            simulation_filePath = os.path.join(simulation_sessions_directory, "SessionSIM", "trialIdentifier_"+trial_ID+".csv")
+    # Validate data consistency
+    if human_data['TrialID'] != sim_data['TrialID']:
+        raise ValueError(f"Trial ID mismatch: {human_data['TrialID']} != {sim_data['TrialID']}")
+    if human_data['numTargs'] != sim_data['numTargs']:
+        raise ValueError(f"Number of targets mismatch: {human_data['numTargs']} != {sim_data['numTargs']}")
 
-            # Check if files exist before reading
-            if not os.path.exists(human_filePath):
-                print(f"\nWarning: Human file not found: {human_filePath}. Skipping...")
-                continue
+    numTargets = int(human_data['numTargs'])
 
-            if not os.path.exists(simulation_filePath):
-                print(f"\nWarning: Simulation file not found: {simulation_filePath}. Skipping...")
-                continue
 
-            human_data = pd.read_csv(human_filePath)
-            sim_data = pd.read_csv(simulation_filePath)
 
-            # Validate data consistency
-            if human_data['TrialID'][0] != sim_data['TrialID'][0]:
-                raise ValueError(f"Trial ID mismatch: {human_data['TrialID'][0]} != {sim_data['TrialID'][0]}")
-            if human_data['numTargs'][0] != sim_data['numTargs'][0]:
-                raise ValueError(f"Number of targets mismatch: {human_data['numTargs'][0]} != {sim_data['numTargs'][0]}")
+    # DTW distance of each player's engagement, both pairs in one batch
+    err_player_1, err_player_2 = get_dtw_distances([(human_data['HA0_engagement'], sim_data["HA0_engagement"]),
+                                                    (human_data["HA1_engagement"], sim_data["HA1_engagement"])], save=False, mode=dtw_mode)
+    final_err_player_1 = err_player_1/(human_data['length'] + sim_data['length'])
+    final_err_player_2 = err_player_2/(human_data['length'] + sim_data['length'])
 
-            numTargets = int(human_data['numTargs'][0])
+    return (final_err_player_1, final_err_player_2), get_new_dtw_distances()
 
 
+def main():
+    workers = get_workers()
+    dtw_mode = get_dtw_mode(default='approximate') # fastdtw, as the published errors
 
-            err_player_1, _ = fastdtw(np.column_stack([human_data['HA0_engagement'].to_numpy()]), np.column_stack([sim_data["HA0_engagement"].to_numpy()]), dist=euclidean)
-            final_err_player_1 = err_player_1/(len(human_data) + len(sim_data))
+    # pack the policy CSVs once here, so the worker processes only map the store
+    load_policies('human_policy')
+    load_policies('simulation_policy')
 
-            err_player_2, _ = fastdtw(np.column_stack([human_data["HA1_engagement"].to_numpy()]), np.column_stack([sim_data["HA1_engagement"].to_numpy()]), dist=euclidean)
-            final_err_player_2 = err_player_2/(len(human_data) + len(sim_data))
+    human_sessions_directories = os.listdir(os.path.join(policy_folder, "Human")) # list of all sessions (ie, participants)
+    # Skip hidden files and directories (like .DS_Store)
+    human_sessions = [human_session for human_session in human_sessions_directories if not human_session.startswith('.')]
 
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
-            print(len(human_data), len(sim_data))
+    # one work unit per simulation type, trial and session
+    work_units = [(simulation, trial, human_session, dtw_mode) for simulation in simulations for trial in range(firstTrial, lastTrial) for human_session in human_sessions]
+    results = run_parallel(get_DTW_errors, work_units, workers=workers, desc="Trials")
+    for _, new_distances in results:
+        add_dtw_distances(new_distances)
+    save_dtw_cache() # keep the DTW distances for the next run
+    errors = iter(trial_errors for trial_errors, _ in results)
 
+    for simulation in simulations: # for each simulation type
 
-            df.loc[df_row, "Session"] = human_session
-            df.loc[df_row, "Player"] = 1
-            df.loc[df_row, str(trial)] = final_err_player_1
+        # two rows (players 1 and 2) per session, one column per trial
+        trial_errors_table = make_results(human_sessions, (1, 2), range(firstTrial, lastTrial))
 
-            df.loc[df_row+1, "Session"] = human_session
-            df.loc[df_row+1, "Player"] = 2
-            df.loc[df_row+1, str(trial)] = final_err_player_2
+        for trial in range(firstTrial, lastTrial):
+            for human_session in human_sessions:
+                trial_errors = next(errors)
+                if trial_errors is None:
+                    continue
+                final_err_player_1, final_err_player_2 = trial_errors
+                set_result(trial_errors_table, human_session, 1, trial, final_err_player_1)
+                set_result(trial_errors_table, human_session, 2, trial, final_err_player_2)
 
-            df_row += 2  # Increment by 2 for the two players
+        # Write CSV once after all trials are processed, with as many rows as before (2 per entry of the Human folder)
+        write_results(trial_errors_table, os.path.join(output_dir, "Successive"+simulation+"_DTW_Errors.csv"), num_rows=len(human_sessions_directories)*2)
 
-    # Write CSV once after all trials are processed
-    df.to_csv(os.path.join(output_dir, "Successive"+simulations[simulation_key]+"_DTW_Errors.csv"), index=False)
 
+if __name__ == "__main__":
+    main()
@@ -14,9 +14,11 @@ from pathlib import Path # path functions
 import pandas as pd
 # Add parent directory to path to import tools
 sys.path.insert(0, str(Path(__file__).parent.parent))
-from tools.utils import get_chaser, get_num_targets # for project-specific custom functions
-import numpy as np
-from tqdm import tqdm, trange
+from tools.utils import get_dynamic_policy_array, get_num_targets, get_trial_distances, collapse_engagement # for project-specific custom functions
+from tools.trial_store import iter_trial_chunks # reads trials chunk by chunk, ingested ones without CSV parsing
+from tools.file_index import find_trial_files # indexed replacement for rglob
+from tools.parallel import get_workers, run_parallel # process pool for the per-trial work units
+from tools.policy_store import pack_policies # packs the written CSVs for the DTW scripts
 
 max_TAs = 5 # maximum number of targets in the experiment
 
@@ -25,207 +27,132 @@ wd = Path(os.path.dirname(os.path.realpath(__file__))).parents[1] # project work
 
 output_path = os.path.join(wd, "OtherResults", "TS_Dynamic_Policy")
 
-def dist(X,Y):
-    # X and Y are 2D points
-    # returns the Euclidean distance between the two points
-    return ((X[0]-Y[0])**2 + (X[1]-Y[1])**2)**0.5
-
-def get_closest_HA_TA_pair(trialData, i, player):
-    #we will get the HA and TA pair that are closest to each other, in the case that more than one TA is engaged with the HA
-    #trialData is the timeseries data for the current trial
-    #i is the current index in the actual_dynamic_policy breakout point
-    #player is the player we are looking at, 0 for player 0, 1 for player 1
-    numTargs = get_num_targets(trialData, max_TAs)
-    
-    HAx = trialData.iloc[i][player+'x']
-    HAz = trialData.iloc[i][player+'z']
-    HA_TA_distances = np.zeros(numTargs) -1
-    for j in range(numTargs):
-        TAjx = trialData.iloc[i]['t'+str(j)+'x']
-        TAjz = trialData.iloc[i]['t'+str(j)+'z']
-        HA_TA_distances[j] = dist([HAx,HAz],[TAjx,TAjz])
-    return np.argmin(HA_TA_distances)
-
-
-def get_actual_Dynamic_Policy_as_csv(trial, trialData):
-    skip_freq = 1# int(decision_delay / trialDeltaTime) #number of rows to skip to get the desired decision delay
-    num_rows_output = int((len(trialData) / skip_freq)) #number of rows in output array
-    output_array = np.zeros((num_rows_output,13)) - 1
-    numTargets = get_num_targets(trialData, maxTargets)
-
-    ################################################################################
-
-    #loop through all rows of trialData, skipping by skip_freq
-    for i in range(0, num_rows_output):
-        # first just get which TA is running at given point of time
-        trialDataIdx = i * skip_freq 
-        observedOrder = np.zeros((numHerders, maxTargets),dtype=int)
-        # for each herder, get the target they are running at the given time
-        # if they are not running a target, keep 0
-        # if they are running a target, get the target ID    
-        tcolsRun = ['t%drun' % (t) for t in range(0, numTargets)] #list of column names for targets running
-        whoIsRunning = [trialData[tcolRun][trialDataIdx] for tcolRun in tcolsRun] #list of which targets are running
-        for tidx, targetRunning in enumerate(whoIsRunning): 
-            if targetRunning: #if target is indeed running
-                #get the herder running that target
-                chasingHerderID = get_chaser(trialData.iloc[trialDataIdx], tidx, simulation_bool=simulation_bool) #get the herder chasing that target
-                for herderID in range(0, numHerders):
-                    if chasingHerderID[herderID]:
-                        observedOrder[herderID, tidx] = 1
-        output_array[i] = [trialData.iloc[trialDataIdx].time, trial, numTargets, *observedOrder[0,:], *observedOrder[1,:]]
+numHerders = 2
+maxTargets = 5
+firstTrial = 1
+lastTrial = 24 + 1 # +1 for python indexing
+numTrials = lastTrial - firstTrial
+numTargetArray = [3,4,5] # array of the possible number of targets in the experiment
+#startSample = 250 #index where to start the analysis from
+skip_freq = 1# int(decision_delay / trialDeltaTime) #number of rows to skip to get the desired decision delay
+
+columns = ["time","TrialID", "numTargs","HA0TA0", "HA0TA1", "HA0TA2", "HA0TA3", "HA0TA4","HA1TA0", "HA1TA1", "HA1TA2", "HA1TA3", "HA1TA4"]
+
+def get_actual_Dynamic_Policy_as_csv(trial, trialData, simulation_bool, distances=None):
+    # one row per row of trialData: time, TrialID, numTargs, then the 0/1 HA-TA engagement of each herder
+    # a herder engages a target if the target is running and the herder is within the repulsion distance (see get_chaser)
+    herder_header = 'hA' if simulation_bool else 'p'
+    herderHeaders = [herder_header + str(h) for h in range(0, numHerders)]
+    output_array = get_dynamic_policy_array(trialData, trial, herderHeaders, maxTargets, distances)
     return pd.DataFrame(data=output_array, columns = columns)
 
 
-def collapse_actual_dynamic_engagement(actual_dynamic_policy, trialData):
-    
-    # we are going to collapse the actual dynamic engagement policy into a single column
-    # we will do this by creating a new column and filling it with the appropriate values
-
-    # we will iterate through the rows of the actual_dynamic_policy and fill the new column with the appropriate values
-    # we will start by creating a new column with the same length as the actual_dynamic_policy
+def collapse_actual_dynamic_engagement(actual_dynamic_policy, trialData, simulation_bool, distances=None):
+    # we are going to collapse the actual dynamic engagement policy of each HA into a single column
+    # holding the ID of the engaged TA (-1 if none). If more than one TA is engaged with the HA,
+    # the TA closest to the HA is taken (see collapse_engagement)
+    if distances is None:
+        herder_header = 'hA' if simulation_bool else 'p'
+        distances = get_trial_distances(trialData, [herder_header + str(h) for h in range(0, numHerders)], get_num_targets(trialData, maxTargets))
 
     collapsed_policy = pd.DataFrame(columns=['time','TrialID','numTargs','HA0_engagement','HA1_engagement'])
     collapsed_policy['time'] = actual_dynamic_policy['time']
     collapsed_policy['TrialID'] = actual_dynamic_policy['TrialID']
     collapsed_policy['numTargs'] = actual_dynamic_policy['numTargs']
-    collapsed_policy['HA0_engagement'] = -1
-    collapsed_policy['HA1_engagement'] = -1
-    for idx, row in actual_dynamic_policy.iterrows():
-
-        if [row['HA0TA0'], row['HA0TA1'], row['HA0TA2'], row['HA0TA3'], row['HA0TA4']].count(1) > 1:
-            #print("More than one TA is engaged with HA0")
-            closest_TA = get_closest_HA_TA_pair(trialData, idx, player = 'p0' if not simulation_bool else 'hA0')
-            collapsed_policy.at[idx, 'HA0_engagement'] = closest_TA
-        # we will check if the HA is engaged with the TA
-        elif row['HA0TA0'] == 1:
-            collapsed_policy.at[idx, 'HA0_engagement'] = 0
-        elif row['HA0TA1'] == 1:
-            collapsed_policy.at[idx, 'HA0_engagement'] = 1
-        elif row['HA0TA2'] == 1:
-            collapsed_policy.at[idx, 'HA0_engagement'] = 2
-        elif row['HA0TA3'] == 1:
-            collapsed_policy.at[idx, 'HA0_engagement'] = 3
-        elif row['HA0TA4'] == 1:
-            collapsed_policy.at[idx, 'HA0_engagement'] = 4
-
-        if [row['HA1TA0'], row['HA1TA1'], row['HA1TA2'], row['HA1TA3'], row['HA1TA4']].count(1) > 1:
-            #print("More than one TA is engaged with HA1")
-            closest_TA = get_closest_HA_TA_pair(trialData, idx, player = 'p1' if not simulation_bool else 'hA1')
-            collapsed_policy.at[idx, 'HA1_engagement'] = closest_TA
-        elif row['HA1TA0'] == 1:
-            collapsed_policy.at[idx, 'HA1_engagement'] = 0
-        elif row['HA1TA1'] == 1:
-            collapsed_policy.at[idx, 'HA1_engagement'] = 1
-        elif row['HA1TA2'] == 1:
-            collapsed_policy.at[idx, 'HA1_engagement'] = 2
-        elif row['HA1TA3'] == 1:
-            collapsed_policy.at[idx, 'HA1_engagement'] = 3
-        elif row['HA1TA4'] == 1:
-            collapsed_policy.at[idx, 'HA1_engagement'] = 4
+    for herderID in range(0, numHerders):
+        oneHot = actual_dynamic_policy[['HA%dTA%d' % (herderID, t) for t in range(0, maxTargets)]].to_numpy()
+        collapsed_policy['HA%d_engagement' % (herderID)] = collapse_engagement(oneHot, distances[herderID])
 
     return collapsed_policy
 
-if not os.path.exists(output_path):
-    os.mkdir(output_path)
 
-for simulation_bool in [False, True]:
+def write_dynamic_policy(file_path, trial, simulation_bool, output_file):
+    # work unit: reads one trial and writes its collapsed dynamic policy to output_file
+    # the engagement of each row only depends on that row, so the trial is read and written chunk by chunk
+    os.makedirs(os.path.dirname(output_file), exist_ok=True) # one folder per session
+    # write under a temporary name first so a failure partway through a trial never leaves a partial policy behind
+    # (a hidden file, which the file index skips)
+    tmp_file = os.path.join(os.path.dirname(output_file), '.' + os.path.basename(output_file) + '.tmp')
+    with open(tmp_file, 'w', newline='') as f:
+        for i, trialData in enumerate(iter_trial_chunks(file_path)):
+            # HA-TA distances computed once, for the engagement and the tie-breaks of its collapse
+            herder_header = 'hA' if simulation_bool else 'p'
+            distances = get_trial_distances(trialData, [herder_header + str(h) for h in range(0, numHerders)], get_num_targets(trialData, maxTargets))
+            dynamicPolicyTimeSeries = get_actual_Dynamic_Policy_as_csv(trial, trialData, simulation_bool, distances)  #0 and 1 encoded HA-TA engagement
+            collapsedDynamicPolicyTimeSeries = collapse_actual_dynamic_engagement(dynamicPolicyTimeSeries, trialData, simulation_bool, distances)
+            pd.DataFrame(data=collapsedDynamicPolicyTimeSeries).to_csv(f, index=False, header=(i == 0))
+    os.replace(tmp_file, output_file)
+
+
+def get_work_units():
+    """Returns the (file_path, trial, simulation_bool, output_file) of every trial to write"""
+    work_units = []
+
+    for simulation_bool in [False, True]:
+
+        if simulation_bool:
+            simulation_types = ["CollinearAngle", "CollinearDistance", "Angle", "Distance", "ContainmentZone"]
+            for simulation_type in simulation_types:
+                dataDir = os.path.join(wd, 'OtherResults', 'AA-AA_SimulationData', simulation_type) # Directory of all data files
+                output_header = "Simulation"
+
+                sessions_directories = os.listdir(dataDir) # list of all sessions (ie, participants)
+
+                for session in sessions_directories:
+                    # Skip hidden files and directories (like .DS_Store)
+                    if session.startswith('.'):
+                        continue
+
+                    output_filename_folder = os.path.join(output_header, simulation_type, session)
+                    for trial in range(firstTrial, lastTrial):
+                        output_filename = "trialIdentifier_"+str(trial) + ".csv" #one file per trial
+                        trial_ID = "{:02}".format(trial)
 
-    if simulation_bool:
-        simulation_types = ["CollinearAngle", "CollinearDistance", "Angle", "Distance", "ContainmentZone"]
-        for simulation_type in simulation_types:
-            dataDir = os.path.join(wd, 'OtherResults', 'AA-AA_SimulationData', simulation_type) # Directory of all data files
-            output_header = "Simulation"
+                        # Find matching files
+                        matching_files = find_trial_files('simulation', trial, session=session, agent_type=simulation_type)
 
-            if not os.path.exists(os.path.join(output_path, output_header)):
-                os.mkdir(os.path.join(output_path, output_header))
+                        if len(matching_files) == 0:
+                            print(f"\nWarning: No file found for {simulation_type}, session {session}, trial {trial_ID}. Skipping...")
+                            continue
 
-            output_folder = os.path.join(output_path, output_header, simulation_type)
-            if not os.path.exists(output_folder):
-                os.mkdir(output_folder)
+                        file_path = matching_files[0]
+                        work_units.append((file_path, trial, simulation_bool, os.path.join(output_path, output_filename_folder, output_filename)))
 
-            numHerders = 2
-            maxTargets = 5
-            firstTrial = 1
-            lastTrial = 24 + 1 # +1 for python indexing
-            numTrials = lastTrial - firstTrial
-            numTargetArray = [3,4,5] # array of the possible number of targets in the experiment
-            #startSample = 250 #index where to start the analysis from
-            skip_freq = 1# int(decision_delay / trialDeltaTime) #number of rows to skip to get the desired decision delay
-            sessions_directories = os.listdir(dataDir) # list of all sessions (ie, participants)
+        else: # if real data
+            dataDir = os.path.join(wd, 'RAW_EXPERIMENT_DATA', 'TWO-HUMAN_HAs') # Directory of all data files
+            output_header = "Human"
 
-            columns = ["time","TrialID", "numTargs","HA0TA0", "HA0TA1", "HA0TA2", "HA0TA3", "HA0TA4","HA1TA0", "HA1TA1", "HA1TA2", "HA1TA3", "HA1TA4"]
+            sessions_directories = os.listdir(dataDir) # list of all sessions (ie, participants)
 
-            for session in tqdm(sessions_directories, desc="Sessions"):
+            for session in sessions_directories:
                 # Skip hidden files and directories (like .DS_Store)
                 if session.startswith('.'):
                     continue
 
-                output_filename_folder = os.path.join(output_header, simulation_type, session)
-                if not os.path.exists(os.path.join(output_path, output_filename_folder)):
-                    os.mkdir(os.path.join(output_path, output_filename_folder))
-                for trial in trange(firstTrial, lastTrial, desc="Trials", leave=False):
+                output_filename_folder = os.path.join(output_header, session)
+                for trial in range(firstTrial, lastTrial):
                     output_filename = "trialIdentifier_"+str(trial) + ".csv" #one file per trial
                     trial_ID = "{:02}".format(trial)
-                    part_dir = Path(os.path.join(dataDir, session, 'ExperimentData'))
 
                     # Find matching files
-                    matching_files = [path for path in part_dir.rglob('*trialIdentifier'+trial_ID+'*')]
+                    matching_files = find_trial_files('human', trial, session=session)
 
                     if len(matching_files) == 0:
-                        print(f"\nWarning: No file found for {simulation_type}, session {session}, trial {trial_ID}. Skipping...")
+                        print(f"\nWarning: No file found for session {session}, trial {trial_ID}. Skipping...")
                         continue
 
-                    file_path = matching_files[0]
-                    trialData = pd.read_csv(file_path)
-                    dynamicPolicyTimeSeries = get_actual_Dynamic_Policy_as_csv(trial, trialData)  #0 and 1 encoded HA-TA engagement
-                    collapsedDynamicPolicyTimeSeries = collapse_actual_dynamic_engagement(dynamicPolicyTimeSeries, trialData)
-
-
-                    pd.DataFrame(data=collapsedDynamicPolicyTimeSeries).to_csv(os.path.join(output_path, output_filename_folder, output_filename), index=False)
-                    
-    else: # if real data
-        dataDir = os.path.join(wd, 'RAW_EXPERIMENT_DATA', 'TWO-HUMAN_HAs') # Directory of all data files
-        output_header = "Human"
-        output_folder = os.path.join(output_path, output_header)
-        if not os.path.exists(output_folder):
-            os.mkdir(output_folder)
-
-        numHerders = 2
-        maxTargets = 5
-        firstTrial = 1
-        lastTrial = 24 + 1 # +1 for python indexing
-        numTrials = lastTrial - firstTrial
-        numTargetArray = [3,4,5] # array of the possible number of targets in the experiment
-        #startSample = 250 #index where to start the analysis from
-        skip_freq = 1# int(decision_delay / trialDeltaTime) #number of rows to skip to get the desired decision delay
-        sessions_directories = os.listdir(dataDir) # list of all sessions (ie, participants)
-
-        columns = ["time","TrialID", "numTargs","HA0TA0", "HA0TA1", "HA0TA2", "HA0TA3", "HA0TA4","HA1TA0", "HA1TA1", "HA1TA2", "HA1TA3", "HA1TA4"]
-
-        for session in tqdm(sessions_directories, desc="Sessions"):
-            # Skip hidden files and directories (like .DS_Store)
-            if session.startswith('.'):
-                continue
-
-            output_filename_folder = os.path.join(output_header, session)
-            if not os.path.exists(os.path.join(output_path, output_filename_folder)):
-                os.mkdir(os.path.join(output_path, output_filename_folder))
-            for trial in trange(firstTrial, lastTrial, desc="Trials", leave=False):
-                output_filename = "trialIdentifier_"+str(trial) + ".csv" #one file per trial
-                trial_ID = "{:02}".format(trial)
-                part_dir = Path(os.path.join(dataDir, session, 'ExperimentData'))
-
-                # Find matching files
-                matching_files = [path for path in part_dir.rglob('*trialIdentifier'+trial_ID+'*')]
-
-                if len(matching_files) == 0:
-                    print(f"\nWarning: No file found for session {session}, trial {trial_ID}. Skipping...")
-                    continue
+                    filePath = matching_files[0] #0 because assuming only one such file exists
+                    work_units.append((filePath, trial, simulation_bool, os.path.join(output_path, output_filename_folder, output_filename)))
+
+    return work_units
+
 
-                filePath = matching_files[0] #0 because assuming only one such file exists
-                trialData = pd.read_csv(filePath)
-                dynamicPolicyTimeSeries = get_actual_Dynamic_Policy_as_csv(trial, trialData)  #0 and 1 encoded HA-TA engagement
-                collapsedDynamicPolicyTimeSeries = collapse_actual_dynamic_engagement(dynamicPolicyTimeSeries, trialData)
+def main():
+    workers = get_workers()
+    run_parallel(write_dynamic_policy, get_work_units(), workers=workers, desc="Trials")
+    pack_policies('human_policy')
+    pack_policies('simulation_policy')
 
 
-                pd.DataFrame(data=collapsedDynamicPolicyTimeSeries).to_csv(os.path.join(output_path, output_filename_folder, output_filename), index=False)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,15 @@ import sys
 from pathlib import Path
 import numpy as np
 import pandas as pd
-from fastdtw import fastdtw
-from scipy.spatial.distance import euclidean
-from tqdm import tqdm
+
+# Add parent Scripts directory to path for importing tools module
+script_dir = os.path.dirname(os.path.abspath(__file__))
+scripts_dir = os.path.dirname(script_dir)
+sys.path.insert(0, scripts_dir)
+
+from tools.policy_store import load_policies, get_policy, find_policies
+from tools.dtw_utils import get_pairwise_dtw, get_cross_dtw, get_new_dtw_distances, add_dtw_distances, save_dtw_cache, get_dtw_mode
+from tools.parallel import get_workers, run_parallel
 
 ############################### USER SETTINGS ##################################
 first_trial = 7
@@ -17,7 +23,39 @@ num_trials = last_trial - first_trial
 ################################################################################
 
 
-def GETall_AAteam_scores():
+def get_AAteam_trial_scores(player, trial, human_human_sessions, AA_types, dtw_mode='approximate'):
+    """
+    Work unit: normalised DTW scores of the human and the AA of every human-AA team of one trial and player
+    against each human-human team.
+
+    Returns:
+    list of (score type ('human' or 'AA'), session, normalised DTW score), in the order they are to be summed
+    dict of the DTW distances computed by this unit (see get_new_dtw_distances)
+    """
+    humanhumanTSs = [get_policy('human_policy', trial, session)['HA%d_engagement' % (player)] for session in human_human_sessions] #views into the policy store
+    trial_scores = []
+    for subFolder in ["HumanPlayer0", "HumanPlayer1"]:
+        for AA_type in AA_types:
+            AAteamPolicies = find_policies('human_aa_policy', trial, agent_type=AA_type, player_folder=subFolder)
+            if player == 0 and subFolder == "HumanPlayer0" or player == 1 and subFolder == "HumanPlayer1":
+                properHeader = 'p0'
+                score_type = 'human'
+            elif player == 0 and subFolder == "HumanPlayer1" or player == 1 and subFolder == "HumanPlayer0":
+                properHeader = 'hA0'
+                score_type = 'AA'
+            session_names = [session_name for session_name, _ in AAteamPolicies]
+            AAteamTSs = [policy[properHeader + '_engagement'] for _, policy in AAteamPolicies] #human-AA team data
+
+            #DTW distance of every human-AA team against every human-human team of the trial, computed in one batch
+            #(human-human series first, as fastdtw is not symmetric)
+            distances = get_cross_dtw(humanhumanTSs, AAteamTSs, save=False, mode=dtw_mode).T
+            for session_name, AAteamTS, AAteamDistances in zip(session_names, AAteamTSs, distances):
+                for humanhumanTS, distance in zip(humanhumanTSs, AAteamDistances):
+                    trial_scores.append((score_type, session_name, 1 - distance / (len(humanhumanTS) + len(AAteamTS))))
+    return trial_scores, get_new_dtw_distances()
+
+
+def GETall_AAteam_scores(workers=1, dtw_mode='approximate'):
     """Returns the normalised DTW scores of each human-AA team against each human-human team"""
     cwd = os.path.dirname(__file__) # current working directory
     wd = Path(cwd).parents[1] # project working directory
@@ -53,41 +91,45 @@ def GETall_AAteam_scores():
         for session in AA_sessions[AA_type]:
             AA_scores[session] = np.zeros(num_trials)
 
-    for player in (0,1): #player 0 and player 1 start off in predetermined positions each trial
-        for trial in range(first_trial,last_trial): #loop over trials
-            print('\r'+"Processing trial "+ str(trial)+ " for player "+ str(player))
-            trial_ID = "_" + str(trial)
-            humanhumanFilePaths = [[path for path in Path(os.path.join(humanDataDir, session)).rglob('*trialIdentifier'+trial_ID+'*')] for session in human_human_sessions]
-            for subFolder in ["HumanPlayer0", "HumanPlayer1"]:
-                for AA_type in AA_types:
-                    expDir = os.path.join(wd, 'OtherResults', 'Actual_Dynamic_Policies_HumanAA', AA_type)
-                    expFiles = [path for path in Path(os.path.join(expDir, subFolder)).rglob('*trialIdentifier'+trial_ID+'*')]
-                    for expFile in tqdm(expFiles) : #include a progress bar
-                        session_name = Path(expFile).parent.name
-                        AAteamData = pd.read_csv(expFile) #human-AA team data
-                        if player == 0 and subFolder == "HumanPlayer0" or player == 1 and subFolder == "HumanPlayer1":
-                            properHeader = 'p0'
-                            AAteamTS = AAteamData[properHeader + '_engagement']
-                            for humanhumanFilePath in tqdm(humanhumanFilePaths):
-
-                                humanhumanData = pd.read_csv(humanhumanFilePath[0])
-
-                                humanhumanTS = humanhumanData['HA%d_engagement' % (player)]
-                                human_scores[session_name][trial-first_trial] += 1 - fastdtw( np.column_stack([humanhumanTS]), np.column_stack([AAteamTS]), dist=euclidean)[0] / (len(humanhumanTS) + len(AAteamTS))
-                        elif player == 0 and subFolder == "HumanPlayer1" or player == 1 and subFolder == "HumanPlayer0":
-                            properHeader = 'hA0'
-                            AAteamTS = AAteamData[properHeader + '_engagement']
-                            for humanhumanFilePath in tqdm(humanhumanFilePaths):
-                                
-                                humanhumanData = pd.read_csv(humanhumanFilePath[0]) 
-                                humanhumanTS = humanhumanData['HA%d_engagement' % (player)]
-                                AA_scores[session_name][trial-first_trial] += 1 - fastdtw( np.column_stack([humanhumanTS]), np.column_stack([AAteamTS]), dist=euclidean)[0] / (len(humanhumanTS) + len(AAteamTS))
+    work_units = [(player, trial, human_human_sessions, AA_types, dtw_mode) for player in (0,1) for trial in range(first_trial,last_trial)]
+    results = run_parallel(get_AAteam_trial_scores, work_units, workers=workers, desc="Trials")
+    for (player, trial, _, _, _), (trial_scores, new_distances) in zip(work_units, results):
+        add_dtw_distances(new_distances)
+        for score_type, session_name, score in trial_scores:
+            if score_type == 'human':
+                human_scores[session_name][trial-first_trial] += score
+            else:
+                AA_scores[session_name][trial-first_trial] += score
+    save_dtw_cache()
 
 
     return human_scores, AA_scores
 
 
-def GETall_humanTeam_scores():
+def get_humanTeam_trial_scores(player, trial, human_human_sessions, dtw_mode='approximate'):
+    """
+    Work unit: normalised DTW scores of each human-human session of one trial and player against each other session.
+
+    Returns:
+    list of (session index, normalised DTW score), in the order they are to be summed
+    dict of the DTW distances computed by this unit (see get_new_dtw_distances)
+    """
+    #read every session once and get the DTW distance of each pair of sessions
+    humanhumanTSs = [get_policy('human_policy', trial, session)['HA%d_engagement' % (player)] for session in human_human_sessions]
+    distances = get_pairwise_dtw(humanhumanTSs, save=False, mode=dtw_mode)
+
+    #calculate the normalised DTW scores of each evaluee against each single background session
+    trial_scores = []
+    for count, evaluee_session in enumerate(human_human_sessions): #loop over single human-human sessions
+        evalueeTS = humanhumanTSs[count]
+        for background_count, backgroundTS in enumerate(humanhumanTSs):
+            if background_count == count:
+                continue
+            trial_scores.append((count, 1 - distances[background_count, count] / (len(backgroundTS) + len(evalueeTS)))) #background first, as fastdtw is not symmetric
+    return trial_scores, get_new_dtw_distances()
+
+
+def GETall_humanTeam_scores(workers=1, dtw_mode='approximate'):
     cwd = os.path.dirname(__file__) # current working directory
     wd = Path(cwd).parents[1] # project working directory
     humanDataDir = os.path.join(wd, 'OtherResults', 'TS_Dynamic_Policy', 'Human') # directory containing human-human TSp data
@@ -95,27 +137,20 @@ def GETall_humanTeam_scores():
     num_humanhumanSessions = len(human_human_sessions)
 
     humanTeamScores = np.zeros((num_humanhumanSessions, num_trials)) #there are num_humanhumanSessions human-human sessions and num_trials trials per session
-    for count, evaluee_session in enumerate(human_human_sessions): #loop over single human-human sessions
-        print("\n Evaluee session: ", count+1, " of ", len(human_human_sessions))
-        background_sessions = [session for session in human_human_sessions if session != evaluee_session]
-        for player in (0,1): #player 0 and player 1 start off in predetermined positions each trial
-            for trial in range(first_trial,last_trial): #loop over trials
-                #calculate the normalised DTW scores of each evaluee against each single background session
-                trial_ID = "_"+str(trial)  #"{:02}".format(trial)
-                backgroundFilePaths = [[path for path in Path(os.path.join(humanDataDir, background_session)).rglob('*trialIdentifier'+trial_ID+'*')] for background_session in background_sessions]
-
-                evalFile = [path for path in Path(os.path.join(humanDataDir, evaluee_session)).rglob('*trialIdentifier'+trial_ID+'*')][0]     
-                evalueeData = pd.read_csv(evalFile)   
-                for backgroundFilePath in tqdm(backgroundFilePaths):
-                    backgroundData = pd.read_csv(backgroundFilePath[0])
-                    backgroundTS = backgroundData['HA%d_engagement' % (player)]
-                    evalueeTS = evalueeData['HA%d_engagement' % (player)]
-                    humanTeamScores[count][trial-first_trial] += 1 - fastdtw( np.column_stack([backgroundTS]), np.column_stack([evalueeTS]), dist=euclidean)[0] / (len(backgroundTS) + len(evalueeTS))
+    work_units = [(player, trial, human_human_sessions, dtw_mode) for player in (0,1) for trial in range(first_trial,last_trial)]
+    results = run_parallel(get_humanTeam_trial_scores, work_units, workers=workers, desc="Trials")
+    for (player, trial, _, _), (trial_scores, new_distances) in zip(work_units, results):
+        add_dtw_distances(new_distances)
+        for count, score in trial_scores:
+            humanTeamScores[count][trial-first_trial] += score
+    save_dtw_cache()
     return humanTeamScores / 2 / 21 #divide by 2 as there are 2 players in the human-human team and divide by 21 as there are 21 trials per session
             
 
 
 if __name__ == "__main__":
+    workers = get_workers()
+    dtw_mode = get_dtw_mode(default='approximate') # fastdtw, as the published scores; --dtw exact for the exact DTW
 
     cwd = os.path.dirname(os.path.realpath(__file__))
     wd = Path(cwd).parents[1] # project working directory
@@ -142,15 +177,19 @@ if __name__ == "__main__":
         print("To recompute, delete these files first.")
         sys.exit(0)
 
+    # pack the policy CSVs once here, so the worker processes only map the store
+    load_policies('human_policy')
+    load_policies('human_aa_policy')
+
     print("Calculating all DTWs for human-human teams")
-    humanTeamDTWs = GETall_humanTeam_scores()
+    humanTeamDTWs = GETall_humanTeam_scores(workers, dtw_mode)
     #save humanTeamDTWs as .csv file
     pd.DataFrame(humanTeamDTWs, columns=cols).to_csv(os.path.join(save_dir, "humanTeamDTWs.csv"), index=False)
     print(f"Saved humanTeamDTWs.csv")
 
 
     print("Calculating all DTWs for human-AA teams")
-    humanDTWs, AA_DTWs = GETall_AAteam_scores()
+    humanDTWs, AA_DTWs = GETall_AAteam_scores(workers, dtw_mode)
 
 
     # Collect scores for Heuristic agent type (Session1xxx)
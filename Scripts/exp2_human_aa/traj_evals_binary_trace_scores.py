@@ -16,7 +16,10 @@ scripts_dir = os.path.dirname(script_dir)
 sys.path.insert(0, scripts_dir)
 
 #custom package
-from tools.traj_utils import get_binary_trace
+from tools.traj_utils import get_binary_heatmap, get_leave_one_out_heatmaps, get_streamed_trajectory, get_visited_trace, get_streamed_heatmap_trace
+from tools.file_index import find_trial_files
+from tools.parallel import get_workers, run_parallel
+from tools.shared_trials import share_trials, find_dataset_files
 
 ############################### USER SETTINGS ##################################
 first_trial = 7
@@ -25,7 +28,45 @@ last_trial = 24 + 1
 ################################################################################
 
 
-def get_surrogate_human_team_traces():
+def get_surrogate_trial_traces(player, trial, all_sessions):
+    """
+    Work unit: binary trace of each human-human session's player against the heatmap of all other sessions.
+
+    Returns:
+    list of (session index, binary trace) for the sessions that could be scored
+    """
+    # read each session's trajectory for the given trial once, chunk by chunk: its histogram and visited cells
+    trialDatas = {}
+    for session in all_sessions:
+        filePaths = find_trial_files('human', trial, session=session)
+        if len(filePaths) == 0:
+            continue  # Skip if this session doesn't have this trial
+        trialDatas[session] = get_streamed_trajectory(filePaths[0], 'p%d' % (player))
+
+    # each evaluee session is compared against the heatmap of all other sessions:
+    # count each session once, then get every leave-one-out heatmap as total minus own counts
+    evaluee_sessions = list(trialDatas.keys())
+    session_histograms = np.array([trialDatas[session][0] for session in evaluee_sessions])
+    if len(evaluee_sessions) > 0:
+        background_heatmaps = get_leave_one_out_heatmaps(session_histograms)
+
+    traces = []
+    for count, evaluee_session in enumerate(all_sessions):
+        num_background = len(evaluee_sessions) - (evaluee_session in trialDatas)
+        # Skip this trial entirely if no background data was found
+        if num_background == 0:
+            print(f"\nWarning: No background data found for trial {trial}, skipping...")
+            continue
+        if evaluee_session not in trialDatas:
+            print(f"\nWarning: No evaluee data found for trial {trial} in session {evaluee_session}, skipping...")
+            continue
+
+        evaluee_index = evaluee_sessions.index(evaluee_session)
+        traces.append((count, get_visited_trace(background_heatmaps[evaluee_index], trialDatas[evaluee_session][1])))
+    return traces
+
+
+def get_surrogate_human_team_traces(workers=1):
     # get the surrogate human team traces
 
     cwd = os.path.dirname(__file__)
@@ -37,51 +78,61 @@ def get_surrogate_human_team_traces():
 
     print("Evaluating surrogate human team traces")
 
-    for count, evaluee_session in enumerate(all_sessions):
-        print("\n Evaluee session: ", count+1, " of ", len(all_sessions))
-        background_sessions = [session for session in all_sessions if session != evaluee_session and not session.startswith('.')]
-
-        for player in (0,1):
-
-            for trial in range(first_trial,last_trial):
-                sys.stdout.write('\r'+"Processing trial "+ str(trial)+ " for player "+ str(player))
-                X = np.array([])
-                Z = np.array([])
-                trial_ID = "{:02}".format(trial)
-                filePaths = [[path for path in Path(os.path.join(humanDataDir, background_session)).rglob('*trialIdentifier'+trial_ID+'*')] for background_session in background_sessions]
-
-                # Skip trial if no files found for any session
-                files_found = 0
-                for filePath in filePaths:
-                    if len(filePath) == 0:
-                        continue  # Skip if this session doesn't have this trial
-                    files_found += 1
-                    trialData = pd.read_csv(filePath[0])
-                    X = np.append(X, trialData['p%dx' % (player)].to_numpy())
-                    Z = np.append(Z, trialData['p%dz' % (player)].to_numpy())
-
-                # Skip this trial entirely if no background data was found
-                if files_found == 0:
-                    print(f"\nWarning: No background data found for trial {trial}, skipping...")
-                    continue
-                #now we have all the human data for the given trial and given player
-
-                # Get evaluee file
-                evalFiles = [path for path in Path(os.path.join(humanDataDir, evaluee_session)).rglob('*trialIdentifier'+trial_ID+'*')]
-                if len(evalFiles) == 0:
-                    print(f"\nWarning: No evaluee data found for trial {trial} in session {evaluee_session}, skipping...")
-                    continue
-
-                evalFile = evalFiles[0]
-                trialData = pd.read_csv(evalFile)
-
-                humanTeamTraces[count][trial-first_trial] += get_binary_trace(X, Z, trialData, "p" + str(player))        
-                
+    work_units = [(player, trial, all_sessions) for player in (0,1) for trial in range(first_trial,last_trial)]
+    results = run_parallel(get_surrogate_trial_traces, work_units, workers=workers, desc="Trials")
+    for (player, trial, _), traces in zip(work_units, results):
+        for count, binary_trace in traces:
+            humanTeamTraces[count][trial-first_trial] += binary_trace
+
     humanTeamTraces = np.array(humanTeamTraces) /  2 #normalise by number of players
 
     return humanTeamTraces
 
-def main():
+
+def score_trial(player, trial, all_sessions, AA_types):
+    """
+    Work unit: binary traces of the human and the AA of each Human-AA team against the heatmap of all
+    human-human sessions of one trial and player.
+
+    Returns:
+    list of (score type ('human' or 'AA'), session, binary trace), in the order they are to be summed
+    """
+    h = 0
+    filePaths = [find_trial_files('human', trial, session=background_session) for background_session in all_sessions]
+
+    # Skip trial if no files found for any session
+    files_found = 0
+    for filePath in filePaths:
+        if len(filePath) == 0:
+            continue  # Skip if this session doesn't have this trial
+        files_found += 1
+        h = h + get_streamed_trajectory(filePath[0], 'p%d' % (player))[0] # counts of each file, read chunk by chunk
+
+    # Skip this trial entirely if no data was found
+    if files_found == 0:
+        print(f"\nWarning: No data found for trial {trial}, skipping...")
+        return []
+    #now we have all the human data for the given trial and given player
+    #build its binary heatmap once and score every Human-AA trajectory of the trial against it
+    binary_heatmap = get_binary_heatmap(h)
+
+    scores = []
+    for subFolder in ["HumanPlayer0", "HumanPlayer1"]:
+
+        for AA_count, AA_type in enumerate(AA_types):
+            expFiles = find_trial_files('human_aa', trial, agent_type=AA_type, player_folder=subFolder)
+            session_names = [Path(expFile).parent.parent.name for expFile in expFiles]
+            if player == 0 and subFolder == "HumanPlayer0" or player == 1 and subFolder == "HumanPlayer1":
+                individual_trial_human_scores = [get_streamed_heatmap_trace(binary_heatmap, expFile, "p0") for expFile in expFiles]
+                scores += [('human', session_name, score) for session_name, score in zip(session_names, individual_trial_human_scores)]
+
+            elif player == 0 and subFolder == "HumanPlayer1" or player == 1 and subFolder == "HumanPlayer0":
+                individual_trial_AA_scores = [get_streamed_heatmap_trace(binary_heatmap, expFile, "hA0") for expFile in expFiles]
+                scores += [('AA', session_name, score) for session_name, score in zip(session_names, individual_trial_AA_scores)]
+    return scores
+
+
+def main(workers=1):
 
 
     wd = Path(os.path.dirname(os.path.realpath(__file__))
@@ -114,59 +165,26 @@ def main():
             AA_scores_better[session] = np.zeros(18)
 
 
-    for player in (0,1):
-
-        for trial in range(first_trial,last_trial):
-            sys.stdout.write('\r'+"Processing trial "+ str(trial)+ " for player "+ str(player))
-            X = np.array([])
-            Z = np.array([])
-            trial_ID = "{:02}".format(trial)
-            filePaths = [[path for path in Path(os.path.join(humanDataDir, background_session)).rglob('*trialIdentifier'+trial_ID+'*')] for background_session in all_sessions]
-
-            # Skip trial if no files found for any session
-            files_found = 0
-            for filePath in filePaths:
-                if len(filePath) == 0:
-                    continue  # Skip if this session doesn't have this trial
-                files_found += 1
-                trialData = pd.read_csv(filePath[0])
-                X = np.append(X, trialData['p%dx' % (player)].to_numpy())
-                Z = np.append(Z, trialData['p%dz' % (player)].to_numpy())
-
-            # Skip this trial entirely if no data was found
-            if files_found == 0:
-                print(f"\nWarning: No data found for trial {trial}, skipping...")
-                continue
-            #now we have all the human data for the given trial and given player            
-
-            for subFolder in ["HumanPlayer0", "HumanPlayer1"]:
-
-                for AA_count, AA_type in enumerate(AA_types):
-                    expDir = os.path.join(wd,'RAW_EXPERIMENT_DATA','HUMAN-AA_TEAM', AA_type)
-                    expFiles = [path for path in Path(os.path.join(expDir, subFolder)).rglob('*trialIdentifier'+trial_ID+'*')]
-                    for expFile in expFiles:
-                        session_name = Path(expFile).parent.parent.name
-                        if player == 0 and subFolder == "HumanPlayer0" or player == 1 and subFolder == "HumanPlayer1":
-                            individual_trial_human_score = get_binary_trace(X, Z, pd.read_csv(expFile), "p0")
-                            #human_scores[AA_count].append(individual_trial_human_score)
-                            human_scores_better[session_name][trial-first_trial] += individual_trial_human_score
-
-
-                        elif player == 0 and subFolder == "HumanPlayer1" or player == 1 and subFolder == "HumanPlayer0":
-                            individual_trial_AA_score = get_binary_trace(X, Z, pd.read_csv(expFile), "hA0")
-                            #AA_scores[AA_count].append(individual_trial_AA_score)
-                            AA_scores_better[session_name][trial-first_trial] += individual_trial_AA_score
-                
-        
-                
-    humanTeamTraces = get_surrogate_human_team_traces()   
+    if workers > 1: # the trajectories are read once into shared memory, instead of by every worker
+        share_trials(find_dataset_files(['human', 'human_aa'], range(first_trial,last_trial), AA_types))
+
+    work_units = [(player, trial, all_sessions, AA_types) for player in (0,1) for trial in range(first_trial,last_trial)]
+    results = run_parallel(score_trial, work_units, workers=workers, desc="Trials")
+    for (player, trial, _, _), scores in zip(work_units, results):
+        for score_type, session_name, score in scores:
+            if score_type == 'human':
+                human_scores_better[session_name][trial-first_trial] += score
+            else:
+                AA_scores_better[session_name][trial-first_trial] += score
+
+    humanTeamTraces = get_surrogate_human_team_traces(workers)   
 
     return humanTeamTraces, human_scores_better, AA_scores_better
 
 if __name__ == "__main__":
 
 
-    humanTeamTraces, human_scores_better, AA_scores_better = main()
+    humanTeamTraces, human_scores_better, AA_scores_better = main(get_workers())
 
     # Collect scores for Heuristic agent type only (Session1xxx)
     AA_scores_heur = []
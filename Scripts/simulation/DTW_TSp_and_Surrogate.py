@@ -2,11 +2,19 @@
 performs surrogate analysis on the TS engagement time series
 saves arrays"""
 import os
+import sys
 from pathlib import Path
 import numpy as np
 import pandas as pd
-from similaritymeasures import dtw
-from tqdm import tqdm
+
+# Add parent Scripts directory to path for importing tools module
+script_dir = os.path.dirname(os.path.abspath(__file__))
+scripts_dir = os.path.dirname(script_dir)
+sys.path.insert(0, scripts_dir)
+
+from tools.file_index import find_trial_files
+from tools.dtw_utils import get_dtw_distance, get_new_dtw_distances, add_dtw_distances, save_dtw_cache, get_dtw_mode
+from tools.parallel import get_workers, run_parallel
 
 ############################### USER SETTINGS ##################################
 first_trial = 7
@@ -15,7 +23,80 @@ num_trials = last_trial - first_trial
 ################################################################################
 
 
-def main():
+def get_evaluee_trial_scores(count, player, trial, human_human_sessions, AA_types, dtw_mode='exact'):
+    """
+    Work unit: normalised DTW scores of one evaluee human-human session, and of every human-AA team,
+    against each single background session for one trial and player.
+
+    Returns:
+    AAteam_scores: list of (score type ('human' or 'AA'), session, list of normalised DTW scores, number of background files)
+    humanTeam_scores: list of the normalised DTW scores of the evaluee
+    humanTeam_trialscount: number of background files read for the evaluee
+    new_distances: dict of the DTW distances computed by this unit (see get_new_dtw_distances)
+    """
+    evaluee_session = human_human_sessions[count]
+    background_sessions = [session for session in human_human_sessions if session != evaluee_session]
+    backgroundFilePaths = [find_trial_files('human_policy', trial, session=background_session) for background_session in background_sessions]
+    evalFile = find_trial_files('human_policy', trial, session=evaluee_session)[0]     
+    evalueeData = pd.read_csv(evalFile)   
+
+    AAteam_scores = []
+    for subFolder in ["HumanPlayer0", "HumanPlayer1"]:
+        for _, AA_type in enumerate(AA_types):
+            expFiles = find_trial_files('human_aa_policy', trial, agent_type=AA_type, player_folder=subFolder)
+            for expFile in expFiles:
+
+                session_name = Path(expFile).parent.name
+                AAteamData = pd.read_csv(expFile)
+
+                numTargets = int(AAteamData['numTargs'][0])
+                taCols = ["TA%d" % i for i in range(0,numTargets)]
+                haCol = "HA%d" % player
+                colNames = [haCol + taCol for taCol in taCols]
+
+                if player == 0 and subFolder == "HumanPlayer0" or player == 1 and subFolder == "HumanPlayer1":
+                    score_type = 'human'
+                elif player == 0 and subFolder == "HumanPlayer1" or player == 1 and subFolder == "HumanPlayer0":
+                    score_type = 'AA'
+
+                AAteamTS = [AAteamData[col].to_numpy() for col in colNames]
+                session_scores = []
+                trialscount = 0
+                for backgroundFilePath in backgroundFilePaths:
+                    try:
+                        backgroundData = pd.read_csv(backgroundFilePath[0]) #"Error reading file: not present as trial was unsuccessful. Will continue to next trial."
+                        trialscount+=1
+                    except (FileNotFoundError, pd.errors.EmptyDataError, IndexError) as e:
+                        print(f"\nWarning: Skipping file due to: {e}")
+                        continue
+                    backgroundTS = [backgroundData[col].to_numpy() for col in colNames]
+                    session_scores.append(1 - get_dtw_distance( np.column_stack([backgroundTS]).T, np.column_stack([AAteamTS]).T, save=False, mode=dtw_mode) / (len(backgroundTS) + len(AAteamTS)))
+                AAteam_scores.append((score_type, session_name, session_scores, trialscount))
+
+    humanTeam_scores = []
+    trialscount = 0
+    #calculate the normalised DTW scores of each evaluee against each single background session
+    for backgroundFilePath in backgroundFilePaths:
+        try:
+            backgroundData = pd.read_csv(backgroundFilePath[0]) #print("Error reading file: not present as trial was unsuccessful. Will continue to next trial.")
+            trialscount+=1
+        except (FileNotFoundError, pd.errors.EmptyDataError, IndexError) as e:
+            print(f"\nWarning: Skipping file due to: {e}")
+            continue
+
+        numTargets = int(backgroundData['numTargs'][0])
+        taCols = ["TA%d" % i for i in range(0,numTargets)]
+        haCol = "HA%d" % player
+        headersHA = [haCol + taCol for taCol in taCols]
+
+        backgroundTS = [backgroundData[col].to_numpy() for col in headersHA]
+        evalueeTS =  [evalueeData[col].to_numpy() for col in headersHA]    #evalueeData['HA%d_engagement' % (player)]
+
+        humanTeam_scores.append(1 - get_dtw_distance( np.column_stack([backgroundTS]).T, np.column_stack([evalueeTS]).T, save=False, mode=dtw_mode) / (len(backgroundTS) + len(evalueeTS)))
+    return AAteam_scores, humanTeam_scores, trialscount, get_new_dtw_distances()
+
+
+def main(workers=1, dtw_mode='exact'):
     cwd = os.path.dirname(__file__) # current working directory
     wd = Path(cwd).parents[1] # project working directory
     humanDataDir = os.path.join(wd,'OtherResults','TS_Dynamic_Policy','Human') # directory containing human-human TSp data
@@ -56,86 +137,22 @@ def main():
 
     humanTeamScores = np.zeros((num_humanhumanSessions, num_trials)) #there are num_humanhumanSessions human-human sessions and num_trials trials per session
 
-    for count, evaluee_session in enumerate(human_human_sessions): #loop over single human-human sessions
-        print("\n Evaluee session: ", count+1, " of ", len(human_human_sessions))
-        background_sessions = [session for session in human_human_sessions if session != evaluee_session]
-        for player in (0,1): #player 0 and player 1 start off in predetermined positions each trial
-            for trial in range(first_trial,last_trial): #loop over trials
-                print('\r'+"Processing trial "+ str(trial)+ " for player "+ str(player))
-                trial_ID = "_"+str(trial)  #"{:02}".format(trial)
-                backgroundFilePaths = [[path for path in Path(os.path.join(humanDataDir, background_session)).rglob('*trialIdentifier'+trial_ID+'*')] for background_session in background_sessions]
-                evalFile = [path for path in Path(os.path.join(humanDataDir, evaluee_session)).rglob('*trialIdentifier'+trial_ID+'*')][0]     
-                evalueeData = pd.read_csv(evalFile)   
-
-
-                for subFolder in ["HumanPlayer0", "HumanPlayer1"]:
-                    for _, AA_type in enumerate(AA_types):
-                        expDir = os.path.join(wd, 'OtherResults','Actual_Dynamic_Policies_HumanAA', AA_type)
-                        expFiles = [path for path in Path(os.path.join(expDir, subFolder)).rglob('*trialIdentifier'+trial_ID+'*')]
-                        for expFile in tqdm(expFiles) : #include a progress bar
-
-                            session_name = Path(expFile).parent.name
-                            AAteamData = pd.read_csv(expFile)
-
-                            numTargets = int(AAteamData['numTargs'][0])
-                            taCols = ["TA%d" % i for i in range(0,numTargets)]
-                            haCol = "HA%d" % player
-                            colNames = [haCol + taCol for taCol in taCols]
-
-                            if player == 0 and subFolder == "HumanPlayer0" or player == 1 and subFolder == "HumanPlayer1":
-                        
-                                AAteamTS = [AAteamData[col].to_numpy() for col in colNames]
-                                trialscount = 0
-                                for backgroundFilePath in tqdm(backgroundFilePaths):
-                                    try:
-                                        backgroundData = pd.read_csv(backgroundFilePath[0]) #"Error reading file: not present as trial was unsuccessful. Will continue to next trial."
-                                        trialscount+=1
-                                    except (FileNotFoundError, pd.errors.EmptyDataError, IndexError) as e:
-                                        print(f"\nWarning: Skipping file due to: {e}")
-                                        continue
-                                    backgroundTS = [backgroundData[col].to_numpy() for col in colNames]
-                                    human_scores[session_name][trial-first_trial] += 1 - dtw( np.column_stack([backgroundTS]).T, np.column_stack([AAteamTS]).T)[0] / (len(backgroundTS) + len(AAteamTS))
-                                human_scores[session_name][trial-first_trial] /= trialscount
-                            
-                            elif player == 0 and subFolder == "HumanPlayer1" or player == 1 and subFolder == "HumanPlayer0":
-                          
-                                AAteamTS = [AAteamData[col].to_numpy() for col in colNames]
-                                trialscount = 0 
-                                for backgroundFilePath in tqdm(backgroundFilePaths):
-                                    try:
-                                        backgroundData = pd.read_csv(backgroundFilePath[0]) #print("Error reading file: not present as trial was unsuccessful. Will continue to next trial.")
-                                        trialscount+=1
-                                    except (FileNotFoundError, pd.errors.EmptyDataError, IndexError) as e:
-                                        print(f"\nWarning: Skipping file due to: {e}")
-                                        continue
-                                    backgroundTS = [backgroundData[col].to_numpy() for col in colNames]
-                                    AA_scores[session_name][trial-first_trial] += 1 - dtw( np.column_stack([backgroundTS]).T, np.column_stack([AAteamTS]).T)[0] / (len(backgroundTS) + len(AAteamTS))
-                                AA_scores[session_name][trial-first_trial] /= trialscount
-
-                trialscount = 0
-                #calculate the normalised DTW scores of each evaluee against each single background session
-                for backgroundFilePath in tqdm(backgroundFilePaths):
-                    try:
-                        backgroundData = pd.read_csv(backgroundFilePath[0]) #print("Error reading file: not present as trial was unsuccessful. Will continue to next trial.")
-                        trialscount+=1
-                    except (FileNotFoundError, pd.errors.EmptyDataError, IndexError) as e:
-                        print(f"\nWarning: Skipping file due to: {e}")
-                        continue
-
-                    
-
-                    numTargets = int(backgroundData['numTargs'][0])
-                    taCols = ["TA%d" % i for i in range(0,numTargets)]
-                    haCol = "HA%d" % player
-                    headersHA = [haCol + taCol for taCol in taCols]
-
-                    backgroundTS = [backgroundData[col].to_numpy() for col in headersHA]
-                    evalueeTS =  [evalueeData[col].to_numpy() for col in headersHA]    #evalueeData['HA%d_engagement' % (player)]
+    # one work unit per evaluee session, player and trial; the results are summed in the same order as the units
+    work_units = [(count, player, trial, human_human_sessions, AA_types, dtw_mode) for count in range(len(human_human_sessions)) for player in (0,1) for trial in range(first_trial,last_trial)]
+    results = run_parallel(get_evaluee_trial_scores, work_units, workers=workers, desc="Trials")
+    for (count, player, trial, _, _, _), (AAteam_scores, humanTeam_scores, humanTeam_trialscount, new_distances) in zip(work_units, results):
+        add_dtw_distances(new_distances)
+        for score_type, session_name, session_scores, trialscount in AAteam_scores:
+            scores = human_scores if score_type == 'human' else AA_scores
+            for score in session_scores:
+                scores[session_name][trial-first_trial] += score
+            scores[session_name][trial-first_trial] /= trialscount
 
-                    humanTeamScores[count][trial-first_trial] += 1 - dtw( np.column_stack([backgroundTS]).T, np.column_stack([evalueeTS]).T)[0] / (len(backgroundTS) + len(evalueeTS))
-                humanTeamScores[count][trial-first_trial] /= trialscount
-        
+        for score in humanTeam_scores:
+            humanTeamScores[count][trial-first_trial] += score
+        humanTeamScores[count][trial-first_trial] /= humanTeam_trialscount
 
+    save_dtw_cache() #keep the DTW distances for the next run
 
     humanTeamScores /= 2 #divide by 2 as there are 2 players in each human-human session
     humanTeamScores =  humanTeamScores.mean(axis = 1) #take average across trials, preserve sessions axis
@@ -144,7 +161,7 @@ def main():
 
 
 if __name__ == "__main__":
-    humanTeamScores, human_scores, AA_scores = main()
+    humanTeamScores, human_scores, AA_scores = main(get_workers(), get_dtw_mode())
     AA_scores_heur = []
     
     human_scores_heur = []
@@ -0,0 +1,362 @@
+"""Benchmarks of the hot paths of the analysis, on synthetic herding trials.
+
+The private RAW_EXPERIMENT_DATA is not needed: make_synthetic_trial generates trials with the column schema of the
+raw CSVs (time, TrialID, p{n}x/y/z and p{n}xq/yq/zq/wq, or the same with hA{n} for the AAs, t{n}x/z, t{n}run),
+in which the herders move towards the target they are assigned to and a target runs while a herder is close to it. The trials are written as CSVs in
+the layout of TWO-HUMAN_HAs and read back, then every benchmark times one pass over all of them.
+
+Benchmarks (one call is one function call):
+    read_csv                    pd.read_csv of every trial
+    get_binary_trace            binary trace of each HA of each trial along the heatmap of all sessions
+    binary_trace_sweep          the same traces for every bin size of sweep_bin_sizes and 4 thresholds, from one heatmap pyramid
+    trace                       trace of each HA of each trial along the same heatmap
+    get_chaser                  every HA-TA pair at every time index of every trial
+    get_observed_target_order   each HA of each trial
+    get_observed_target_orders  all HAs of all trials in one batched call
+    order_match                 observed target order of each HA of each trial against every permutation() of the TAs
+    score_target_orders         the same orders against the permutation table in one batched call
+    dynamic_policy              dynamic policy of each trial, collapsed to one engaged TA per HA
+    dtw_fastdtw                 fastdtw of the engagement series of each HA, between successive sessions
+    dtw_exact                   the same pairs, solved together by tools/dtw_utils.py (without the cache)
+    dtw_banded                  the same pairs, within the default Sakoe-Chiba band of tools/dtw_utils.py
+
+The timings are written as JSON, together with the parameters, the git commit and the library versions, to
+OtherResults/Benchmarks/benchmark_<date>_<time>.json (or the file given with --output).
+
+Usage (from the Scripts folder):
+    python -m tools.benchmark [--sessions N] [--trials N] [--length N] [--targets N] [--repeats N] [--seed N]
+                              [--output FILE] [--data-dir DIR] [benchmark ...]
+"""
+
+import os # for directory handling
+import sys # for the command line arguments
+import json # for the results file
+import time # for the timings
+import getopt # for command line arguments
+import platform # for the machine description
+import tempfile # for the synthetic trials
+import importlib # for the dynamic policy functions of the exp1 script
+import subprocess # for the git commit
+from datetime import datetime
+from pathlib import Path # for file handling
+import numpy as np
+import pandas as pd
+from fastdtw import fastdtw
+from scipy.spatial.distance import euclidean
+from .utils import get_chaser, get_observed_target_order, get_observed_target_orders, order_match, permutation, score_target_orders, trace, repulsion_distance
+from .traj_utils import get_binary_trace, get_histogram, get_binary_heatmap, get_visited_cells, get_base_bin_size, get_pyramid_traces, sweep_bin_sizes, bin_size, xlim, ylim
+from .dtw_utils import compute_dtw_distances
+
+wd = Path(__file__).resolve().parents[2] # project working directory
+results_dir = os.path.join(wd, 'OtherResults', 'Benchmarks')
+
+numHerders = 2
+trialDeltaTime = 0.02 # seconds between two samples
+herderSpeed = 0.35 # distance moved by a HA per sample
+targetSpeed = 0.1 # distance moved by a walking TA per sample
+runSpeed = 0.3 # distance moved by a running TA per sample
+switchInterval = (100, 400) # range of the number of samples a HA stays on its assigned TA
+sweep_thresholds = (5, 10, 15, 20) # thresholds of the binary_trace_sweep benchmark
+
+benchmark_names = ['read_csv', 'get_binary_trace', 'binary_trace_sweep', 'trace', 'get_chaser', 'get_observed_target_order', 'get_observed_target_orders', 'order_match', 'score_target_orders', 'dynamic_policy', 'dtw_fastdtw', 'dtw_exact', 'dtw_banded']
+default_parameters = {'sessions': 4, 'trials': 4, 'length': 3000, 'targets': 5, 'repeats': 3, 'seed': 0}
+
+
+def make_synthetic_trial(rng, trial, trialLength, numTargets, herderHeaders=('p0', 'p1')):
+    """
+    Arguments:
+    rng: np.random.Generator
+    trial: trial number, written to the TrialID column
+    trialLength: number of samples
+    numTargets: number of TAs
+    herderHeaders: column prefixes of the HAs
+
+    Returns:
+    pd.DataFrame with the columns of a raw trial CSV
+    """
+    numHerders = len(herderHeaders)
+    fieldLimits = np.array([xlim, ylim]) - 1
+    herders = np.zeros((numHerders, trialLength, 2))
+    targets = np.zeros((numTargets, trialLength, 2))
+    running = np.zeros((numTargets, trialLength), dtype=bool)
+    herders[:, 0] = rng.uniform(-fieldLimits, fieldLimits, (numHerders, 2))
+    targets[:, 0] = rng.uniform(-fieldLimits / 2, fieldLimits / 2, (numTargets, 2))
+
+    assigned = rng.integers(0, numTargets, numHerders) # TA each HA is moving towards
+    nextSwitch = rng.integers(*switchInterval, numHerders)
+    herderNoise = rng.normal(0, 0.3, (trialLength, numHerders, 2))
+    targetSteps = rng.normal(0, targetSpeed, (trialLength, numTargets, 2))
+    for i in range(1, trialLength):
+        switching = np.flatnonzero(i >= nextSwitch)
+        assigned[switching] = rng.integers(0, numTargets, len(switching))
+        nextSwitch[switching] = i + rng.integers(*switchInterval, len(switching))
+        heading = targets[assigned, i - 1] - herders[:, i - 1]
+        heading = heading / np.maximum(np.hypot(heading[:, 0], heading[:, 1]), 1e-9)[:, np.newaxis] + herderNoise[i]
+        herders[:, i] = herders[:, i - 1] + herderSpeed * heading / np.hypot(heading[:, 0], heading[:, 1])[:, np.newaxis]
+
+        # a TA runs away from the closest HA while one is within the repulsion distance, and walks randomly otherwise
+        away = targets[:, i - 1, np.newaxis, :] - herders[np.newaxis, :, i - 1, :]
+        distances = np.hypot(away[..., 0], away[..., 1])
+        closest = np.argmin(distances, axis=1)
+        closestDistances = distances[np.arange(numTargets), closest]
+        running[:, i] = closestDistances < repulsion_distance
+        step = targetSteps[i]
+        flee = away[np.arange(numTargets), closest] / np.maximum(closestDistances, 1e-9)[:, np.newaxis]
+        step[running[:, i]] = runSpeed * flee[running[:, i]]
+        targets[:, i] = np.clip(targets[:, i - 1] + step, -fieldLimits, fieldLimits)
+    herders = np.clip(herders, -fieldLimits, fieldLimits)
+
+    # every TA runs at least once, as in the experiment
+    for t in np.flatnonzero(~running.any(axis=1)):
+        running[t, rng.integers(1, trialLength)] = True
+
+    data = {'time': np.arange(trialLength) * trialDeltaTime, 'TrialID': np.full(trialLength, trial)}
+    for h, header in enumerate(herderHeaders):
+        data[header + 'x'] = herders[h, :, 0]
+        data[header + 'y'] = np.ones(trialLength)
+        data[header + 'z'] = herders[h, :, 1]
+        velocity = np.gradient(herders[h], axis=0)
+        yaw = np.arctan2(velocity[:, 0], velocity[:, 1]) # rotation about the vertical axis
+        data[header + 'xq'] = np.zeros(trialLength)
+        data[header + 'yq'] = np.sin(yaw / 2)
+        data[header + 'zq'] = np.zeros(trialLength)
+        data[header + 'wq'] = np.cos(yaw / 2)
+    for t in range(numTargets):
+        data['t%dx' % (t)] = targets[t, :, 0]
+        data['t%dz' % (t)] = targets[t, :, 1]
+        data['t%drun' % (t)] = running[t]
+    return pd.DataFrame(data)
+
+
+def write_synthetic_trials(data_dir, sessions, trials, trialLength, numTargets, seed=0):
+    """
+    Writes sessions x trials synthetic trial CSVs to data_dir/Session<NNN>/ExperimentData/.
+
+    Returns:
+    dict of (session, trial) to the path of the CSV
+    """
+    rng = np.random.default_rng(seed)
+    paths = {}
+    for session in range(sessions):
+        session_dir = os.path.join(data_dir, 'Session%03d' % (session), 'ExperimentData')
+        os.makedirs(session_dir, exist_ok=True)
+        for trial in range(1, trials + 1):
+            paths[(session, trial)] = os.path.join(session_dir, 'Data_trialIdentifier%02d.csv' % (trial))
+            make_synthetic_trial(rng, trial, trialLength, numTargets).to_csv(paths[(session, trial)], index=False)
+    return paths
+
+
+def get_benchmarks(paths, numTargets):
+    """
+    Arguments:
+    paths: as returned by write_synthetic_trials
+    numTargets: number of TAs of every trial
+
+    Returns:
+    dict of benchmark name to a function without arguments that runs the benchmark once and returns its number of calls
+    """
+    policy_module = importlib.import_module('exp1_human_human.get_actual_TS_Dynamic_Policy_as_csv')
+    trials = {key: pd.read_csv(path) for key, path in paths.items()}
+    herders = ['p%d' % (h) for h in range(numHerders)]
+    trial_numbers = sorted(set(trial for _, trial in trials))
+
+    # inputs of the trace benchmarks: the positions of all HAs of all sessions, per trial
+    positions = {}
+    for trial in trial_numbers:
+        datas = [data for (_, t), data in trials.items() if t == trial]
+        positions[trial] = (np.concatenate([data[h + 'x'].to_numpy() for data in datas for h in herders]),
+                            np.concatenate([data[h + 'z'].to_numpy() for data in datas for h in herders]))
+    heatmaps = {trial: get_binary_heatmap(get_histogram(*positions[trial])) for trial in trial_numbers}
+    rows = {key: data.to_dict('records') for key, data in trials.items()}
+    targetOrders = get_observed_target_orders(list(trials.values()), numTargets, herders)[0]
+
+    # inputs of the DTW benchmarks: the collapsed engagement of each HA, compared between successive sessions
+    def get_policy(data, trial):
+        return policy_module.collapse_actual_dynamic_engagement(policy_module.get_actual_Dynamic_Policy_as_csv(trial, data, False), data, False)
+    policies = {key: get_policy(data, key[1]) for key, data in trials.items()}
+    pairs = []
+    for (session, trial), policy in policies.items():
+        if (session + 1, trial) in policies:
+            for h in range(numHerders):
+                column = 'HA%d_engagement' % (h)
+                pairs.append((policy[column].to_numpy(), policies[(session + 1, trial)][column].to_numpy()))
+
+    def run_read_csv():
+        for path in paths.values():
+            pd.read_csv(path)
+        return len(paths)
+
+    def run_get_binary_trace():
+        for (_, trial), data in trials.items():
+            for h in herders:
+                get_binary_trace(*positions[trial], data, h)
+        return len(trials) * numHerders
+
+    def run_binary_trace_sweep():
+        base_size = get_base_bin_size(sweep_bin_sizes)
+        for (_, trial), data in trials.items():
+            background = get_histogram(*positions[trial], size=base_size)
+            visited = np.array([get_visited_cells(data[h + 'x'].to_numpy(), data[h + 'z'].to_numpy(), size=base_size) for h in herders])
+            get_pyramid_traces(background, visited, base_size, sweep_bin_sizes, sweep_thresholds)
+        return len(trials) * numHerders
+
+    def run_trace():
+        for (_, trial), data in trials.items():
+            for h in herders:
+                trace(heatmaps[trial], data[[h + 'x', h + 'z']].to_numpy(), bin_size, xlim, ylim)
+        return len(trials) * numHerders
+
+    def run_get_chaser():
+        calls = 0
+        for trial_rows in rows.values():
+            for row in trial_rows:
+                for t in range(numTargets):
+                    get_chaser(row, t, False)
+            calls += len(trial_rows) * numTargets
+        return calls
+
+    def run_get_observed_target_order():
+        for data in trials.values():
+            for h in range(numHerders):
+                get_observed_target_order(data, h, numTargets)
+        return len(trials) * numHerders
+
+    def run_get_observed_target_orders():
+        get_observed_target_orders(list(trials.values()), numTargets, herders)
+        return 1
+
+    def run_order_match():
+        candidates = permutation(list(range(numTargets)))
+        for order in targetOrders.reshape(-1, targetOrders.shape[-1]):
+            for candidate in candidates:
+                order_match(order[:numTargets], candidate)
+        return len(trials) * numHerders * len(candidates)
+
+    def run_score_target_orders():
+        score_target_orders(targetOrders, numTargets)
+        return 1
+
+    def run_dynamic_policy():
+        for (_, trial), data in trials.items():
+            get_policy(data, trial)
+        return len(trials)
+
+    def run_dtw_fastdtw():
+        for a, b in pairs:
+            fastdtw(np.column_stack([a]), np.column_stack([b]), dist=euclidean)
+        return len(pairs)
+
+    def run_dtw_exact():
+        compute_dtw_distances(pairs)
+        return len(pairs)
+
+    def run_dtw_banded():
+        compute_dtw_distances(pairs, mode='banded')
+        return len(pairs)
+
+    return {
+        'read_csv': run_read_csv,
+        'get_binary_trace': run_get_binary_trace,
+        'binary_trace_sweep': run_binary_trace_sweep,
+        'trace': run_trace,
+        'get_chaser': run_get_chaser,
+        'get_observed_target_order': run_get_observed_target_order,
+        'get_observed_target_orders': run_get_observed_target_orders,
+        'order_match': run_order_match,
+        'score_target_orders': run_score_target_orders,
+        'dynamic_policy': run_dynamic_policy,
+        'dtw_fastdtw': run_dtw_fastdtw,
+        'dtw_exact': run_dtw_exact,
+        'dtw_banded': run_dtw_banded,
+    }
+
+
+def time_benchmark(benchmark, repeats):
+    """
+    Runs benchmark repeats times.
+
+    Returns:
+    dict of the number of calls per run and the min, median and mean wall time of a run, and the min time per call
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        calls = benchmark()
+        times.append(time.perf_counter() - start)
+    return {'calls': calls, 'repeats': repeats, 'min_s': min(times), 'median_s': float(np.median(times)),
+            'mean_s': float(np.mean(times)), 'per_call_s': min(times) / max(calls, 1)}
+
+
+def get_git_commit():
+    """Returns the commit hash of the working tree, or None outside of a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=wd, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(parameters, selected=None, data_dir=None):
+    """
+    Arguments:
+    parameters: dict with the keys of default_parameters
+    selected: names of the benchmarks to run (all if None)
+    data_dir: folder for the synthetic CSVs, kept after the run (a temporary folder if None)
+
+    Returns:
+    dict of the results, as written to the JSON file
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = write_synthetic_trials(data_dir or tmp_dir, parameters['sessions'], parameters['trials'],
+                                       parameters['length'], parameters['targets'], parameters['seed'])
+        benchmarks = get_benchmarks(paths, parameters['targets'])
+        timings = {}
+        for name in selected or benchmarks:
+            timings[name] = time_benchmark(benchmarks[name], parameters['repeats'])
+            print(f"{name:28s} {timings[name]['calls']:8d} calls  {timings[name]['min_s']:9.4f} s  {timings[name]['per_call_s'] * 1e6:11.2f} us/call")
+
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': parameters,
+        'results': timings,
+    }
+
+
+if __name__ == "__main__":
+    usage = "Usage: python -m tools.benchmark [--sessions N] [--trials N] [--length N] [--targets N] [--repeats N] [--seed N] [--output FILE] [--data-dir DIR] [benchmark ...]"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "o:", [key + "=" for key in default_parameters] + ["output=", "data-dir="])
+    except getopt.GetoptError as err:
+        print(f"Error: {err}")
+        print(usage)
+        sys.exit(2)
+
+    parameters = dict(default_parameters)
+    output_file = os.path.join(results_dir, 'benchmark_' + datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+    data_dir = None
+    for opt, arg in opts:
+        if opt[2:] in parameters:
+            parameters[opt[2:]] = int(arg)
+        elif opt in ("-o", "--output"):
+            output_file = arg
+        elif opt == "--data-dir":
+            data_dir = arg
+    if parameters['targets'] < 1 or parameters['sessions'] < 1 or parameters['trials'] < 1 or parameters['repeats'] < 1:
+        print("Error: --sessions, --trials, --targets and --repeats must be at least 1")
+        sys.exit(2)
+
+    for name in args:
+        if name not in benchmark_names:
+            print(f"Error: unknown benchmark {name}, one of {', '.join(benchmark_names)}")
+            sys.exit(2)
+
+    results = run_benchmarks(parameters, selected=args or None, data_dir=data_dir)
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output_file}")
@@ -0,0 +1,677 @@
+"""Exact dynamic time warping (DTW) of engagement time series, with a persistent result cache.
+
+The TS engagement series are short sequences over a small alphabet (the engaged TA index, or a one-hot row of
+HA-TA engagements), so every series is first turned into a sequence of integer symbols and the local costs are
+looked up in a symbol x symbol table of euclidean distances. Many pairs are then solved at once by sweeping the
+anti-diagonals of the DTW matrices, each anti-diagonal being a single vectorized step over all pairs.
+
+The recursion is the one of similaritymeasures.dtw (and fastdtw.dtw):
+    d[i, j] = c[i, j] + min(d[i-1, j], d[i, j-1], d[i-1, j-1])
+and gives bit-identical distances.
+
+The engagement series are also piecewise constant, with long runs of one symbol. When the symbol costs are integers
+(as for the 1-D engagement series) and the series have few runs, the pairs are instead solved on their run-length
+encodings by dtw_runs_batch: the DTW matrix is split into blocks of constant cost (one per pair of runs) and only the
+last row and column of each block are computed, in closed form from the block's first row and column (Froese et al.,
+2020, Fast exact dynamic time warping on run-length encoded time series). The cost grows with the number of runs times
+the series lengths instead of the product of the lengths, and the distances are the same, since all sums of integer
+costs are exact.
+
+Three modes are available, chosen by the scripts with --dtw (see get_dtw_mode; each script sets its own default):
+    exact               the full DTW, as above
+    banded[:FRACTION]   exact DTW restricted to a Sakoe-Chiba band of FRACTION (default 0.1) of the longer series
+                        around the diagonal; only the band of each anti-diagonal is computed, and the distance is an
+                        upper bound of the exact one. The band is not applied to the run-length encodings, so banded
+                        pairs are always swept in full and banded DTW is slower than exact DTW on the engagement series
+    approximate         fastdtw (Salvador & Chan, 2007), as the scripts used before; also an upper bound, but not
+                        symmetric: its distance depends on which series of a pair comes first
+Given a max_distance, pairs whose LB_Kim or LB_Keogh lower bound exceeds it are skipped, and the anti-diagonal
+sweep abandons a pair as soon as two successive anti-diagonals exceed it. get_nearest_series uses both for top-k
+nearest neighbour searches, with the k-th best distance found so far as max_distance.
+
+Distances are cached in OtherResults/DTW_cache.json keyed by content hashes of the two series (and the mode, for
+banded and approximate distances), so a pair is only ever computed once, whichever script or loop asks for it.
+Approximate distances are keyed by the ordered pair, as fastdtw gives both orders different distances.
+"""
+
+import os # for directory handling
+import sys # for exiting on an invalid --dtw
+import json # for the persisted cache
+import hashlib # for content hashes
+from pathlib import Path # for file handling
+import numpy as np
+from scipy.spatial.distance import cdist, euclidean
+from fastdtw import fastdtw
+from .utils import encode_runs
+from .parallel import get_options
+from . import profiling # opt-in timers, see instrument_module at the end
+
+wd = Path(__file__).resolve().parents[2] # project working directory
+cache_path = os.path.join(wd, 'OtherResults', 'DTW_cache.json')
+
+batch_size = 256 # number of pairs solved together in one anti-diagonal sweep
+run_cost_ratio = 12 # relative cost of one run-length block edge element vs one DTW matrix cell, see use_runs
+dtw_modes = ('exact', 'banded', 'approximate') # see parse_dtw_mode
+default_band = 0.1 # Sakoe-Chiba band of the banded mode, as a fraction of the longer series
+
+_cache = None # in-memory copy of the cache, loaded once per process
+_cache_changed = False # True if _cache holds distances that are not yet saved
+_new_distances = {} # distances computed in this process, see get_new_dtw_distances
+
+
+def as_series(series):
+    """Returns series (1-D sequence of values, or 2-D time x features) as a 2-D float64 array."""
+    series = np.asarray(series, dtype=np.float64)
+    if series.ndim == 1:
+        series = series.reshape(-1, 1)
+    return np.ascontiguousarray(series)
+
+
+def hash_series(series):
+    """Returns the sha1 hex digest of the shape and values of series."""
+    series = as_series(series)
+    h = hashlib.sha1(str(series.shape).encode())
+    h.update(series.tobytes())
+    return h.hexdigest()
+
+
+def get_pair_key(hash_a, hash_b):
+    """DTW is symmetric, so both orders of a pair share one key."""
+    return hash_a + hash_b if hash_a <= hash_b else hash_b + hash_a
+
+
+def load_dtw_cache():
+    """Returns the cache of distances keyed by get_pair_key, reading it from disk on the first call."""
+    global _cache
+    if _cache is None:
+        _cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                _cache = json.load(f)
+    return _cache
+
+
+def save_dtw_cache():
+    """Writes the distances computed in this process to the cache file."""
+    global _cache_changed
+    if not _cache_changed or not os.path.isdir(os.path.dirname(cache_path)):
+        return
+    tmp_path = cache_path + '.%d.tmp' % (os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(_cache, f)
+    os.replace(tmp_path, cache_path)
+    _cache_changed = False
+
+
+def get_new_dtw_distances():
+    """
+    Returns the distances computed in this process since the last call, as a dict keyed like the cache.
+    Worker processes (see tools/parallel.py) return these to the main process, which adds them with
+    add_dtw_distances and is the only one to write the cache file.
+    """
+    global _new_distances
+    new_distances, _new_distances = _new_distances, {}
+    return new_distances
+
+
+def add_dtw_distances(distances):
+    """Adds distances (as returned by get_new_dtw_distances) to the cache; save_dtw_cache writes them."""
+    global _cache_changed
+    cache = load_dtw_cache()
+    for key, distance in distances.items():
+        if key not in cache:
+            cache[key] = distance
+            _cache_changed = True
+
+
+def get_symbols(series_list):
+    """
+    Encodes every row of the given series as an integer symbol.
+
+    Arguments:
+    series_list: list of 2-D arrays as returned by as_series, all with the same number of features
+
+    Returns:
+    symbols: list of 1-D int arrays, one per series
+    cost_table: np.array (numSymbols x numSymbols) of euclidean distances between the symbols
+    """
+    rows = np.concatenate(series_list)
+    alphabet, inverse = np.unique(rows, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    splits = np.cumsum([len(series) for series in series_list])[:-1]
+    return np.split(inverse, splits), cdist(alphabet, alphabet)
+
+
+def get_band_radii(n, m, band):
+    """
+    Sakoe-Chiba band of each pair: cell (i, j) is kept if |i * (m - 1) - j * (n - 1)| <= radius, ie if it lies within
+    band * max(n, m) samples of the diagonal from (0, 0) to (n - 1, m - 1), measured along the longer series.
+    The band is widened where needed to keep a warping path through it.
+
+    Arguments:
+    n, m: int arrays of the lengths of the two series of each pair
+    band: fraction of the longer series
+
+    Returns:
+    np.array of the radius of each pair, in units of i * (m - 1) - j * (n - 1)
+    """
+    shorter, longer = np.minimum(n, m) - 1, np.maximum(n, m) - 1
+    width = np.maximum(band * np.maximum(n, m), np.maximum(1, longer / np.maximum(shorter, 1)))
+    return width * np.maximum(shorter, 0)
+
+
+def dtw_batch(symbols_a, symbols_b, cost_table, band=None, max_distances=None):
+    """
+    Exact (or Sakoe-Chiba banded) DTW distances of the pairs (symbols_a[p], symbols_b[p]).
+
+    Arguments:
+    symbols_a, symbols_b: lists of 1-D int arrays of symbols (see get_symbols)
+    cost_table: np.array of the distance between each pair of symbols
+    band: if given, fraction of the longer series of the Sakoe-Chiba band (see get_band_radii)
+    max_distances: if given, np.array of a threshold per pair; a pair is abandoned (inf) as soon as every cell of two
+    successive anti-diagonals exceeds its threshold, since every warping path crosses one of them
+
+    Returns:
+    np.array of the DTW distance of each pair (inf if either series is empty, or if the pair was abandoned)
+    """
+    num_pairs = len(symbols_a)
+    n = np.array([len(s) for s in symbols_a])
+    m = np.array([len(s) for s in symbols_b])
+    distances = np.full(num_pairs, np.inf)
+    if num_pairs == 0 or n.max() == 0 or m.max() == 0:
+        return distances
+
+    N, M = n.max(), m.max()
+    A = np.zeros((num_pairs, N), dtype=int)
+    B = np.zeros((num_pairs, M), dtype=int)
+    for p in range(num_pairs):
+        A[p, :n[p]] = symbols_a[p]
+        B[p, :m[p]] = symbols_b[p]
+    last_diagonal = n + m - 2 # anti-diagonal of each pair's final cell
+    active = (n > 0) & (m > 0) # pairs still being solved
+    if band is not None:
+        radii = get_band_radii(n, m, band)
+        steps = np.maximum(n + m - 2, 1)
+
+    # cell (i, j) of anti-diagonal k = i + j is stored at index i + 1 of the diagonal buffers, index 0 stays inf;
+    # only the rows written on each buffer (written_*) are reset before it is reused
+    prev2 = np.full((num_pairs, N + 1), np.inf) # anti-diagonal k - 2
+    prev1 = np.full((num_pairs, N + 1), np.inf) # anti-diagonal k - 1
+    cur = np.full((num_pairs, N + 1), np.inf)
+    written_prev2 = written_prev1 = written_cur = slice(0, 0)
+    for k in range(N + M - 1):
+        low, high = max(0, k - M + 1), min(N - 1, k)
+        if band is not None:
+            # rows of anti-diagonal k inside the band of at least one pair still being solved
+            band_low = np.ceil((k * (n - 1) - radii) / steps)
+            band_high = np.floor((k * (n - 1) + radii) / steps)
+            low, high = max(low, int(band_low[active].min())), min(high, int(band_high[active].max()))
+        i = np.arange(low, high + 1)
+        c = cost_table[A[:, i], B[:, k - i]]
+        if band is not None:
+            c = np.where(np.abs(i * (m[:, np.newaxis] - 1) - (k - i) * (n[:, np.newaxis] - 1)) <= radii[:, np.newaxis], c, np.inf)
+        cur[:, written_cur] = np.inf
+        if k == 0:
+            cur[:, 1] = c[:, 0]
+        else:
+            # up: d[i-1, j], left: d[i, j-1] (both on anti-diagonal k - 1), diagonal: d[i-1, j-1] (on k - 2)
+            cur[:, i + 1] = c + np.minimum(np.minimum(prev1[:, i], prev1[:, i + 1]), prev2[:, i])
+        written_cur = slice(low + 1, high + 2)
+        finished = active & (last_diagonal == k)
+        distances[finished] = cur[finished, n[finished]]
+        active &= last_diagonal > k
+
+        if max_distances is not None and k > 0:
+            abandoned = active & (cur[:, written_cur].min(axis=1) > max_distances) & (prev1[:, written_prev1].min(axis=1) > max_distances)
+            active &= ~abandoned
+        if not active.any():
+            break
+        prev2, prev1, cur = prev1, cur, prev2
+        written_prev2, written_prev1, written_cur = written_prev1, written_cur, written_prev2
+    return distances
+
+
+def get_segments(lengths):
+    """
+    Arguments:
+    lengths: int array of the lengths of consecutive segments of a flat array
+
+    Returns:
+    ids: segment of each element
+    positions: position of each element within its segment
+    offsets: index of the first element of each segment
+    """
+    offsets = (np.cumsum(lengths) - lengths).astype(int)
+    ids = np.repeat(np.arange(len(lengths)), lengths)
+    return ids, np.arange(len(ids)) - offsets[ids], offsets
+
+
+def segment_cummin(x, ids, reverse=False):
+    """
+    Running minimum of x restarting at each segment (from the end of the segment if reverse).
+    x must hold integer values (or inf) and ids must be nondecreasing: every segment is shifted below the previous
+    one by a power of two larger than the range of x, so one np.minimum.accumulate serves all segments exactly.
+    """
+    if reverse:
+        return segment_cummin(x[::-1], ids[-1] - ids[::-1])[::-1] if len(x) > 0 else x.copy()
+    finite = np.isfinite(x)
+    if not finite.any():
+        return x.copy()
+    low, high = x[finite].min(), x[finite].max()
+    sentinel = high + 1 # stands for inf, which would otherwise carry the minimum of the previous segment over
+    shift = 2.0 ** np.ceil(np.log2(high - low + 2))
+    if ids[-1] * shift + abs(low) >= 2.0 ** 52:
+        raise ValueError("DTW values too large for exact segmented minima")
+    offsets = ids * shift
+    out = np.minimum.accumulate(np.where(finite, x, sentinel) - offsets) + offsets
+    out[out >= sentinel] = np.inf
+    return out
+
+
+def get_block_edges(par, par_lengths, perp, perp_lengths, costs):
+    """
+    Last row (or column) of a set of DTW blocks of constant cost, from their first row and column.
+
+    The cell at distance j along the far edge of a block of cost c, m cells away from the parallel boundary,
+    is reached from boundary cell k of the parallel boundary (k = 0 the corner, k = i + 1 its i-th cell) through
+    max(m, j + 1 - k) cells, and from boundary cell i of the perpendicular boundary through max(m - 1 - i, j + 1) cells.
+    Each minimum over k or i is a window, prefix or suffix minimum.
+
+    Arguments:
+    par: flat array of the parallel boundaries, each as [corner, n cells]
+    par_lengths: int array of n + 1 per block
+    perp: flat array of the perpendicular boundaries (m cells each, without the corner)
+    perp_lengths: int array of m per block
+    costs: cost of each block
+
+    Returns:
+    flat array of the n cells of the far edge of each block
+    """
+    par_ids, par_positions, par_offsets = get_segments(par_lengths)
+    perp_ids, perp_positions, perp_offsets = get_segments(perp_lengths)
+    ids, j, _ = get_segments(par_lengths - 1)
+    c, m = costs[ids], perp_lengths[ids]
+    par_base, perp_base = par_offsets[ids], perp_offsets[ids]
+
+    # k in [j + 1 - m, j + 1]: m cells; the window is split into chunks of width m + 1 (van Herk/Gil-Werman)
+    width = perp_lengths + 1
+    num_chunks = -(-par_lengths // width)
+    chunk_ids = (np.cumsum(num_chunks) - num_chunks)[par_ids] + par_positions // width[par_ids]
+    chunk_prefix = segment_cummin(par, chunk_ids)
+    chunk_suffix = segment_cummin(par, chunk_ids, reverse=True)
+    edge = np.minimum(chunk_prefix[par_base + j + 1], chunk_suffix[par_base + np.maximum(0, j + 1 - m)]) + c * m
+
+    # k < j + 1 - m: j + 1 - k cells
+    far = j >= m
+    shifted_prefix = segment_cummin(par - costs[par_ids] * par_positions, par_ids)
+    edge[far] = np.minimum(edge[far], shifted_prefix[par_base[far] + j[far] - m[far]] + c[far] * (j[far] + 1))
+
+    # i >= m - 2 - j: j + 1 cells, i < m - 2 - j: m - 1 - i cells
+    perp_suffix = segment_cummin(perp, perp_ids, reverse=True)
+    edge = np.minimum(edge, perp_suffix[perp_base + np.maximum(0, m - 2 - j)] + c * (j + 1))
+    perp_prefix = segment_cummin(perp + costs[perp_ids] * (perp_lengths[perp_ids] - 1 - perp_positions), perp_ids)
+    near = m - 3 - j >= 0
+    edge[near] = np.minimum(edge[near], perp_prefix[perp_base[near] + m[near] - 3 - j[near]])
+    return edge
+
+
+def dtw_runs_batch(runs_a, runs_b, cost_table):
+    """
+    Exact DTW distances of the pairs (runs_a[p], runs_b[p]) of run-length encoded symbol series.
+    Block (a, b) of a pair is the a-th run of its first series against the b-th run of its second one; the blocks
+    of all pairs on one anti-diagonal a + b = k of the block grid are solved together, from the last rows and
+    columns of the blocks on anti-diagonals k - 1 and k - 2.
+
+    Arguments:
+    runs_a, runs_b: lists of (symbols, lengths) as returned by encode_runs on get_symbols series
+    cost_table: np.array of the distance between each pair of symbols, with integer values
+
+    Returns:
+    np.array of the DTW distance of each pair (inf if either series is empty)
+    """
+    distances = np.full(len(runs_a), np.inf)
+    num_runs_a = np.array([len(symbols) for symbols, _ in runs_a], dtype=int)
+    num_runs_b = np.array([len(symbols) for symbols, _ in runs_b], dtype=int)
+    pairs = np.flatnonzero((num_runs_a > 0) & (num_runs_b > 0))
+    if len(pairs) == 0:
+        return distances
+    num_runs_a, num_runs_b = num_runs_a[pairs], num_runs_b[pairs]
+
+    symbols_a = np.zeros((len(pairs), num_runs_a.max()), dtype=int)
+    lengths_a = np.zeros((len(pairs), num_runs_a.max()), dtype=int)
+    symbols_b = np.zeros((len(pairs), num_runs_b.max()), dtype=int)
+    lengths_b = np.zeros((len(pairs), num_runs_b.max()), dtype=int)
+    for i, p in enumerate(pairs):
+        symbols_a[i, :num_runs_a[i]], lengths_a[i, :num_runs_a[i]] = runs_a[p]
+        symbols_b[i, :num_runs_b[i]], lengths_b[i, :num_runs_b[i]] = runs_b[p]
+
+    # per anti-diagonal: first run index a of each pair, position of each pair's first block, last rows and columns
+    previous = previous2 = None
+    for k in range((num_runs_a + num_runs_b).max() - 1):
+        first_a = np.maximum(0, k - num_runs_b + 1)
+        last_a = np.minimum(num_runs_a - 1, k)
+        num_blocks = np.maximum(0, last_a - first_a + 1)
+        first_block = np.cumsum(num_blocks) - num_blocks
+        pair = np.repeat(np.arange(len(pairs)), num_blocks)
+        a = first_a[pair] + np.arange(len(pair)) - first_block[pair]
+        b = k - a
+        rows, cols = lengths_a[pair, a], lengths_b[pair, b]
+        costs = cost_table[symbols_a[pair, a], symbols_b[pair, b]].astype(np.float64)
+
+        # corner: last cell of block (a - 1, b - 1); 0 before the first cell, inf along the outer boundary
+        corners = np.where((a == 0) & (b == 0), 0.0, np.inf)
+        top = np.full(cols.sum(), np.inf) # last row of block (a - 1, b)
+        left = np.full(rows.sum(), np.inf) # last column of block (a, b - 1)
+        if previous is not None:
+            p_first_a, p_last_a, p_first_block, p_bottoms, p_bottom_ends, p_rights, p_right_ends = previous
+            up = (a > 0) & (a - 1 >= p_first_a[pair]) & (a - 1 <= p_last_a[pair])
+            up_block = p_first_block[pair] + a - 1 - p_first_a[pair]
+            top_ids, top_positions, _ = get_segments(cols)
+            found = up[top_ids]
+            top[found] = p_bottoms[p_bottom_ends[up_block[top_ids[found]]] - cols[top_ids[found]] + top_positions[found]]
+            side = (b > 0) & (a >= p_first_a[pair]) & (a <= p_last_a[pair])
+            side_block = p_first_block[pair] + a - p_first_a[pair]
+            left_ids, left_positions, _ = get_segments(rows)
+            found = side[left_ids]
+            left[found] = p_rights[p_right_ends[side_block[left_ids[found]]] - rows[left_ids[found]] + left_positions[found]]
+        if previous2 is not None:
+            q_first_a, _, q_first_block, q_bottoms, q_bottom_ends, _, _ = previous2
+            diagonal = (a > 0) & (b > 0)
+            corners[diagonal] = q_bottoms[q_bottom_ends[q_first_block[pair[diagonal]] + a[diagonal] - 1 - q_first_a[pair[diagonal]]] - 1]
+
+        # last rows: parallel boundary [corner, top], perpendicular boundary left; last columns: the other way round
+        par = np.empty(cols.sum() + rows.sum() + 2 * len(pair))
+        par_lengths = np.r_[cols + 1, rows + 1]
+        _, par_positions, par_offsets = get_segments(par_lengths)
+        par[par_offsets] = np.r_[corners, corners]
+        par[par_positions > 0] = np.r_[top, left]
+        edges = get_block_edges(par, par_lengths, np.r_[left, top], np.r_[rows, cols], np.r_[costs, costs])
+
+        bottoms, rights = edges[:cols.sum()], edges[cols.sum():]
+        bottom_ends, right_ends = np.cumsum(cols), np.cumsum(rows)
+        finished = (a == num_runs_a[pair] - 1) & (b == num_runs_b[pair] - 1)
+        distances[pairs[pair[finished]]] = bottoms[bottom_ends[finished] - 1]
+        previous2, previous = previous, (first_a, last_a, first_block, bottoms, bottom_ends, rights, right_ends)
+    return distances
+
+
+def use_runs(num_runs_a, num_runs_b, length_a, length_b):
+    """True if a pair is cheaper to solve on its runs (about length_a * num_runs_b + length_b * num_runs_a block
+    edge cells) than on its full DTW matrix (length_a * length_b cells)."""
+    return run_cost_ratio * (length_a * num_runs_b + length_b * num_runs_a) < length_a * length_b
+
+
+def parse_dtw_mode(mode):
+    """
+    Arguments:
+    mode: 'exact', 'banded' (band of default_band), 'banded:FRACTION' or 'approximate'
+
+    Returns:
+    (name, band): name of the mode and band fraction (None unless banded)
+    """
+    name, _, band = mode.partition(':')
+    if name == 'banded':
+        band = float(band) if band else default_band
+        if not 0 < band <= 1:
+            raise ValueError(f"DTW band must be in (0, 1], got {band}")
+        return name, band
+    if name not in dtw_modes or band:
+        raise ValueError(f"Unknown DTW mode {mode}, one of exact, banded[:FRACTION], approximate")
+    return name, None
+
+
+def get_dtw_mode(argv=None, default='exact'):
+    """
+    Returns:
+    DTW mode given on the command line with --dtw (see parse_dtw_mode), default if not given; exits on an invalid mode
+    """
+    mode = get_options(argv).get('--dtw', default)
+    try:
+        parse_dtw_mode(mode)
+    except ValueError as err:
+        print(f"Error: {err}")
+        sys.exit(2)
+    return mode
+
+
+def get_mode_suffix(mode):
+    """Suffix of the cache keys of mode: empty for exact distances, so the existing cache entries stay valid."""
+    name, band = parse_dtw_mode(mode)
+    if name == 'exact':
+        return ''
+    return ':' + name + ('' if band is None else ':%g' % (band))
+
+
+def get_dtw_key(series_a, series_b, mode='exact'):
+    """Cache key of the distance of a pair in mode: the same for both orders, except for fastdtw (approximate)."""
+    hash_a, hash_b = hash_series(series_a), hash_series(series_b)
+    if parse_dtw_mode(mode)[0] == 'approximate':
+        return hash_a + hash_b + get_mode_suffix(mode)
+    return get_pair_key(hash_a, hash_b) + get_mode_suffix(mode)
+
+
+def lb_kim(a, b):
+    """
+    LB_Kim lower bound of the DTW distance of two series (as returned by as_series): every warping path matches the
+    first and the last samples of both series.
+    """
+    if len(a) == 0 or len(b) == 0:
+        return np.inf
+    bound = np.linalg.norm(a[0] - b[0])
+    if len(a) > 1 or len(b) > 1:
+        bound += np.linalg.norm(a[-1] - b[-1])
+    return bound
+
+
+def get_envelope(series, length, band=None):
+    """
+    Lower and upper envelope of a 1-D series over the samples that each sample of a series of the given length can
+    be matched to: all of them, or those of its Sakoe-Chiba band (see get_band_radii).
+
+    Returns:
+    lower, upper: np.arrays of the given length
+    """
+    n, m = length, len(series)
+    if band is None or n == 1 or m == 1:
+        return np.full(n, series.min()), np.full(n, series.max())
+    radius = get_band_radii(np.array([n]), np.array([m]), band)[0]
+    i = np.arange(n)
+    first = np.maximum(0, np.ceil((i * (m - 1) - radius) / (n - 1))).astype(int)
+    last = np.minimum(m - 1, np.floor((i * (m - 1) + radius) / (n - 1))).astype(int)
+    # reduceat over the interleaved window bounds; every other result is a window [first, last]
+    bounds = np.column_stack([first, last + 1]).ravel()
+    padded = np.append(series, series[-1])
+    return np.minimum.reduceat(padded, bounds)[0::2], np.maximum.reduceat(padded, bounds)[0::2]
+
+
+def lb_keogh(a, b, band=None):
+    """
+    LB_Keogh lower bound of the DTW distance of two 1-D series (as returned by as_series, with one feature): every
+    sample of one series is matched to at least one sample of the other within its window, so it costs at least
+    its distance to the envelope of the other series over that window. Returns 0 (a trivial bound) for series of
+    several features.
+    """
+    if len(a) == 0 or len(b) == 0:
+        return np.inf
+    if a.shape[1] != 1:
+        return 0.0
+    bounds = []
+    for x, y in ((a[:, 0], b[:, 0]), (b[:, 0], a[:, 0])):
+        lower, upper = get_envelope(y, len(x), band)
+        bounds.append(np.sum(np.maximum(x - upper, 0) + np.maximum(lower - x, 0)))
+    return max(bounds)
+
+
+def compute_dtw_distances(pairs, mode='exact', max_distance=None):
+    """
+    DTW distances of a list of (series_a, series_b) pairs, without using the cache.
+
+    Arguments:
+    pairs: list of tuples of two series (1-D sequences or 2-D time x features arrays)
+    mode: 'exact', 'banded[:FRACTION]' or 'approximate' (see parse_dtw_mode)
+    max_distance: if given, pairs whose distance is known to exceed it are abandoned early and get inf: those whose
+    LB_Kim or LB_Keogh bound exceeds it, and (exact and banded modes) those whose anti-diagonal sweep exceeds it
+
+    Returns:
+    np.array of the DTW distance of each pair
+    """
+    name, band = parse_dtw_mode(mode)
+    distances = np.full(len(pairs), np.inf)
+    if len(pairs) == 0:
+        return distances
+    pairs = [(as_series(a), as_series(b)) for a, b in pairs]
+
+    todo = np.arange(len(pairs))
+    if max_distance is not None:
+        bounds = np.array([max(lb_kim(a, b), lb_keogh(a, b, band)) for a, b in pairs])
+        todo = np.flatnonzero(bounds <= max_distance)
+
+    if name == 'approximate':
+        # fastdtw (Salvador & Chan, 2007): linear time, but only an upper bound of the DTW distance
+        for p in todo:
+            distances[p] = fastdtw(pairs[p][0], pairs[p][1], dist=euclidean)[0]
+        return distances
+
+    # series with a different number of features (eg, one-hot rows of 3, 4 or 5 TAs) get their own alphabet
+    num_features = np.array([pairs[p][0].shape[1] for p in todo])
+    for features in np.unique(num_features):
+        group = todo[num_features == features]
+        symbols, cost_table = get_symbols([series for p in group for series in pairs[p]])
+        symbols_a, symbols_b = symbols[0::2], symbols[1::2]
+
+        # pairs with few runs are solved on their run-length encodings, which gives the same sums if all costs are integers
+        # (without a band: dtw_runs_batch has no Sakoe-Chiba band, so banded pairs all take the sweep below)
+        runs = np.zeros(len(group), dtype=bool)
+        if band is None and np.array_equal(cost_table, np.round(cost_table)):
+            runs_a, runs_b = [encode_runs(s) for s in symbols_a], [encode_runs(s) for s in symbols_b]
+            runs = np.array([use_runs(len(ra[0]), len(rb[0]), len(a), len(b)) for ra, rb, a, b in zip(runs_a, runs_b, symbols_a, symbols_b)], dtype=bool)
+            order = np.flatnonzero(runs)[np.argsort([len(runs_a[p][0]) + len(runs_b[p][0]) for p in np.flatnonzero(runs)], kind='stable')]
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                distances[group[batch]] = dtw_runs_batch([runs_a[p] for p in batch], [runs_b[p] for p in batch], cost_table)
+
+        # the other pairs by anti-diagonal sweeps of their DTW matrices; pairs of similar length are solved together to keep the padding small
+        dense = np.flatnonzero(~runs)
+        order = dense[np.argsort([len(symbols_a[p]) + len(symbols_b[p]) for p in dense], kind='stable')]
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            max_distances = None if max_distance is None else np.full(len(batch), max_distance)
+            distances[group[batch]] = dtw_batch([symbols_a[p] for p in batch], [symbols_b[p] for p in batch], cost_table, band, max_distances)
+
+    if max_distance is not None:
+        distances[distances > max_distance] = np.inf
+    return distances
+
+
+def get_dtw_distances(pairs, save=True, mode='exact', max_distance=None):
+    """
+    DTW distances of a list of (series_a, series_b) pairs. Distances already in the cache are looked up,
+    the others are computed together in one batch and added to the cache.
+
+    Arguments:
+    pairs: list of tuples of two series (1-D sequences or 2-D time x features arrays)
+    save: if True, write new distances to the cache file before returning
+    mode: 'exact', 'banded[:FRACTION]' or 'approximate' (see parse_dtw_mode), each cached separately
+    max_distance: see compute_dtw_distances; abandoned pairs get inf and are not cached
+
+    Returns:
+    np.array of the DTW distance of each pair
+    """
+    global _cache_changed
+    cache = load_dtw_cache()
+    keys = [get_dtw_key(a, b, mode) for a, b in pairs]
+
+    missing = {}
+    for p, key in enumerate(keys):
+        if key not in cache and key not in missing:
+            missing[key] = p
+    computed = {}
+    if missing:
+        new_distances = compute_dtw_distances([pairs[p] for p in missing.values()], mode, max_distance)
+        for key, distance in zip(missing, new_distances):
+            computed[key] = float(distance)
+            if max_distance is None or distance <= max_distance:
+                cache[key] = _new_distances[key] = float(distance)
+                _cache_changed = True
+        if save:
+            save_dtw_cache()
+    return np.array([cache[key] if key in cache else computed[key] for key in keys])
+
+
+def get_dtw_distance(series_a, series_b, save=True, mode='exact'):
+    """DTW distance of one pair of series, see get_dtw_distances."""
+    return get_dtw_distances([(series_a, series_b)], save=save, mode=mode)[0]
+
+
+def get_pairwise_dtw(series_list, save=True, mode='exact'):
+    """
+    Matrix of the DTW distances between every two series of series_list, matrix[a, b] being the distance of
+    (series_list[a], series_list[b]). Each unordered pair is computed once and the matrix is symmetric, except in
+    approximate mode, where fastdtw is run on both orders; the diagonal is 0.
+    """
+    num_series = len(series_list)
+    symmetric = parse_dtw_mode(mode)[0] != 'approximate'
+    pairs = [(a, b) for a in range(num_series) for b in range(num_series) if (a < b if symmetric else a != b)]
+    distances = get_dtw_distances([(series_list[a], series_list[b]) for a, b in pairs], save=save, mode=mode)
+    matrix = np.zeros((num_series, num_series))
+    for (a, b), distance in zip(pairs, distances):
+        matrix[a, b] = distance
+        if symmetric:
+            matrix[b, a] = distance
+    return matrix
+
+
+def get_cross_dtw(series_list_a, series_list_b, save=True, mode='exact'):
+    """Matrix (len(series_list_a) x len(series_list_b)) of the DTW distances between the two sets of series."""
+    pairs = [(a, b) for a in series_list_a for b in series_list_b]
+    distances = get_dtw_distances(pairs, save=save, mode=mode)
+    return distances.reshape(len(series_list_a), len(series_list_b))
+
+def get_nearest_series(query, candidates, k=5, mode='exact', save=True, batch=16):
+    """
+    Top-k nearest neighbour search: the k candidates with the smallest DTW distance to query.
+
+    The candidates are visited by increasing LB_Kim/LB_Keogh lower bound, batch by batch. Once k distances are known,
+    the k-th smallest is the max_distance of the next batches: candidates whose bound exceeds it are never computed
+    (and the search stops at the first one, as the bounds are sorted), and the others are abandoned early by the
+    anti-diagonal sweep. The result is the same as sorting the distances to every candidate.
+
+    Arguments:
+    query: series (1-D sequence or 2-D time x features array)
+    candidates: list of series
+    k: number of neighbours
+    mode: 'exact', 'banded[:FRACTION]' or 'approximate' (see parse_dtw_mode; the bounds are also bounds of the
+    banded and approximate distances, which are upper bounds of the exact one)
+    save: if True, write the new exact distances to the cache file before returning
+    batch: number of candidates solved together
+
+    Returns:
+    indices: np.array of the positions in candidates of the (at most) k nearest ones, by increasing distance
+    (ties by position)
+    distances: np.array of their DTW distances
+    """
+    _, band = parse_dtw_mode(mode)
+    query_series = as_series(query)
+    bounds = np.array([max(lb_kim(query_series, c), lb_keogh(query_series, c, band)) for c in map(as_series, candidates)])
+    order = np.argsort(bounds, kind='stable')
+    distances = np.full(len(candidates), np.inf)
+    max_distance = np.inf
+    for start in range(0, len(order), batch):
+        group = order[start:start + batch]
+        group = group[bounds[group] <= max_distance]
+        if len(group) == 0:
+            break # every remaining bound exceeds the k-th distance
+        distances[group] = get_dtw_distances([(query, candidates[c]) for c in group], save=False, mode=mode,
+                                             max_distance=None if np.isinf(max_distance) else max_distance)
+        known = np.sort(distances[np.isfinite(distances)])
+        if len(known) >= k:
+            max_distance = known[k - 1]
+    if save:
+        save_dtw_cache()
+
+    nearest = np.lexsort((np.arange(len(candidates)), distances))[:k]
+    nearest = nearest[np.isfinite(distances[nearest])]
+    return nearest, distances[nearest]
+
+
+profiling.instrument_module(__name__) # times the functions above when profiling is on (see tools/profiling.py)
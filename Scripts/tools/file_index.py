@@ -0,0 +1,173 @@
+"""Persistent index of the per-trial files of every dataset.
+
+The data folders are walked once and every file with 'trialIdentifier' in its name is recorded under the key
+(dataset, agent type, session, player folder, trial). The index is saved to OtherResults/trial_file_index.json
+together with the modification time of every folder that was walked; a dataset is only walked again when one of
+its folder mtimes changes (ie, files were added, removed or renamed).
+
+Datasets and their folder layouts (relative to the project working directory):
+    human:              RAW_EXPERIMENT_DATA/TWO-HUMAN_HAs/<session>/...
+    human_aa:           RAW_EXPERIMENT_DATA/HUMAN-AA_TEAM/<agent type>/<player folder>/<session>/...
+    simulation:         OtherResults/AA-AA_SimulationData/<agent type>/<session>/...
+    human_policy:       OtherResults/TS_Dynamic_Policy/Human/<session>/...
+    simulation_policy:  OtherResults/TS_Dynamic_Policy/Simulation/<agent type>/<session>/...
+    human_aa_policy:    OtherResults/Actual_Dynamic_Policies_HumanAA/<agent type>/<player folder>/<session>/...
+"""
+
+import os # for directory handling
+import re # regular expressions
+import json # for the persisted index
+import threading # the index is built once per process, even if several threads ask for it
+from pathlib import Path # for file handling
+from . import profiling # opt-in timers, see instrument_module at the end
+
+wd = Path(__file__).resolve().parents[2] # project working directory
+index_path = os.path.join(wd, 'OtherResults', 'trial_file_index.json')
+
+# dataset name: (root folder, names of the leading path components below the root)
+datasets = {
+    'human': (os.path.join('RAW_EXPERIMENT_DATA', 'TWO-HUMAN_HAs'), ('session',)),
+    'human_aa': (os.path.join('RAW_EXPERIMENT_DATA', 'HUMAN-AA_TEAM'), ('agent_type', 'player_folder', 'session')),
+    'simulation': (os.path.join('OtherResults', 'AA-AA_SimulationData'), ('agent_type', 'session')),
+    'human_policy': (os.path.join('OtherResults', 'TS_Dynamic_Policy', 'Human'), ('session',)),
+    'simulation_policy': (os.path.join('OtherResults', 'TS_Dynamic_Policy', 'Simulation'), ('agent_type', 'session')),
+    'human_aa_policy': (os.path.join('OtherResults', 'Actual_Dynamic_Policies_HumanAA'), ('agent_type', 'player_folder', 'session')),
+}
+
+# raw files are named *trialIdentifierNN*, dynamic policy files trialIdentifier_N.csv
+trial_pattern = re.compile(r'trialIdentifier(?:_(\d+)|(\d{2}))')
+
+_index = None # in-memory copy of the index, loaded once per process
+_index_by_trial = None # same paths keyed by (dataset, agent_type, player_folder, trial), for lookups across sessions
+_lock = threading.Lock()
+
+
+def get_trial_number(file_name):
+    """Returns the trial number encoded in file_name, or None if it is not a trial file."""
+    match = trial_pattern.search(file_name)
+    if match is None:
+        return None
+    return int(match.group(1) or match.group(2))
+
+
+def scan_dataset(dataset):
+    """
+    Walks the root folder of dataset.
+
+    Returns:
+    dirs: dict of folder path (relative to wd) to its mtime, for every folder walked
+    files: list of [agent_type, session, player_folder, trial, file path relative to wd]
+    """
+    root, fields = datasets[dataset]
+    root_path = os.path.join(wd, root)
+    dirs = {}
+    files = []
+    if not os.path.isdir(root_path):
+        return dirs, files
+
+    for dirpath, dirnames, filenames in os.walk(root_path):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')] # skip hidden folders (like .git)
+        dirs[os.path.relpath(dirpath, wd)] = os.stat(dirpath).st_mtime
+        parts = Path(os.path.relpath(dirpath, root_path)).parts
+        if len(parts) < len(fields):
+            continue # files above the session level are not trial files
+        key_parts = dict(zip(fields, parts))
+        for filename in filenames:
+            trial = get_trial_number(filename)
+            if trial is None or filename.startswith('.'):
+                continue
+            files.append([key_parts.get('agent_type', ''), key_parts['session'], key_parts.get('player_folder', ''),
+                          trial, os.path.relpath(os.path.join(dirpath, filename), wd)])
+    files.sort(key=lambda f: f[-1])
+    return dirs, files
+
+
+def is_stale(dataset_entry, dataset):
+    """True if any folder recorded for the dataset has been modified, removed or newly created."""
+    if not dataset_entry['dirs']:
+        return os.path.isdir(os.path.join(wd, datasets[dataset][0]))
+    for rel_dir, mtime in dataset_entry['dirs'].items():
+        try:
+            if os.stat(os.path.join(wd, rel_dir)).st_mtime != mtime:
+                return True
+        except FileNotFoundError:
+            return True
+    return False
+
+
+def build_file_index(refresh=True):
+    """
+    Loads the persisted index and rescans the datasets whose folders changed.
+
+    Arguments:
+    refresh: if False, use the persisted index as is (only missing datasets are scanned)
+
+    Returns:
+    dict of dataset name to {'dirs': {...}, 'files': [...]}, as described in scan_dataset
+    """
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    changed = False
+    for dataset in datasets:
+        if dataset not in index or (refresh and is_stale(index[dataset], dataset)):
+            dirs, files = scan_dataset(dataset)
+            index[dataset] = {'dirs': dirs, 'files': files}
+            changed = True
+
+    if changed and os.path.isdir(os.path.dirname(index_path)):
+        tmp_path = index_path + '.%d.tmp' % (os.getpid()) # unique per process, as worker processes may rebuild it too
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    return index
+
+
+def get_file_index(refresh=False):
+    """
+    Returns the file index as a dict keyed by (dataset, agent_type, session, player_folder, trial),
+    with values the sorted list of matching Paths. The folder mtimes are checked on the first call in a process
+    and again whenever refresh is True.
+    """
+    global _index, _index_by_trial
+    with _lock:
+        if _index is None or refresh:
+            index = build_file_index()
+            by_key = {}
+            by_trial = {}
+            for dataset, entry in index.items():
+                for agent_type, session, player_folder, trial, rel_path in entry['files']:
+                    path = Path(os.path.join(wd, rel_path))
+                    by_key.setdefault((dataset, agent_type, session, player_folder, trial), []).append(path)
+                    by_trial.setdefault((dataset, agent_type, player_folder, trial), []).append(path)
+            _index, _index_by_trial = by_key, by_trial
+    return _index
+
+
+def find_trial_files(dataset, trial, session=None, agent_type='', player_folder=''):
+    """
+    Replacement for Path(...).rglob('*trialIdentifier'+trial_ID+'*').
+
+    Arguments:
+    dataset: one of the keys of datasets
+    trial: trial number (int)
+    session: session folder name, or None to match the trial in every session
+    agent_type, player_folder: only used by the datasets whose layout has these levels
+
+    Returns:
+    list of Paths of the matching files (empty if there are none)
+    """
+    index = get_file_index()
+    if session is not None:
+        return list(index.get((dataset, agent_type, session, player_folder, trial), []))
+    return list(_index_by_trial.get((dataset, agent_type, player_folder, trial), []))
+
+profiling.instrument_module(__name__) # times the functions above when profiling is on (see tools/profiling.py)
+
+
+if __name__ == "__main__":
+    index = build_file_index()
+    for dataset, entry in index.items():
+        print(f"{dataset}: {len(entry['files'])} trial files in {len(entry['dirs'])} folders")
@@ -0,0 +1,115 @@
+"""Process-pool runner for the per-session/per-trial analysis loops.
+
+Each script splits its loops into independent work units (eg, one (player, trial) pair), each unit being a tuple
+of arguments of a top-level function of the script. run_parallel hands the units to a pool of worker processes
+and returns their results in the order of the units, so the scripts assemble their outputs exactly as in a serial
+run; iter_parallel yields them as the units finish instead. A single progress bar counts the finished units of all workers.
+
+The number of workers is given on the command line of every script:
+    python calcAllDTW.py --workers 8
+It defaults to 1 (everything runs in the calling process, as before); --workers 0 uses all cores.
+The DTW scripts also take --dtw exact|banded[:FRACTION]|approximate, see tools/dtw_utils.py.
+With --profile, the run is timed stage by stage and a report is written at exit, see tools/profiling.py.
+"""
+
+import os # for the number of cores
+import sys # for the command line arguments
+import getopt # for command line arguments
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from . import profiling # per-stage timers, on with --profile
+
+
+# command line options shared by the analysis scripts: --workers (see get_workers), --dtw (see tools/dtw_utils.py)
+# and --profile (see tools/profiling.py, which reads it from sys.argv when it is imported)
+usage_options = "[--workers N] [--dtw exact|banded[:FRACTION]|approximate] [--profile]"
+
+
+def get_options(argv=None):
+    """
+    Arguments:
+    argv: list of command line arguments (defaults to sys.argv[1:])
+
+    Returns:
+    dict of the long name of each option given (eg, '--workers') to its value
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        opts, _ = getopt.getopt(argv, "w:", ["workers=", "dtw=", "profile"])
+    except getopt.GetoptError as err:
+        print(f"Error: {err}")
+        print("Usage: python " + os.path.basename(sys.argv[0]) + " " + usage_options)
+        sys.exit(2)
+    return {('--workers' if opt == '-w' else opt): arg for opt, arg in opts}
+
+
+def get_workers(argv=None):
+    """
+    Arguments:
+    argv: list of command line arguments (defaults to sys.argv[1:])
+
+    Returns:
+    number of worker processes given with --workers N (or -w N), 1 if not given, all cores if N is 0
+    """
+    workers = int(get_options(argv).get('--workers', 1))
+    if workers <= 0:
+        workers = os.cpu_count()
+    return workers
+
+
+def iter_parallel(func, work_units, workers=1, desc=None):
+    """
+    Runs func on every work unit like run_parallel, but yields each result as soon as its unit is done,
+    so the caller can write the outputs that are complete while the other units still run.
+
+    Arguments:
+    func: top-level (picklable) function
+    work_units: list of tuples, the arguments of each call of func
+    workers: number of worker processes
+    desc: label of the progress bar
+
+    Yields:
+    (index of the work unit, result of func), in the order the units finish (the order of work_units if workers is 1)
+    """
+    work_units = list(work_units)
+    with tqdm(total=len(work_units), desc=desc) as progress, profiling.stage('run_parallel:' + (desc or func.__name__)):
+        if workers <= 1 or len(work_units) <= 1:
+            for i, unit in enumerate(work_units):
+                with profiling.stage(func.__name__):
+                    result = func(*unit)
+                progress.update()
+                yield i, result
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(work_units))) as executor:
+                if profiling.enabled: # each worker times its unit and sends its stages back with the result
+                    futures = {executor.submit(profiling.run_unit, profiling.get_path(), func, unit): i for i, unit in enumerate(work_units)}
+                else:
+                    futures = {executor.submit(func, *unit): i for i, unit in enumerate(work_units)}
+                for future in as_completed(futures):
+                    result = future.result()
+                    if profiling.enabled:
+                        result, stats = result
+                        profiling.merge_stats(stats)
+                    progress.update()
+                    yield futures[future], result
+
+
+def run_parallel(func, work_units, workers=1, desc=None):
+    """
+    Runs func on every work unit, on a pool of worker processes if workers > 1.
+
+    Arguments:
+    func: top-level (picklable) function
+    work_units: list of tuples, the arguments of each call of func
+    workers: number of worker processes
+    desc: label of the progress bar
+
+    Returns:
+    list of the results of func, in the order of work_units
+    """
+    work_units = list(work_units)
+    results = [None] * len(work_units)
+    for i, result in iter_parallel(func, work_units, workers, desc):
+        results[i] = result
+    return results
@@ -0,0 +1,377 @@
+"""Declarative pipeline of the Python analysis stages, with incremental rebuilds.
+
+Each stage below names the script that produces it, the files it reads and the files it writes:
+    raw data -> policies_exp1, policies_exp2 (TS_Dynamic_Policy, Actual_Dynamic_Policies_HumanAA)
+             -> dtw_ts_errors (DTW_TS_Errors), tsp_dtws (TSp_DTWs)
+    raw data -> aa_scores_traces (AA_scores_traces), binary_trace_overlaps (binaryTraceOverlaps) -> convert_scores_exp2
+
+The content hash (sha1) of every input and output is kept in OtherResults/pipeline_manifest.json.
+1) The policy stages are rebuilt per trial file: only the trials whose raw file changed (or whose output is missing
+   or was modified) are recomputed, with the work unit functions of their script. Outputs of trials that no longer
+   exist are deleted.
+2) The other stages aggregate over all sessions and are rerun as a whole, with their script, whenever the set or
+   contents of their input files change. Their old outputs are deleted before the script runs.
+In both cases a change to the stage's script or to the tools package (except this file) also forces a rebuild,
+and so does an output that was modified or deleted by hand. The per-trial stages run first, one at a time, as each
+starts its own pool of worker processes; then the other stages run concurrently as soon as their dependencies are done.
+
+Usage (from the Scripts folder):
+    python -m tools.pipeline [--workers N] [--dry-run] [stage ...]
+"""
+
+import os # for directory handling
+import sys # for the python executable and command line arguments
+import json # for the persisted manifest
+import getopt # for command line arguments
+import hashlib # for content hashes
+import importlib # for the work unit functions of the per-trial stages
+import threading # to guard the manifest across concurrent stages
+import subprocess # to run the aggregate stages
+from pathlib import Path # for file handling
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+wd = Path(__file__).resolve().parents[2] # project working directory
+scripts_dir = Path(__file__).resolve().parents[1]
+manifest_path = os.path.join(wd, 'OtherResults', 'pipeline_manifest.json')
+log_dir = os.path.join(wd, 'OtherResults', 'pipeline_logs')
+
+simulation_types = ["CollinearAngle", "CollinearDistance", "Angle", "Distance", "ContainmentZone"]
+
+# stage name: definition. Paths are relative to the project working directory, scripts relative to Scripts.
+# Per-trial stages give the module and work unit function of their script: module.get_work_units() returns
+# tuples whose first item is the input file and last item the output file of the unit. They run before the other
+# stages (see run_pipeline), so they may only depend on other per-trial stages.
+stages = {
+    'policies_exp1': {
+        'script': 'exp1_human_human/get_actual_TS_Dynamic_Policy_as_csv.py',
+        'module': 'exp1_human_human.get_actual_TS_Dynamic_Policy_as_csv',
+        'unit_function': 'write_dynamic_policy',
+        'depends': [],
+    },
+    'policies_exp2': {
+        'script': 'exp2_human_aa/get_actual_Dynamic_Policy_as_csv_Human-AA.py',
+        'module': 'exp2_human_aa.get_actual_Dynamic_Policy_as_csv_Human-AA',
+        'unit_function': 'write_dynamic_policy',
+        'depends': [],
+    },
+    'dtw_ts_errors': {
+        'script': 'exp1_human_human/compare_dynamic_policies_by_TA_and_Participant_TS_DTW.py',
+        'inputs': ['OtherResults/TS_Dynamic_Policy/**/*.csv'],
+        'outputs': ['OtherResults/DTW_TS_Errors/Successive%s_DTW_Errors.csv' % (sim) for sim in simulation_types],
+        'depends': ['policies_exp1'],
+    },
+    'aa_scores_traces': {
+        'script': 'exp1_human_human/binary_trace_evaluator_Exp1.py',
+        'inputs': ['RAW_EXPERIMENT_DATA/TWO-HUMAN_HAs/**/*trialIdentifier*', 'OtherResults/AA-AA_SimulationData/**/*trialIdentifier*'],
+        'outputs': ['OtherResults/AA_scores_traces/AA_scores_traces_Successive%s.csv' % (sim) for sim in simulation_types],
+        'depends': [],
+    },
+    'tsp_dtws': {
+        'script': 'exp2_human_aa/calcAllDTW.py',
+        'inputs': ['OtherResults/TS_Dynamic_Policy/Human/**/*.csv', 'OtherResults/Actual_Dynamic_Policies_HumanAA/**/*.csv',
+                   'RAW_EXPERIMENT_DATA/HUMAN-AA_TEAM/**/*trialIdentifier*'],
+        'outputs': ['OtherResults/TSp_DTWs/humanTeamDTWs.csv', 'OtherResults/TSp_DTWs/AA_scores_heur.csv', 'OtherResults/TSp_DTWs/human_scores_heur.csv'],
+        'depends': ['policies_exp1', 'policies_exp2'],
+    },
+    'binary_trace_overlaps': {
+        'script': 'exp2_human_aa/traj_evals_binary_trace_scores.py',
+        'inputs': ['RAW_EXPERIMENT_DATA/TWO-HUMAN_HAs/**/*trialIdentifier*', 'RAW_EXPERIMENT_DATA/HUMAN-AA_TEAM/**/*trialIdentifier*'],
+        'outputs': ['OtherResults/binaryTraceOverlaps/humanTeamTraces.csv', 'OtherResults/binaryTraceOverlaps/AA_scores_heur.csv', 'OtherResults/binaryTraceOverlaps/human_scores_heur.csv'],
+        'depends': [],
+    },
+    'convert_scores_exp2': {
+        'script': 'exp2_human_aa/convert_scores_exp2.py',
+        'inputs': ['OtherResults/binaryTraceOverlaps/humanTeamTraces.csv', 'OtherResults/binaryTraceOverlaps/AA_scores_heur.csv', 'OtherResults/binaryTraceOverlaps/human_scores_heur.csv'],
+        'outputs': ['OtherResults/binaryTraceOverlaps/human_AHA_binarytracescores_heur.csv'],
+        'depends': ['binary_trace_overlaps'],
+    },
+}
+
+_lock = threading.Lock()
+
+
+def load_manifest():
+    """Returns the manifest: {'files': {path: [size, mtime_ns, sha1]}, 'stages': {...}, 'units': {...}}"""
+    manifest = {'files': {}, 'stages': {}, 'units': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest.update(json.load(f))
+    return manifest
+
+
+def save_manifest(manifest):
+    if not os.path.isdir(os.path.dirname(manifest_path)):
+        return
+    with _lock:
+        tmp_path = manifest_path + '.%d.tmp' % (os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+
+
+def get_file_hash(manifest, path):
+    """
+    Returns the sha1 of the contents of path (None if it does not exist). Hashes are remembered in the manifest
+    with the file's size and mtime, so unchanged files are not read again.
+    """
+    rel_path = os.path.relpath(os.path.abspath(path), wd)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    with _lock:
+        known = manifest['files'].get(rel_path)
+    if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+        return known[2]
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    with _lock:
+        manifest['files'][rel_path] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+    return h.hexdigest()
+
+
+def get_code_hash(manifest, stage):
+    """Hash of the stage's script and of the tools package (except this pipeline module)."""
+    h = hashlib.sha1()
+    code_files = [scripts_dir / stages[stage]['script']] + sorted(p for p in (scripts_dir / 'tools').glob('*.py') if p.name != 'pipeline.py')
+    for path in code_files:
+        h.update(path.name.encode())
+        h.update(get_file_hash(manifest, path).encode())
+    return h.hexdigest()
+
+
+def get_input_files(stage):
+    """Sorted list of the files matching the input patterns of a stage (hidden files excluded)."""
+    files = set()
+    for pattern in stages[stage]['inputs']:
+        for path in wd.glob(pattern):
+            if path.is_file() and not any(part.startswith('.') for part in path.relative_to(wd).parts):
+                files.add(path)
+    return sorted(files)
+
+
+def outputs_unchanged(manifest, recorded_outputs):
+    """True if every recorded output still exists with the recorded contents."""
+    return all(get_file_hash(manifest, os.path.join(wd, rel_path)) == file_hash for rel_path, file_hash in recorded_outputs.items())
+
+
+def run_script_stage(stage, manifest, workers, dry_run):
+    """
+    Reruns an aggregate stage if its inputs, code or outputs changed.
+
+    Returns:
+    'up to date', 'rebuilt' (or would be, on a dry run) or 'failed'
+    """
+    definition = stages[stage]
+    h = hashlib.sha1(get_code_hash(manifest, stage).encode())
+    for path in get_input_files(stage):
+        h.update(os.path.relpath(path, wd).encode())
+        h.update(get_file_hash(manifest, path).encode())
+    fingerprint = h.hexdigest()
+
+    with _lock:
+        record = manifest['stages'].get(stage)
+    if record is not None and record['fingerprint'] == fingerprint and set(record['outputs']) == set(definition['outputs']) \
+            and outputs_unchanged(manifest, record['outputs']):
+        return 'up to date'
+    if dry_run:
+        return 'rebuilt'
+
+    # the scripts skip outputs that already exist, and a failed run must not leave old outputs looking current
+    with _lock:
+        manifest['stages'].pop(stage, None)
+    save_manifest(manifest)
+    for rel_path in definition['outputs']:
+        if os.path.exists(os.path.join(wd, rel_path)):
+            os.remove(os.path.join(wd, rel_path))
+
+    os.makedirs(log_dir, exist_ok=True)
+    script_path = scripts_dir / definition['script']
+    with open(os.path.join(log_dir, stage + '.log'), 'w') as log:
+        result = subprocess.run([sys.executable, script_path.name, '--workers', str(workers)], cwd=script_path.parent, stdout=log, stderr=subprocess.STDOUT)
+    outputs = {rel_path: get_file_hash(manifest, os.path.join(wd, rel_path)) for rel_path in definition['outputs']}
+    if result.returncode != 0 or None in outputs.values():
+        print(f"Error: stage {stage} failed, see {os.path.join(log_dir, stage + '.log')}")
+        return 'failed'
+
+    with _lock:
+        manifest['stages'][stage] = {'fingerprint': fingerprint, 'outputs': outputs}
+    save_manifest(manifest)
+    return 'rebuilt'
+
+
+def run_unit_stage(stage, manifest, workers, dry_run):
+    """
+    Recomputes the trials of a per-trial stage whose input, code or output changed,
+    and deletes the outputs of trials that no longer exist.
+
+    Returns:
+    'up to date', 'rebuilt' (or would be, on a dry run) or 'failed'
+    """
+    from tools.parallel import run_parallel # imported here as it is only needed by the per-trial stages
+
+    definition = stages[stage]
+    module = importlib.import_module(definition['module'])
+    code_hash = get_code_hash(manifest, stage)
+
+    with _lock:
+        records = dict(manifest['units'].get(stage, {}))
+    fingerprints = {}
+    to_run = []
+    for unit in module.get_work_units():
+        input_path, output_path = unit[0], unit[-1]
+        rel_output = os.path.relpath(os.path.abspath(output_path), wd)
+        fingerprint = hashlib.sha1((code_hash + get_file_hash(manifest, input_path) + repr(unit[1:-1])).encode()).hexdigest()
+        fingerprints[rel_output] = fingerprint
+        record = records.get(rel_output)
+        if record is None or record['fingerprint'] != fingerprint or get_file_hash(manifest, output_path) != record['hash']:
+            to_run.append(unit)
+    removed = [rel_output for rel_output in records if rel_output not in fingerprints]
+
+    if len(to_run) == 0 and len(removed) == 0:
+        return 'up to date'
+    print(f"{stage}: {len(to_run)} of {len(fingerprints)} trials to rebuild, {len(removed)} to remove")
+    if dry_run:
+        return 'rebuilt'
+
+    for rel_output in removed:
+        output_path = os.path.join(wd, rel_output)
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        # the scripts list the session folders, so the folder of a session that is gone must go too
+        if os.path.isdir(os.path.dirname(output_path)) and len(os.listdir(os.path.dirname(output_path))) == 0:
+            os.rmdir(os.path.dirname(output_path))
+        records.pop(rel_output)
+    for unit in to_run:
+        records.pop(os.path.relpath(os.path.abspath(unit[-1]), wd), None)
+    with _lock:
+        manifest['units'][stage] = dict(records)
+    save_manifest(manifest)
+
+    try:
+        run_parallel(getattr(module, definition['unit_function']), to_run, workers=workers, desc=stage)
+    except Exception as e:
+        print(f"Error: stage {stage} failed: {e}")
+        return 'failed'
+
+    for unit in to_run:
+        rel_output = os.path.relpath(os.path.abspath(unit[-1]), wd)
+        records[rel_output] = {'fingerprint': fingerprints[rel_output], 'hash': get_file_hash(manifest, unit[-1])}
+    with _lock:
+        manifest['units'][stage] = records
+    save_manifest(manifest)
+    return 'rebuilt'
+
+
+def get_dependency_status(stage, status, dry_run):
+    """
+    Returns:
+    'skipped' if a dependency of stage failed or was skipped, 'rebuilt' on a dry run if a dependency would be rebuilt
+    (its inputs are about to change), None if stage is to be run
+    """
+    dependencies = [status.get(dependency) for dependency in stages[stage]['depends']]
+    if 'failed' in dependencies or 'skipped' in dependencies:
+        return 'skipped'
+    if dry_run and 'rebuilt' in dependencies:
+        return 'rebuilt'
+    return None
+
+
+def print_status(stage, status, dry_run):
+    """Prints the status of stage once it is decided."""
+    print(f"{stage}: {'would be rebuilt' if dry_run and status[stage] == 'rebuilt' else status[stage]}")
+
+
+def run_pipeline(workers=1, dry_run=False, selected_stages=None):
+    """
+    Brings every stage up to date: the per-trial stages one after the other, then each of the other stages as soon as
+    all its dependencies are done.
+
+    Arguments:
+    workers: number of worker processes given to each stage
+    dry_run: if True, only report what would be rebuilt
+    selected_stages: names of the stages to run (defaults to all of them); their dependencies are run too
+
+    Returns:
+    dict of stage name to 'up to date', 'rebuilt' or 'failed' (or 'skipped' if a dependency failed)
+    """
+    if selected_stages is None:
+        selected_stages = list(stages)
+    pending = []
+    def add_stage(stage):
+        for dependency in stages[stage]['depends']:
+            add_stage(dependency)
+        if stage not in pending:
+            pending.append(stage)
+    for stage in selected_stages:
+        add_stage(stage)
+
+    manifest = load_manifest()
+    status = {}
+    # the per-trial stages run in this thread before any other is started: their process pools fork this process,
+    # which is unsafe once it has threads, and two of them at once would start twice the workers
+    for stage in [stage for stage in pending if 'module' in stages[stage]]:
+        pending.remove(stage)
+        status[stage] = get_dependency_status(stage, status, dry_run)
+        if status[stage] is None:
+            try:
+                status[stage] = run_unit_stage(stage, manifest, workers, dry_run)
+            except Exception as e:
+                print(f"Error: stage {stage} failed: {e}")
+                status[stage] = 'failed'
+        print_status(stage, status, dry_run)
+
+    # the other stages run their script in a subprocess, from a thread each
+    with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+        running = {}
+        while pending or running:
+            for stage in list(pending):
+                if None in [status.get(dependency) for dependency in stages[stage]['depends']]:
+                    continue # a dependency is still pending or running
+                pending.remove(stage)
+                status[stage] = get_dependency_status(stage, status, dry_run)
+                if status[stage] is None:
+                    running[executor.submit(run_script_stage, stage, manifest, workers, dry_run)] = stage
+                else:
+                    print_status(stage, status, dry_run)
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    status[stage] = future.result()
+                except Exception as e:
+                    print(f"Error: stage {stage} failed: {e}")
+                    status[stage] = 'failed'
+                print_status(stage, status, dry_run)
+    save_manifest(manifest)
+    return status
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "w:n", ["workers=", "dry-run"])
+    except getopt.GetoptError as err:
+        print(f"Error: {err}")
+        print("Usage: python -m tools.pipeline [--workers N] [--dry-run] [stage ...]")
+        sys.exit(2)
+
+    workers = 1
+    dry_run = False
+    for opt, arg in opts:
+        if opt in ("-w", "--workers"):
+            workers = int(arg) if int(arg) > 0 else os.cpu_count()
+        elif opt in ("-n", "--dry-run"):
+            dry_run = True
+    for stage in args:
+        if stage not in stages:
+            print(f"Error: unknown stage {stage}, one of {', '.join(stages)}")
+            sys.exit(2)
+
+    status = run_pipeline(workers=workers, dry_run=dry_run, selected_stages=args or None)
+    if 'failed' in status.values():
+        sys.exit(1)
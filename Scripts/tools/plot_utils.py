@@ -1,6 +1,8 @@
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
-from scipy.spatial.transform import Rotation as R
+from .utils import quat_to_angle
+from . import profiling # opt-in timers, see instrument_module at the end
 #from .utils import * # for project-specific custom functions
 
 field_dimensions = [120, 90] # the field (walls) are of dimensions 120 by 90 m
@@ -25,24 +27,38 @@ def plot_walls():
     return
 
 def plot_trialtrajectories(data, numHerders, numTargets, title):
-    for h in range(numHerders):
-        hcolx = 'p%dx' % (h)
-        hcolz = 'p%dz' % (h)
-        hcolxq = 'p%dxq' % (h)
-        hcolyq = 'p%dyq' % (h)
-        hcolzq = 'p%dzq' % (h)
-        hcolwq = 'p%dwq' % (h)
-        heading_init = R.from_quat([data[hcolxq][0], data[hcolyq][0], data[hcolzq][0], data[hcolwq][0]]).as_rotvec()[1]
-        plt.arrow(data[hcolx][0], data[hcolz][0], np.cos(heading_init), np.sin(heading_init), shape = 'full', lw = 0,length_includes_head=True, head_width=2.5)
-        plt.text(data[hcolx][0], data[hcolz][0], 'H%d' % (h))
-        plt.plot(data[hcolx], data[hcolz], c=[0,0,.7], linestyle='dashed')
-    
-    for t in range(numTargets):
-        tcolx = 't%dx' % (t)
-        tcolz = 't%dz' % (t)
-        plt.plot(data[tcolx][0], data[tcolz][0], c='r',  marker = 'o')
-        plt.plot(data[tcolx], data[tcolz], c=[.7,0,0], linestyle='dashed')
-        plt.text(data[tcolx][0], data[tcolz][0], 'T%d' % (t))
+    # data is the pd.DataFrame of a trial, or an iterable of its consecutive chunks (see iter_trial_chunks in tools/trial_store.py)
+    # so long trials can be drawn without loading them whole
+    chunks = [data] if isinstance(data, pd.DataFrame) else data
+    previous = None # last row of the previous chunk, so the dashed lines continue across chunks
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        first = previous is None
+        rows = chunk if first else pd.concat([previous, chunk])
+        for h in range(numHerders):
+            hcolx = 'p%dx' % (h)
+            hcolz = 'p%dz' % (h)
+            hcolxq = 'p%dxq' % (h)
+            hcolyq = 'p%dyq' % (h)
+            hcolzq = 'p%dzq' % (h)
+            hcolwq = 'p%dwq' % (h)
+            if first:
+                start = chunk.iloc[0]
+                heading_init = quat_to_angle(start[hcolxq], start[hcolyq], start[hcolzq], start[hcolwq])
+                plt.arrow(start[hcolx], start[hcolz], np.cos(heading_init), np.sin(heading_init), shape = 'full', lw = 0,length_includes_head=True, head_width=2.5)
+                plt.text(start[hcolx], start[hcolz], 'H%d' % (h))
+            plt.plot(rows[hcolx], rows[hcolz], c=[0,0,.7], linestyle='dashed')
+
+        for t in range(numTargets):
+            tcolx = 't%dx' % (t)
+            tcolz = 't%dz' % (t)
+            if first:
+                start = chunk.iloc[0]
+                plt.plot(start[tcolx], start[tcolz], c='r',  marker = 'o')
+                plt.text(start[tcolx], start[tcolz], 'T%d' % (t))
+            plt.plot(rows[tcolx], rows[tcolz], c=[.7,0,0], linestyle='dashed')
+        previous = chunk.iloc[-1:]
 
     plot_circle(0,0)
     plot_walls()
@@ -60,7 +76,7 @@ def plot_initialconditions(data, numHerders, numTargets, title):
         hcolyq = 'p%dyq' % (h)
         hcolzq = 'p%dzq' % (h)
         hcolwq = 'p%dwq' % (h)
-        heading_init = R.from_quat([data[hcolxq][0], data[hcolyq][0], data[hcolzq][0], data[hcolwq][0]]).as_rotvec()[1]
+        heading_init = quat_to_angle(data[hcolxq][0], data[hcolyq][0], data[hcolzq][0], data[hcolwq][0])
         plt.arrow(data[hcolx][0], data[hcolz][0], np.cos(heading_init), np.sin(heading_init), shape = 'full', lw = 0,length_includes_head=True, head_width=2.5)
         plt.text(data[hcolx][0], data[hcolz][0], 'H%d' % (h))
     
@@ -88,7 +104,7 @@ def plotter(T, ordering, colors):
 
     returns none
     """
-    heading_init = R.from_quat([T.p0xq[0], T.p0yq[0], T.p0zq[0], T.p0wq[0]]).as_rotvec()[1]
+    heading_init = quat_to_angle(T.p0xq[0], T.p0yq[0], T.p0zq[0], T.p0wq[0])
     plt.arrow(T.p0x[0], T.p0z[0], np.cos(heading_init), np.sin(heading_init), shape = 'full', lw = 0,length_includes_head=True, head_width=2.5)
     plt.plot(T.p0x, T.p0z, c=[.7,.7,.7])
     
@@ -119,4 +135,6 @@ def plotter(T, ordering, colors):
     
     plot_circle(0,0)
     plot_walls()
-    return
\ No newline at end of file
+    return
+
+profiling.instrument_module(__name__) # times the functions above when profiling is on (see tools/profiling.py)
@@ -0,0 +1,229 @@
+"""Packed, memory-mapped store of the dynamic policy (TS engagement) series.
+
+The policy scripts write one small CSV per session and trial to OtherResults/TS_Dynamic_Policy and
+OtherResults/Actual_Dynamic_Policies_HumanAA. pack_policies() packs all CSVs of one dataset of tools/file_index.py
+(human_policy, simulation_policy or human_aa_policy) into a single file OtherResults/PolicyStore/<dataset>.bin:
+    8 bytes         magic number
+    8 bytes         length of the offset table (little-endian uint64)
+    offset table    JSON list with one entry per trial: its file index key, source CSV (with size and mtime),
+                    TrialID, numTargs, number of samples, engagement column names and the byte offset of its data
+    data            per trial: time (float64), then each engagement column (int8), then the run-length encoding
+                    of each engagement column (run lengths as int32, run values as int8), padded to 8 bytes
+load_policies() maps the file once per process and returns views into it, so getting a series neither opens nor
+parses a CSV and slicing it does not copy it. The run-length encodings (see encode_runs in tools/utils.py) hold
+one entry per switch of engaged TA instead of one per sample. The store is repacked whenever a CSV was added,
+removed or modified after it was packed, so the CSVs stay the reference outputs.
+"""
+
+import os # for directory handling
+import json # for the offset table
+import struct # for the header
+from pathlib import Path # for file handling
+import numpy as np
+import pandas as pd
+from .file_index import get_file_index
+from .utils import encode_runs
+from .dtw_utils import get_nearest_series
+from . import profiling # opt-in timers, see instrument_module at the end
+
+wd = Path(__file__).resolve().parents[2] # project working directory
+store_dir = os.path.join(wd, 'OtherResults', 'PolicyStore')
+
+magic = b'TSPOLv02'
+policy_datasets = ('human_policy', 'simulation_policy', 'human_aa_policy')
+
+_stores = {} # dataset: dict of key to entry, loaded once per process
+
+
+def get_store_path(dataset):
+    return os.path.join(store_dir, dataset + '.bin')
+
+
+def get_policy_sources(dataset, refresh=False):
+    """
+    Returns:
+    list of [key, path relative to wd, size, mtime_ns] of every policy CSV of dataset, in file index order,
+    with key the [agent_type, session, player_folder, trial] of the trial
+    """
+    sources = []
+    for (index_dataset, agent_type, session, player_folder, trial), paths in get_file_index(refresh=refresh).items():
+        if index_dataset != dataset:
+            continue
+        for path in paths:
+            stat = os.stat(path)
+            sources.append([[agent_type, session, player_folder, trial], os.path.relpath(path, wd), stat.st_size, stat.st_mtime_ns])
+    sources.sort(key=lambda source: source[1])
+    return sources
+
+
+def pack_policies(dataset):
+    """
+    Packs every policy CSV of dataset into its store file.
+
+    Returns:
+    number of trials packed
+    """
+    sources = get_policy_sources(dataset, refresh=True) # the policy scripts may have just written new files
+    table = []
+    blocks = []
+    offset = 0
+    for key, rel_path, size, mtime_ns in sources:
+        policy = pd.read_csv(os.path.join(wd, rel_path))
+        columns = [col for col in policy.columns if col.endswith('_engagement')]
+        engagement = policy[columns].to_numpy()
+        if engagement.size > 0 and (engagement.min() < np.iinfo(np.int8).min or engagement.max() > np.iinfo(np.int8).max):
+            raise ValueError(f"Engagement values of {rel_path} do not fit in int8")
+
+        engagement = engagement.T.astype(np.int8)
+        block = policy['time'].to_numpy(dtype=np.float64).tobytes() + engagement.tobytes()
+        num_runs = []
+        for series in engagement:
+            values, lengths = encode_runs(series)
+            block += b'\0' * (-len(block) % 4) + lengths.astype(np.int32).tobytes() + values.tobytes()
+            num_runs.append(len(values))
+        block += b'\0' * (-len(block) % 8)
+        table.append({'key': key, 'source': rel_path, 'size': size, 'mtime_ns': mtime_ns,
+                      'TrialID': float(policy['TrialID'].iloc[0]) if len(policy) > 0 else None,
+                      'numTargs': float(policy['numTargs'].iloc[0]) if len(policy) > 0 else None,
+                      'length': len(policy), 'columns': columns, 'runs': num_runs, 'offset': offset})
+        blocks.append(block)
+        offset += len(block)
+
+    table_bytes = json.dumps(table).encode()
+    table_bytes += b' ' * (-len(table_bytes) % 8) # keeps the data 8-byte aligned
+
+    os.makedirs(store_dir, exist_ok=True)
+    tmp_path = get_store_path(dataset) + '.%d.tmp' % (os.getpid()) # several scripts may repack at the same time
+    with open(tmp_path, 'wb') as f:
+        f.write(magic + struct.pack('<Q', len(table_bytes)) + table_bytes)
+        for block in blocks:
+            f.write(block)
+    os.replace(tmp_path, get_store_path(dataset))
+    _stores.pop(dataset, None)
+    return len(table)
+
+
+def read_store(dataset):
+    """
+    Maps the store file of dataset.
+
+    Returns:
+    table: the offset table (list of dicts, see pack_policies)
+    data: np.memmap of the bytes after the table
+    """
+    store_path = get_store_path(dataset)
+    with open(store_path, 'rb') as f:
+        header = f.read(16)
+        if header[:8] != magic:
+            raise ValueError(f"{store_path} is not a policy store")
+        table_length = struct.unpack('<Q', header[8:])[0]
+        table = json.loads(f.read(table_length))
+    if os.path.getsize(store_path) == 16 + table_length:
+        return table, np.zeros(0, dtype=np.uint8) # no data (np.memmap cannot map an empty range)
+    return table, np.memmap(store_path, dtype=np.uint8, mode='r', offset=16 + table_length)
+
+
+def is_stale(table, sources):
+    """True if the CSVs listed in table are not exactly sources (see get_policy_sources)."""
+    if len(table) != len(sources):
+        return True
+    for entry, (key, rel_path, size, mtime_ns) in zip(table, sources):
+        if entry['key'] != key or entry['source'] != rel_path or entry['size'] != size or entry['mtime_ns'] != mtime_ns:
+            return True
+    return False
+
+
+def load_policies(dataset):
+    """
+    Returns the policies of dataset, repacking its store first if it is missing or stale.
+
+    Returns:
+    dict of (agent_type, session, player_folder, trial) to a dict with
+    'source': path of the CSV, 'TrialID', 'numTargs', 'length': number of samples,
+    'time': float64 array, one int8 array per engagement column (eg, 'HA0_engagement'),
+    and its run-length encoding (eg, 'HA0_engagement_runs': (int8 run values, int32 run lengths)),
+    all arrays being read-only views into the mapped store
+    """
+    if dataset in _stores:
+        return _stores[dataset]
+    if dataset not in policy_datasets:
+        raise ValueError(f"Unknown policy dataset {dataset}, one of {', '.join(policy_datasets)}")
+
+    sources = get_policy_sources(dataset)
+    try:
+        stale = is_stale(read_store(dataset)[0], sources)
+    except (FileNotFoundError, ValueError): # not packed yet, or packed in an older format
+        stale = True
+    if stale:
+        pack_policies(dataset)
+    table, data = read_store(dataset)
+
+    policies = {}
+    for entry in table:
+        length, offset = entry['length'], entry['offset']
+        policy = {'source': Path(os.path.join(wd, entry['source'])), 'TrialID': entry['TrialID'],
+                  'numTargs': entry['numTargs'], 'length': length}
+        policy['time'] = data[offset:offset + 8 * length].view(np.float64)
+        offset += 8 * length
+        for col in entry['columns']:
+            policy[col] = data[offset:offset + length].view(np.int8)
+            offset += length
+        for col, num_runs in zip(entry['columns'], entry['runs']):
+            offset += -offset % 4
+            lengths = data[offset:offset + 4 * num_runs].view(np.int32)
+            offset += 4 * num_runs
+            policy[col + '_runs'] = (data[offset:offset + num_runs].view(np.int8), lengths)
+            offset += num_runs
+        policies[tuple(entry['key'])] = policy
+    _stores[dataset] = policies
+    return policies
+
+
+def get_policy(dataset, trial, session, agent_type='', player_folder=''):
+    """
+    Replacement for pd.read_csv of the policy CSV of one trial.
+
+    Returns:
+    the dict of the trial as described in load_policies, or None if the trial has no policy
+    """
+    return load_policies(dataset).get((agent_type, session, player_folder, trial))
+
+
+def find_policies(dataset, trial, agent_type='', player_folder=''):
+    """
+    Policies of one trial across all sessions, in the order of find_trial_files(dataset, trial, ...).
+
+    Returns:
+    list of (session, policy dict as described in load_policies)
+    """
+    return [(key[1], policy) for key, policy in load_policies(dataset).items() if key[0] == agent_type and key[2] == player_folder and key[3] == trial]
+
+def find_nearest_sessions(query, trial, k=5, dataset='human_policy', player=0, agent_type='', player_folder='', exclude=(), mode='exact', save=True):
+    """
+    Sessions of one trial whose engagement series is the most similar to query (eg, which human teams an AA team
+    most resembles), by early-abandoning DTW with lower-bound pruning (see get_nearest_series in tools/dtw_utils.py).
+
+    Arguments:
+    query: engagement series (eg, the HA0_engagement of an AA team's policy)
+    trial: trial number
+    k: number of sessions
+    dataset, agent_type, player_folder: corpus searched, as in find_policies
+    player: HA whose HA<player>_engagement series are compared
+    exclude: sessions left out (eg, the session of the query)
+    mode: DTW mode, see parse_dtw_mode in tools/dtw_utils.py
+
+    Returns:
+    list of (session, DTW distance) of the (at most) k nearest sessions, by increasing distance
+    """
+    column = 'HA%d_engagement' % (player)
+    candidates = [(session, policy[column]) for session, policy in find_policies(dataset, trial, agent_type, player_folder)
+                  if session not in exclude and column in policy]
+    indices, distances = get_nearest_series(query, [series for _, series in candidates], k, mode, save)
+    return [(candidates[i][0], float(distance)) for i, distance in zip(indices, distances)]
+
+profiling.instrument_module(__name__) # times the functions above when profiling is on (see tools/profiling.py)
+
+
+if __name__ == "__main__":
+    for dataset in policy_datasets:
+        print(f"{dataset}: packed {pack_policies(dataset)} trials into {get_store_path(dataset)}")
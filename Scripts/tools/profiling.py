@@ -0,0 +1,258 @@
+"""Opt-in profiling of the analysis scripts: per-stage timers, call counts and file I/O counters.
+
+Profiling is off unless a script is started with --profile (parsed by tools/parallel.py with the other options)
+or with the environment variable HERDING_PROFILE set (to anything but 0), which also reaches the scripts run by
+tools/pipeline.py. When it is off, nothing is wrapped and the functions below cost nothing.
+
+When it is on:
+    - every public function of the tools modules is timed as a stage (eg, 'traj_utils.get_histogram'); each tools
+      module calls instrument_module at its end, so the wrapped functions are the ones the scripts import
+    - the library calls of the hot paths are timed too: pandas.read_csv, DataFrame .loc/.iloc writes,
+      np.histogram2d, np.load and Path.rglob
+    - every file opened is counted, with its size if opened for reading, under the innermost running stage
+    - run_parallel times its loop as the stage 'run_parallel:<desc>' and each work unit as a child stage; the stages
+      of worker processes are sent back with the results and merged (their times add up over the workers, so they
+      can exceed the wall time of the loop)
+
+Stages are keyed by their call path (script;stage;...;stage). At exit, the script writes to OtherResults/Profiles:
+    <script>_<date>_<time>.json     per stage: calls, total and self seconds, files opened and their size in bytes
+                                    (files opened for reading; the bytes actually read are not counted), and the
+                                    same summed per stage name
+    <script>_<date>_<time>.folded   the self time of every call path in microseconds, one 'path count' line per
+                                    path (the collapsed stack format of flamegraph.pl, speedscope and inferno)
+Generator functions (eg, tools.trial_store.iter_trial_chunks) are timed while they produce each item, so their
+calls are the number of items produced.
+"""
+
+import os # for directory handling
+import io # for io.open
+import sys # for the command line arguments
+import json # for the report
+import time # for the timers
+import atexit # to write the report at exit
+import inspect # to find the functions of the tools modules
+import builtins # for open
+import functools # for the wrappers
+import threading # each thread keeps its own stack of stages
+import multiprocessing # worker processes do not write reports
+from datetime import datetime
+from pathlib import Path # for file handling
+import numpy as np
+import pandas as pd
+
+wd = Path(__file__).resolve().parents[2] # project working directory
+profiles_dir = os.path.join(wd, 'OtherResults', 'Profiles')
+env_var = 'HERDING_PROFILE'
+
+enabled = os.environ.get(env_var, '0') not in ('', '0') or '--profile' in sys.argv[1:]
+
+_root = (Path(sys.argv[0]).name.replace(' ', '_') or 'python',) if sys.argv else ('python',)
+_stats = {} # call path: [calls, total seconds, seconds in child stages, files opened, bytes of the files opened]
+_local = threading.local()
+_main_stack = [[_root, time.perf_counter(), 0.0]] # the root stage runs from import to exit
+_started = datetime.now()
+_open = builtins.open
+
+
+def _get_stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = _main_stack if threading.current_thread() is threading.main_thread() else [[_root, time.perf_counter(), 0.0]]
+    return stack
+
+
+def _get_entry(path):
+    entry = _stats.get(path)
+    if entry is None:
+        entry = _stats[path] = [0, 0.0, 0.0, 0, 0]
+    return entry
+
+
+def _enter(name):
+    stack = _get_stack()
+    stack.append([stack[-1][0] + (name,), time.perf_counter(), 0.0])
+
+
+def _exit():
+    stack = _get_stack()
+    path, start, children = stack.pop()
+    elapsed = time.perf_counter() - start
+    entry = _get_entry(path)
+    entry[0] += 1
+    entry[1] += elapsed
+    entry[2] += children
+    stack[-1][2] += elapsed
+
+
+class stage:
+    """
+    Context manager timing its block as a stage named name, nested in the running stage:
+        with stage('load backgrounds'):
+            ...
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if enabled:
+            _enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        if enabled:
+            _exit()
+        return False
+
+
+def profiled(func, name=None):
+    """
+    Returns func timed as the stage name (default: its qualified name), or func itself if profiling is off.
+    Generator functions are timed while they produce each item.
+    """
+    if not enabled:
+        return func
+    name = name or func.__qualname__
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            generator = func(*args, **kwargs)
+            while True:
+                _enter(name)
+                try:
+                    item = next(generator)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    _exit()
+                yield item
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            _enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _exit()
+    wrapper.__wrapped_by_profiling__ = True
+    return wrapper
+
+
+def instrument_module(module_name):
+    """Replaces every public function defined in the module module_name by its profiled version (if profiling is on)."""
+    if not enabled:
+        return
+    module = sys.modules[module_name]
+    prefix = module_name.rsplit('.', 1)[-1]
+    for name, obj in list(vars(module).items()):
+        if name.startswith('_') or not inspect.isfunction(obj) or obj.__module__ != module_name or hasattr(obj, '__wrapped_by_profiling__'):
+            continue
+        setattr(module, name, profiled(obj, prefix + '.' + name))
+
+
+def _counting_open(file, mode='r', *args, **kwargs):
+    f = _open(file, mode, *args, **kwargs)
+    entry = _get_entry(_get_stack()[-1][0])
+    entry[3] += 1
+    if ('r' in mode or '+' in mode) and not isinstance(file, int):
+        try:
+            entry[4] += os.fstat(f.fileno()).st_size
+        except (OSError, ValueError):
+            pass
+    return f
+
+
+def instrument_libraries():
+    """Times the library calls of the hot paths and counts the files opened."""
+    for owner, name, label in [(pd, 'read_csv', 'pandas.read_csv'), (np, 'histogram2d', 'np.histogram2d'),
+                               (np, 'load', 'np.load'), (Path, 'rglob', 'Path.rglob')]:
+        setattr(owner, name, profiled(getattr(owner, name), label))
+    try:
+        from pandas.core.indexing import _LocationIndexer # shared by .loc and .iloc
+        _LocationIndexer.__setitem__ = profiled(_LocationIndexer.__setitem__, 'DataFrame.loc[]=')
+    except (ImportError, AttributeError): # private to pandas
+        pass
+    builtins.open = io.open = _counting_open
+
+
+def get_path():
+    """Returns the call path of the running stage (to pass to worker processes)."""
+    return _get_stack()[-1][0]
+
+
+def get_stats():
+    """Returns the recorded stages, as a dict of call path to [calls, total s, child s, files opened, bytes of the files opened]."""
+    return {path: list(entry) for path, entry in _stats.items()}
+
+
+def merge_stats(stats):
+    """Adds the stages recorded by a worker process (see run_unit) to the stages of this process."""
+    for path, values in stats.items():
+        entry = _get_entry(tuple(path))
+        for i, value in enumerate(values):
+            entry[i] += value
+
+
+def run_unit(path, func, args):
+    """
+    Runs func(*args) in a worker process as the stage func.__name__ below path.
+
+    Returns:
+    the result of func and the stages it recorded (see get_stats)
+    """
+    _stats.clear()
+    _local.stack = [[tuple(path), time.perf_counter(), 0.0]]
+    with stage(func.__name__):
+        result = func(*args)
+    return result, get_stats()
+
+
+def get_report():
+    """
+    Returns:
+    dict with the script, its arguments, start time and wall time, and
+    'stages': per call path (joined with ';') its calls, total_s, self_s, files_opened and file_bytes_opened, by decreasing total_s,
+    'functions': the same summed per stage name, by decreasing self_s
+    """
+    stats = get_stats()
+    root = stats.setdefault(_root, [0, 0.0, 0.0, 0, 0])
+    root[0] += 1
+    root[1] += time.perf_counter() - _main_stack[0][1]
+    root[2] += _main_stack[0][2]
+
+    stages = []
+    functions = {}
+    for path, (calls, total, children, files, nbytes) in stats.items():
+        row = {'calls': calls, 'total_s': total, 'self_s': max(total - children, 0.0), 'files_opened': files, 'file_bytes_opened': nbytes}
+        stages.append(dict(stage=';'.join(path), depth=len(path) - 1, **row))
+        function = functions.setdefault(path[-1], {'name': path[-1], 'calls': 0, 'total_s': 0.0, 'self_s': 0.0, 'files_opened': 0, 'file_bytes_opened': 0})
+        for key, value in row.items():
+            if key != 'total_s' or path[-1] not in path[:-1]: # recursive calls are already in the total of the outer call
+                function[key] += value
+    stages.sort(key=lambda row: -row['total_s'])
+    return {'script': _root[0], 'argv': sys.argv[1:], 'started': _started.isoformat(timespec='seconds'), 'wall_s': root[1],
+            'stages': stages, 'functions': sorted(functions.values(), key=lambda row: -row['self_s'])}
+
+
+def get_folded(report):
+    """Returns the collapsed stack lines ('a;b;c microseconds') of the self time of every stage of report."""
+    return ''.join('%s %d\n' % (row['stage'], round(row['self_s'] * 1e6)) for row in report['stages'] if round(row['self_s'] * 1e6) > 0)
+
+
+def write_report():
+    """Writes the JSON report and the collapsed stacks of this process to profiles_dir."""
+    if multiprocessing.parent_process() is not None: # worker processes send their stages back to run_parallel
+        return
+    report = get_report()
+    os.makedirs(profiles_dir, exist_ok=True)
+    base = os.path.join(profiles_dir, '%s_%s' % (Path(_root[0]).stem, _started.strftime('%Y%m%d_%H%M%S')))
+    with _open(base + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    with _open(base + '.folded', 'w') as f:
+        f.write(get_folded(report))
+    print(f"Profile written to {base}.json and {base}.folded", file=sys.stderr)
+
+
+if enabled:
+    instrument_libraries()
+    atexit.register(write_report)
@@ -0,0 +1,77 @@
+"""Typed container of the per-session, per-player, per-trial scores written by the analysis scripts.
+
+The scripts score every (session, player, trial) once and write one CSV with the columns
+    Session, Player, <trial>, <trial>, ...
+and two rows per session (one per player). make_results preallocates the scores as one float64 array (NaN for
+missing entries) instead of an object DataFrame filled cell by cell with .loc; to_frame builds the CSV layout only
+when the results are written. A row gets its Session and Player labels once any of its scores has been set (even
+to NaN), as when the cells were written one by one, and rows that were never set stay empty.
+"""
+
+import numpy as np
+import pandas as pd
+from . import profiling # opt-in timers, see instrument_module at the end
+
+
+def make_results(sessions, players, trials):
+    """
+    Arguments:
+    sessions: session labels, in row order (eg, the session folder names)
+    players: player labels, in row order within a session (eg, [1, 2])
+    trials: trial numbers, in column order
+
+    Returns:
+    dict with 'sessions', 'players' and 'trials' (lists), 'values': float64 array of shape
+    (len(sessions), len(players), len(trials)) filled with NaN, 'assigned': bool array of the same shape,
+    and 'index': dict of 'sessions', 'players' and 'trials' to a dict of label to position
+    """
+    sessions, players, trials = list(sessions), list(players), list(trials)
+    shape = (len(sessions), len(players), len(trials))
+    return {'sessions': sessions, 'players': players, 'trials': trials,
+            'values': np.full(shape, np.nan), 'assigned': np.zeros(shape, dtype=bool),
+            'index': {axis: {label: i for i, label in enumerate(labels)} for axis, labels in
+                      (('sessions', sessions), ('players', players), ('trials', trials))}}
+
+
+def set_result(results, session, player, trial, value):
+    """Sets the score of session, player and trial (labels as given to make_results) to value."""
+    index = results['index']
+    position = (index['sessions'][session], index['players'][player], index['trials'][trial])
+    results['values'][position] = value
+    results['assigned'][position] = True
+
+
+def to_frame(results, num_rows=None):
+    """
+    Arguments:
+    results: as returned by make_results
+    num_rows: number of rows of the frame, padded with empty rows (default: two per session and player)
+
+    Returns:
+    pd.DataFrame with the columns Session, Player and one per trial (named str(trial)), one row per session and player
+    """
+    num_sessions, num_players, num_trials = results['values'].shape
+    values = results['values'].reshape(-1, num_trials)
+    labelled = results['assigned'].reshape(-1, num_trials).any(axis=1)
+    if num_rows is None:
+        num_rows = len(values)
+
+    sessions = np.full(num_rows, np.nan, dtype=object)
+    players = np.full(num_rows, np.nan, dtype=object)
+    rows = np.flatnonzero(labelled)
+    sessions[rows] = [results['sessions'][row // num_players] for row in rows]
+    players[rows] = [results['players'][row % num_players] for row in rows]
+    frame = {'Session': sessions, 'Player': players}
+    scores = np.full((num_rows, num_trials), np.nan)
+    scores[:len(values)] = values
+    for t, trial in enumerate(results['trials']):
+        frame[str(trial)] = scores[:, t]
+    return pd.DataFrame(frame)
+
+
+def write_results(results, file_path, num_rows=None):
+    """Writes results to file_path as CSV, in the layout of to_frame."""
+    to_frame(results, num_rows).to_csv(file_path, index=False)
+
+
+profiling.instrument_module(__name__) # times the functions above when profiling is on (see tools/profiling.py)
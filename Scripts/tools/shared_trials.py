@@ -0,0 +1,227 @@
+"""Shared-memory cache of the trial trajectories, for the worker processes of run_parallel.
+
+Without it, every worker process reads (and holds) its own copy of the trials it needs, and the per-trial loops of
+the binary trace scripts read the same human trials again for every unit. share_trials() reads the trajectory
+columns of each trial once in the calling process (positions p{n}/hA{n}/t{n} x/y/z, run flags t{n}run and time,
+see get_trajectory_columns) and copies them into one multiprocessing.shared_memory block per trial. The manifest
+of the blocks (per trial: block name, number of rows, all column names of the file, and dtype and offset of each
+shared column) is kept in a block of its own, whose name is put in the environment variable HERDING_SHARED_TRIALS,
+so the worker processes started afterwards find it, whether they are forked or spawned.
+
+get_shared_trial() attaches to the block of a trial (once per process) and returns read-only views of its columns,
+without copying them or opening any file. iter_trial_chunks and get_trial_columns (tools/trial_store.py), and so
+get_streamed_trajectory (tools/traj_utils.py) and the binary trace scripts, serve the shared trials from the cache;
+the views can also be passed as trialData to the engagement functions of tools/utils.py (get_trial_distances,
+get_dynamic_policy_array, ...). The columns keep the dtypes they are read with (see tools/trial_store.py), so the
+scripts compute the same results from shared trials as from the trials read from their files.
+
+The blocks are freed by release_shared_trials(), which is called at exit of the process that created them:
+    if workers > 1:
+        share_trials(find_dataset_files(['human'], range(first_trial, last_trial)))
+    results = run_parallel(...)
+"""
+
+import os # for the environment variable and the paths
+import json # for the manifest
+import atexit # the blocks are freed at exit
+import shutil # for the free space of /dev/shm
+import struct # for the length of the manifest
+from multiprocessing import shared_memory
+import numpy as np
+from . import profiling # opt-in timers, see instrument_module at the end
+
+env_var = 'HERDING_SHARED_TRIALS' # name of the manifest block, inherited by the worker processes
+shm_dir = '/dev/shm' # where the blocks live on Linux (a tmpfs, often small in containers)
+alignment = 64 # byte alignment of each column in its block
+
+_manifest = None # absolute trial path: entry (see share_trials), loaded once per process
+_blocks = {} # block name: SharedMemory, created or attached by this process
+_created = [] # names of the blocks created by this process (the manifest last), freed by release_shared_trials
+_owner = None # id of the process that created the blocks
+
+
+def get_trajectory_columns(columns):
+    """
+    Arguments:
+    columns: column names of a raw trial CSV
+
+    Returns:
+    the positions (p{n}x/y/z, hA{n}x/y/z, t{n}x/y/z), run flags (t{n}run) and time among columns, in file order
+    """
+    from .trial_store import position_pattern, run_pattern # imported here, as tools.trial_store imports this module
+    return [col for col in columns if position_pattern.match(col) or run_pattern.match(col) or col == 'time']
+
+
+def find_dataset_files(datasets, trials=None, agent_types=None):
+    """
+    Arguments:
+    datasets: names of datasets of tools/file_index.py (eg, ['human', 'simulation'])
+    trials: trial numbers (defaults to all)
+    agent_types: agent types of the datasets that have them (defaults to all)
+
+    Returns:
+    sorted list of the paths of every trial file of datasets
+    """
+    from .file_index import get_file_index
+    paths = []
+    for (dataset, agent_type, _, _, trial), trial_paths in get_file_index().items():
+        if dataset in datasets and (trials is None or trial in trials) and (agent_types is None or agent_type == '' or agent_type in agent_types):
+            paths += trial_paths
+    return sorted(paths)
+
+
+def _get_key(csv_path):
+    return os.path.abspath(os.fspath(csv_path))
+
+
+def _load_manifest():
+    global _manifest
+    if _manifest is None:
+        _manifest = {}
+        name = os.environ.get(env_var)
+        if name:
+            try:
+                block = shared_memory.SharedMemory(name)
+            except FileNotFoundError: # the process that shared the trials is gone
+                return _manifest
+            length, = struct.unpack_from('<Q', block.buf)
+            _manifest = json.loads(bytes(block.buf[8:8 + length]))
+            block.close()
+    return _manifest
+
+
+def _has_room(size):
+    """True if size bytes fit in /dev/shm (writing past a full tmpfs kills the process with SIGBUS)."""
+    if not os.path.isdir(shm_dir):
+        return True
+    return size + (64 << 20) <= shutil.disk_usage(shm_dir).free # keep a margin for the other users of /dev/shm
+
+
+def _write_manifest(manifest):
+    data = json.dumps(manifest).encode()
+    block = shared_memory.SharedMemory(create=True, size=8 + len(data))
+    struct.pack_into('<Q', block.buf, 0, len(data))
+    block.buf[8:8 + len(data)] = data
+    _blocks[block.name] = block
+    _created.append(block.name)
+    os.environ[env_var] = block.name
+
+
+def share_trials(csv_paths, select_columns=get_trajectory_columns):
+    """
+    Copies the trajectory columns of every trial of csv_paths into shared memory, for the processes started afterwards.
+    Trials that are already shared are skipped; if /dev/shm runs out of room, the remaining trials are left to be
+    read from their files.
+
+    Arguments:
+    csv_paths: paths of raw trial CSVs (each read through tools/trial_store.py, from its archive if it is up to date)
+    select_columns: function of the column names of a trial to the ones to share (defaults to get_trajectory_columns)
+
+    Returns:
+    number of trials shared by this call
+    """
+    global _manifest, _owner
+    from .trial_store import iter_trial_chunks, get_trial_columns # imported here, as tools.trial_store imports this module
+    if _owner is None:
+        _owner = os.getpid()
+        atexit.register(release_shared_trials)
+    manifest = dict(_load_manifest())
+    num_shared = 0
+    for csv_path in csv_paths:
+        key = _get_key(csv_path)
+        if key in manifest:
+            continue
+        all_columns = get_trial_columns(csv_path)
+        chunks = list(iter_trial_chunks(csv_path, select_columns(all_columns)))
+        num_rows = sum(len(chunk) for chunk in chunks)
+        # numeric columns only: anything else has no fixed-size layout
+        columns = [(col, chunks[0][col].dtype) for col in chunks[0].columns if chunks[0][col].dtype.kind in 'biuf']
+
+        layout = []
+        size = 0
+        for col, dtype in columns:
+            size += -size % alignment
+            layout.append([col, dtype.str, size])
+            size += num_rows * dtype.itemsize
+        if not _has_room(size):
+            print(f"Warning: not enough room in {shm_dir} to share {csv_path}, the remaining trials are read from their files")
+            break
+
+        block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        _blocks[block.name] = block
+        _created.append(block.name)
+        for col, dtype, offset in layout:
+            target = np.ndarray(num_rows, dtype=dtype, buffer=block.buf, offset=offset)
+            start = 0
+            for chunk in chunks:
+                target[start:start + len(chunk)] = chunk[col].to_numpy()
+                start += len(chunk)
+            del target # no export of the buffer may outlive release_shared_trials
+        manifest[key] = {'block': block.name, 'rows': num_rows, 'columns': all_columns, 'layout': layout}
+        num_shared += 1
+
+    if num_shared > 0:
+        old_name = os.environ.get(env_var)
+        _write_manifest(manifest)
+        if old_name in _created: # the processes started from now on read the new manifest
+            _created.remove(old_name)
+            old_block = _blocks.pop(old_name)
+            old_block.close()
+            old_block.unlink()
+    _manifest = manifest
+    return num_shared
+
+
+def get_shared_columns(csv_path):
+    """Returns all the column names of a shared trial in file order (shared or not), or None if the trial is not shared."""
+    entry = _load_manifest().get(_get_key(csv_path))
+    return None if entry is None else entry['columns']
+
+
+def get_shared_trial(csv_path, columns=None):
+    """
+    Arguments:
+    csv_path: path of the raw trial CSV
+    columns: column names wanted (defaults to all the shared ones)
+
+    Returns:
+    dict of column name to read-only np.array view of the column in shared memory, in file order,
+    or None if the trial is not shared or one of columns is not
+    """
+    entry = _load_manifest().get(_get_key(csv_path))
+    if entry is None:
+        return None
+    layout = {col: (dtype, offset) for col, dtype, offset in entry['layout']}
+    if columns is not None and not set(columns) <= layout.keys():
+        return None
+    block = _blocks.get(entry['block'])
+    if block is None:
+        block = _blocks[entry['block']] = shared_memory.SharedMemory(entry['block'])
+
+    trial = {}
+    for col, (dtype, offset) in layout.items():
+        if columns is None or col in columns:
+            view = np.ndarray(entry['rows'], dtype=dtype, buffer=block.buf, offset=offset)
+            view.flags.writeable = False
+            trial[col] = view
+    return trial
+
+
+def release_shared_trials():
+    """Frees the blocks created by share_trials in this process (called at exit)."""
+    global _manifest
+    if _owner != os.getpid(): # forked workers inherit the list of blocks, but only their creator frees them
+        return
+    for name in _created:
+        block = _blocks.pop(name)
+        try:
+            block.close()
+        except BufferError: # views of the block are still referenced: its memory goes with them
+            pass
+        block.unlink()
+    _created.clear()
+    os.environ.pop(env_var, None)
+    _manifest = None
+
+
+profiling.instrument_module(__name__) # times the functions above when profiling is on (see tools/profiling.py)
@@ -4,8 +4,11 @@
 3) Potentially plotting the heatmaps
 """
 
+import math # for the greatest common divisor of the bin sizes
 import numpy as np
-from .utils import trace
+from .utils import get_grid_indices
+from .shared_trials import get_shared_trial
+from . import profiling # opt-in timers, see instrument_module at the end
 
 #binning size for 2-D histograms
 bin_size = 5
@@ -17,6 +20,126 @@ ylim = 45
 #threshold for binary heatmap
 threshold =10
 
+#bin sizes that tile the field exactly, for sweeps with get_pyramid_traces
+sweep_bin_sizes = (1, 2, 3, 5, 6, 10, 15, 30)
+
+
+
+"""Function to get the number of heatmap cells along z and x for a bin size
+Inputs:
+size: bin size (defaults to bin_size)
+Output:
+(ny, nx): ints
+"""
+def get_grid_shape(size=None):
+    if size is None:
+        size = bin_size
+    return int(90/size), int(120/size)
+
+
+"""Function to count the positions of a set of trajectories on the bin_size grid
+Inputs:
+X: np.array of x-coordinates
+Z: np.array of z-coordinates
+size: bin size (defaults to bin_size)
+Output:
+h: np.array of counts, oriented like the heatmaps (rows from +ylim down to -ylim)
+"""
+def get_histogram(X, Z, size=None):
+    ny, nx = get_grid_shape(size)
+    h, _, _ = np.histogram2d(x = np.asarray(X).flatten(), y = np.asarray(Z).flatten(),  bins = (nx, ny), range = ((-xlim, xlim), (-ylim,ylim)))
+    return h.T[::-1]
+
+
+"""Function to turn counts from get_histogram into a binary heatmap
+Inputs:
+h: np.array of counts, or a stack of them (the last two axes are the grid)
+Output:
+binary_heatmap: np.array of bools, True where the square-root weighted heatmap exceeds threshold
+"""
+def get_binary_heatmap(h):
+    weighted_heatmap = np.sqrt(h)
+    return weighted_heatmap > threshold
+
+
+"""Function to build all leave-one-out background heatmaps of a trial at once
+Inputs:
+session_histograms: np.array of shape (numSessions, ny, nx), get_histogram of each session's trajectory
+(all zeros for a session without data for the trial)
+Output:
+binary_heatmaps: np.array of shape (numSessions, ny, nx), the binary heatmap of all sessions but the given one
+"""
+def get_leave_one_out_heatmaps(session_histograms):
+    total = session_histograms.sum(axis=0)
+    return get_binary_heatmap(total[np.newaxis] - session_histograms)
+
+
+"""Function to find the heatmap cell of each point of a trajectory, binned exactly like get_histogram
+Inputs:
+X: np.array of x-coordinates
+Z: np.array of z-coordinates
+size: bin size (defaults to bin_size)
+Output:
+bin_indices: np.array of ints, flat index into a heatmap (row-major, rows from +ylim down to -ylim),
+-1 for points outside the field or NaN
+"""
+def get_bin_indices(X, Z, size=None):
+    return get_grid_indices(X, Z, bin_size if size is None else size, xlim, ylim)
+
+
+"""Function to calculate the binary traces of a batch of trajectories along one already built binary heatmap
+Each trajectory scores the fraction of the heatmap cells it visits that are set in the heatmap
+Inputs:
+binary_heatmap: np.array as returned by get_binary_heatmap
+individialDatas: list of pd.DataFrames, one per trajectory set
+agents: string, or list of strings (one per dataframe), "hA0" or "p0" etc. Used for file dataframe headers
+Output:
+binary_traces: np.array of floats, one per dataframe (NaN for a trajectory that never enters the field)
+"""
+def get_heatmap_traces(binary_heatmap, individialDatas, agents):
+    if isinstance(agents, str):
+        agents = [agents] * len(individialDatas)
+
+    binary_traces = np.zeros(len(individialDatas))
+    scored = np.zeros(len(individialDatas), dtype=bool)
+    trajectory_ids = []
+    bin_indices = []
+    for i, (individialData, agent) in enumerate(zip(individialDatas, agents)):
+        # Validate individual data exists
+        if agent+'x' not in individialData.columns or agent+'z' not in individialData.columns:
+            print(f"Warning: Agent columns {agent}x/{agent}z not found in data. Returning 0.")
+            continue
+        indices = get_bin_indices(individialData[agent+'x'].to_numpy(), individialData[agent+'z'].to_numpy())
+        indices = indices[indices >= 0]
+        scored[i] = True
+        trajectory_ids.append(np.full(len(indices), i))
+        bin_indices.append(indices)
+    if not np.any(scored):
+        return binary_traces
+
+    # each (trajectory, cell) pair is counted once, however often the trajectory visits the cell
+    num_cells = binary_heatmap.size
+    visited = np.unique(np.concatenate(trajectory_ids) * num_cells + np.concatenate(bin_indices))
+    visited_ids = visited // num_cells
+    visited_cells = visited % num_cells
+
+    num_visited = np.bincount(visited_ids, minlength=len(individialDatas))
+    num_hits = np.bincount(visited_ids, weights=np.ravel(binary_heatmap)[visited_cells], minlength=len(individialDatas))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        binary_traces[scored] = num_hits[scored] / num_visited[scored]
+    return binary_traces
+
+
+"""Function to calculate the binary trace of one trajectory along an already built binary heatmap
+Inputs:
+binary_heatmap: np.array as returned by get_binary_heatmap
+individialData: pd.DataFrame of data for one given trajectory set
+agent: string, "hA0" or "p0" for human or simulated data. Used for file dataframe headers
+Output:
+binary_trace: float
+"""
+def get_heatmap_trace(binary_heatmap, individialData, agent):
+    return get_heatmap_traces(binary_heatmap, [individialData], agent)[0]
 
 
 """Function to calculate the binary trace for a given trial for one given trajectory
@@ -34,13 +157,191 @@ def get_binary_trace(X, Z, individialData, agent):
         print(f"Warning: Empty trajectory data for agent {agent}. Returning 0.")
         return 0.0
 
-    # Validate individual data exists
-    if agent+'x' not in individialData.columns or agent+'z' not in individialData.columns:
+    binary_heatmap = get_binary_heatmap(get_histogram(X, Z))
+    return get_heatmap_trace(binary_heatmap, individialData, agent)
+
+
+"""Function to mark the heatmap cells visited by a trajectory
+Inputs:
+X: np.array of x-coordinates
+Z: np.array of z-coordinates
+visited: optional np.array of bools (one per heatmap cell, flat) to add the visits to
+size: bin size (defaults to bin_size)
+Output:
+visited: np.array of bools, True for every cell visited at least once
+"""
+def get_visited_cells(X, Z, visited=None, size=None):
+    if visited is None:
+        visited = np.zeros(np.prod(get_grid_shape(size)), dtype=bool)
+    indices = get_bin_indices(X, Z, size)
+    visited[indices[indices >= 0]] = True
+    return visited
+
+
+"""Function to score the cells visited by a trajectory along an already built binary heatmap, as get_heatmap_traces
+Inputs:
+binary_heatmap: np.array as returned by get_binary_heatmap
+visited: np.array as returned by get_visited_cells
+Output:
+binary_trace: float (NaN for a trajectory that never enters the field)
+"""
+def get_visited_trace(binary_heatmap, visited):
+    num_visited = np.count_nonzero(visited)
+    if num_visited == 0:
+        return np.nan
+    return np.float64(np.count_nonzero(np.ravel(binary_heatmap)[visited])) / np.float64(num_visited)
+
+
+"""Function to read one trajectory of a trial file chunk by chunk (see iter_trial_chunks in tools/trial_store.py),
+holding only chunk_size rows of its two columns at a time, or whole from shared memory if the trial was shared
+(see share_trials in tools/shared_trials.py)
+Inputs:
+file_path: path of the raw trial CSV
+agent: string, "hA0" or "p0" etc. Used for file dataframe headers
+chunk_size: number of rows per chunk (defaults to default_chunk_size of tools/trial_store.py)
+size: bin size (defaults to bin_size; the finest bin size of a sweep, see get_pyramid_traces)
+Output:
+h: np.array of counts, equal to get_histogram of the whole trajectory
+visited: np.array of bools, equal to get_visited_cells of the whole trajectory
+num_samples: number of rows of the trajectory
+or None if the file has no columns for agent
+"""
+def get_streamed_trajectory(file_path, agent, chunk_size=None, size=None):
+    # imported here, as tools/__init__.py imports this module and tools.trial_store is also run as a script
+    from .trial_store import iter_trial_chunks, get_trial_columns, default_chunk_size
+    if chunk_size is None:
+        chunk_size = default_chunk_size
+    columns = [agent+'x', agent+'z']
+    trial = get_shared_trial(file_path, columns)
+    if trial is not None: # the whole trajectory at once, as views of the trial in shared memory
+        chunks = [(trial[agent+'x'], trial[agent+'z'])]
+    elif set(columns) <= set(get_trial_columns(file_path)):
+        chunks = ((chunk[agent+'x'].to_numpy(), chunk[agent+'z'].to_numpy()) for chunk in iter_trial_chunks(file_path, columns, chunk_size))
+    else:
+        return None
+    h = np.zeros(get_grid_shape(size))
+    visited = np.zeros(h.size, dtype=bool)
+    num_samples = 0
+    for X, Z in chunks:
+        h += get_histogram(X, Z, size) # counts are whole numbers, so summing the chunks is exact
+        get_visited_cells(X, Z, visited, size)
+        num_samples += len(X)
+    return h, visited, num_samples
+
+
+"""Streamed counterpart of get_heatmap_trace, reading the trajectory from its trial file chunk by chunk
+Inputs:
+binary_heatmap: np.array as returned by get_binary_heatmap
+file_path: path of the raw trial CSV
+agent: string, "hA0" or "p0" etc. Used for file dataframe headers
+chunk_size: number of rows per chunk (defaults to default_chunk_size of tools/trial_store.py)
+Output:
+binary_trace: float, the same as get_heatmap_trace of the whole trial
+"""
+def get_streamed_heatmap_trace(binary_heatmap, file_path, agent, chunk_size=None):
+    trajectory = get_streamed_trajectory(file_path, agent, chunk_size)
+    if trajectory is None:
         print(f"Warning: Agent columns {agent}x/{agent}z not found in data. Returning 0.")
         return 0.0
+    return get_visited_trace(binary_heatmap, trajectory[1])
+
+
+"""Streamed counterpart of get_binary_trace, reading every trial file chunk by chunk
+Inputs:
+background_files: list of (file path, agent) of the trajectories of the heatmap (eg, every human player)
+file_path: path of the raw trial CSV of the scored trajectory
+agent: string, "hA0" or "p0" etc. Used for file dataframe headers
+chunk_size: number of rows per chunk (defaults to default_chunk_size of tools/trial_store.py)
+Output:
+binary_trace: float, the same as get_binary_trace on the concatenated background trajectories
+"""
+def get_streamed_binary_trace(background_files, file_path, agent, chunk_size=None):
+    h = np.zeros(get_grid_shape())
+    num_samples = 0
+    for background_path, background_agent in background_files:
+        trajectory = get_streamed_trajectory(background_path, background_agent, chunk_size)
+        if trajectory is not None:
+            h += trajectory[0]
+            num_samples += trajectory[2]
+    if num_samples == 0:
+        print(f"Warning: Empty trajectory data for agent {agent}. Returning 0.")
+        return 0.0
+    return get_streamed_heatmap_trace(get_binary_heatmap(h), file_path, agent, chunk_size)
+
+"""Function to get the finest bin size of a sweep, from which every bin size of the sweep is a block of whole cells
+Inputs:
+bin_sizes: list of ints, bin sizes that divide both field dimensions (eg, sweep_bin_sizes)
+Output:
+base_size: int, the greatest common divisor of bin_sizes
+"""
+def get_base_bin_size(bin_sizes):
+    for size in bin_sizes:
+        if int(size) != size or (2*xlim) % size != 0 or (2*ylim) % size != 0:
+            raise ValueError(f"Bin size {size} does not tile the {2*xlim} x {2*ylim} field, use one of {sweep_bin_sizes}")
+    return math.gcd(*[int(size) for size in bin_sizes])
+
+
+"""Function to coarsen a fine grid into blocks of factor x factor cells
+Inputs:
+grid: np.array of counts (summed per block) or bools (any per block), the last two axes being the grid;
+or flat bools (one per cell, as returned by get_visited_cells) if shape is given
+factor: int, number of fine cells per coarse cell along each axis
+shape: (ny, nx) of the fine grid, if grid is flat
+Output:
+coarse: np.array of the same kind, with grid axes divided by factor (flat again if grid was flat)
+"""
+def coarsen_grid(grid, factor, shape=None):
+    flat = shape is not None
+    if flat:
+        grid = grid.reshape(grid.shape[:-1] + tuple(shape))
+    ny, nx = grid.shape[-2:]
+    blocks = grid.reshape(grid.shape[:-2] + (ny // factor, factor, nx // factor, factor))
+    coarse = blocks.any(axis=(-3, -1)) if grid.dtype == bool else blocks.sum(axis=(-3, -1))
+    if flat:
+        coarse = coarse.reshape(coarse.shape[:-2] + (-1,))
+    return coarse
+
+
+"""Function to build the heatmap pyramid of fine counts: one grid per bin size, each the block sum of the fine grid
+(equal to get_histogram at that bin size, as the cell edges are whole meters and coincide)
+Inputs:
+h: np.array of counts at base_size (as returned by get_histogram or get_streamed_trajectory with size=base_size),
+the last two axes being the grid
+base_size: bin size of h
+bin_sizes: list of multiples of base_size
+Output:
+pyramid: dict of bin size to np.array of counts
+"""
+def get_heatmap_pyramid(h, base_size, bin_sizes):
+    return {size: coarsen_grid(h, int(size // base_size)) for size in bin_sizes}
+
+
+"""Function to score visited cells against background counts for a whole grid of (bin size, threshold) settings at once,
+from fine counts and fine visited cells built once (see get_streamed_trajectory with size=get_base_bin_size(bin_sizes))
+Each score is get_visited_trace of the coarsened visits along get_binary_heatmap of the coarsened counts with that threshold
+Inputs:
+h: np.array of background counts at base_size, of shape (..., ny, nx) (eg, the counts of all sessions but each evaluee, of shape (numSessions, ny, nx))
+visited: np.array of bools at base_size, of shape (..., ny*nx), broadcastable with the leading axes of h
+base_size: bin size of h and visited
+bin_sizes: list of multiples of base_size
+thresholds: list of thresholds of the binary heatmaps
+Output:
+scores: np.array of floats of shape (..., len(bin_sizes), len(thresholds)) (NaN for a trajectory that never enters the field)
+"""
+def get_pyramid_traces(h, visited, base_size, bin_sizes, thresholds):
+    thresholds = np.asarray(thresholds, dtype=float)
+    fine_shape = h.shape[-2:]
+    scores = []
+    for size in bin_sizes:
+        factor = int(size // base_size)
+        weighted_heatmap = np.sqrt(coarsen_grid(h, factor))
+        weighted_heatmap = weighted_heatmap.reshape(weighted_heatmap.shape[:-2] + (-1,))
+        coarse_visited = coarsen_grid(visited, factor, fine_shape)
+        hits = np.count_nonzero((weighted_heatmap[..., np.newaxis, :] > thresholds[:, np.newaxis]) & coarse_visited[..., np.newaxis, :], axis=-1)
+        num_visited = np.count_nonzero(coarse_visited, axis=-1)[..., np.newaxis]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            scores.append(hits / num_visited)
+    return np.stack(scores, axis=-2)
+
 
-    h, _, _ = np.histogram2d(x = X.flatten(), y = Z.flatten(),  bins = (int(120/bin_size), int(90/bin_size)), range = ((-xlim, xlim), (-ylim,ylim)))
-    weighted_heatmap = np.sqrt((h.T[::-1]))
-    binary_heatmap = weighted_heatmap > threshold
-    binary_trace = trace(binary_heatmap, np.array([individialData[agent+'x'].to_numpy(), individialData[agent+'z'].to_numpy()]).T, bin_size = bin_size, xlim = xlim, ylim = ylim)
-    return binary_trace
+profiling.instrument_module(__name__) # times the functions above when profiling is on (see tools/profiling.py)
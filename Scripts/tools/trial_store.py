@@ -0,0 +1,300 @@
+"""Columnar store for the raw trial CSVs.
+
+The raw timeseries CSVs in RAW_EXPERIMENT_DATA and OtherResults/AA-AA_SimulationData are
+parsed once by ingest_trials() and written as typed .npz archives to OtherResults/TrialStore,
+mirroring the folder structure of the project. Each archive keeps
+1) positions (p{n}x/z, hA{n}x/z, t{n}x/z) as float64
+2) quaternions (p{n}xq/yq/zq/wq) as a separate float64 block
+3) run flags (t{n}run) as bool
+4) every other column (time, TrialID, ...) with its parsed dtype
+These are the dtypes pd.read_csv parses the columns with, so an ingested trial holds the same values as its CSV.
+Positions are kept in float64 even though Unity logs them in single precision: rounding the parsed decimals to
+float32 (26.07043 becomes 26.070430755615234) can flip a distance that sits exactly on the repulsion_distance
+threshold or a position on a bin edge, which would make the results depend on whether the ingest was run.
+
+iter_trial_chunks() streams a trial in chunks of rows instead of loading it whole, for recordings too long to fit
+comfortably in memory: an ingested trial is read through memory maps of its (uncompressed) archive members, any other
+trial with chunked CSV parsing. Either way only the requested columns of one chunk are held at a time.
+Trials put in shared memory by share_trials (see tools/shared_trials.py) are served from there instead, as long as
+the requested columns were shared.
+
+Usage (from the Scripts folder):
+    python -m tools.trial_store
+"""
+
+import os # for directory handling
+import re # regular expressions
+import zipfile # for mapping the members of the archives
+from pathlib import Path # for file handling
+import numpy as np
+import pandas as pd
+from .shared_trials import get_shared_columns, get_shared_trial
+from . import profiling # opt-in timers, see instrument_module at the end
+
+wd = Path(__file__).resolve().parents[2] # project working directory
+store_dir = os.path.join(wd, 'OtherResults', 'TrialStore') # where the ingested trials are kept
+
+# folders holding raw trial CSVs, relative to the project working directory
+raw_data_dirs = [os.path.join('RAW_EXPERIMENT_DATA'), os.path.join('OtherResults', 'AA-AA_SimulationData')]
+
+position_pattern = re.compile(r'^(p|hA|t)\d+[xyz]$') # e.g. p0x, hA1z, t3x
+quaternion_pattern = re.compile(r'^(p|hA)\d+[xyzw]q$') # e.g. p0xq, hA1wq
+run_pattern = re.compile(r'^t\d+run$') # e.g. t0run
+
+default_chunk_size = 100000 # rows per chunk of iter_trial_chunks, far more than a standard trial
+
+
+def get_store_path(csv_path):
+    """
+    Arguments:
+    csv_path: path of a raw trial CSV inside the project working directory
+
+    Returns:
+    path of the corresponding .npz archive in the trial store
+    """
+    relative_path = os.path.relpath(os.path.abspath(csv_path), wd)
+    return os.path.join(store_dir, os.path.splitext(relative_path)[0] + '.npz')
+
+
+def split_columns(columns):
+    """
+    Sorts the column names of a raw trial CSV into the blocks of the store.
+
+    Returns:
+    position_columns, quaternion_columns, run_columns, other_columns: lists of column names, in file order
+    """
+    position_columns = [col for col in columns if position_pattern.match(col)]
+    quaternion_columns = [col for col in columns if quaternion_pattern.match(col)]
+    run_columns = [col for col in columns if run_pattern.match(col)]
+    blocked = set(position_columns + quaternion_columns + run_columns)
+    other_columns = [col for col in columns if col not in blocked]
+    return position_columns, quaternion_columns, run_columns, other_columns
+
+
+def write_trial(trialData, store_path):
+    """
+    Writes one parsed trial to the store.
+
+    Arguments:
+    trialData: pd.DataFrame as returned by pd.read_csv on a raw trial CSV
+    store_path: path of the .npz archive to write
+    """
+    columns = list(trialData.columns)
+    position_columns, quaternion_columns, run_columns, other_columns = split_columns(columns)
+
+    arrays = {
+        'columns': np.array(columns, dtype=str),
+        'position_columns': np.array(position_columns, dtype=str),
+        'quaternion_columns': np.array(quaternion_columns, dtype=str),
+        'run_columns': np.array(run_columns, dtype=str),
+        'other_columns': np.array(other_columns, dtype=str),
+        'positions': trialData[position_columns].to_numpy(dtype=np.float64).reshape(len(trialData), len(position_columns)),
+        'quaternions': trialData[quaternion_columns].to_numpy(dtype=np.float64).reshape(len(trialData), len(quaternion_columns)),
+        'runs': trialData[run_columns].to_numpy(dtype=bool).reshape(len(trialData), len(run_columns)),
+    }
+    for col in other_columns:
+        values = trialData[col].to_numpy()
+        if values.dtype == object:
+            values = values.astype(str) # keep the archive free of pickled objects
+        arrays['column_' + col] = values
+
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    # write under a temporary name first so an interrupted ingest never leaves a truncated archive behind
+    tmp_path = store_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, store_path)
+
+
+def is_ingested(csv_path):
+    """True if csv_path has an archive in the store that is at least as new as the CSV itself."""
+    store_path = get_store_path(csv_path)
+    return os.path.exists(store_path) and os.path.getmtime(store_path) >= os.path.getmtime(csv_path)
+
+
+def load_trial_arrays(csv_path):
+    """
+    Loads an ingested trial without any CSV parsing.
+
+    Arguments:
+    csv_path: path of the raw trial CSV (the archive is looked up in the store)
+
+    Returns:
+    dict with
+    'columns': list of all column names in file order
+    'positions', 'quaternions', 'runs': 2-D arrays (time x columns) of each block
+    'position_columns', 'quaternion_columns', 'run_columns': column names of each block
+    one entry per remaining column name (time, TrialID, ...) holding its 1-D array
+    """
+    with np.load(get_store_path(csv_path), allow_pickle=False) as archive:
+        trial = {
+            'columns': archive['columns'].tolist(),
+            'positions': archive['positions'],
+            'quaternions': archive['quaternions'],
+            'runs': archive['runs'],
+            'position_columns': archive['position_columns'].tolist(),
+            'quaternion_columns': archive['quaternion_columns'].tolist(),
+            'run_columns': archive['run_columns'].tolist(),
+        }
+        for col in archive['other_columns'].tolist():
+            trial[col] = archive['column_' + col]
+    return trial
+
+
+def trial_arrays_to_dataframe(trial):
+    """Rebuilds the pd.DataFrame of a trial loaded with load_trial_arrays, with columns in file order."""
+    data = {}
+    for block, block_columns in (('positions', 'position_columns'), ('quaternions', 'quaternion_columns'), ('runs', 'run_columns')):
+        for i, col in enumerate(trial[block_columns]):
+            data[col] = trial[block][:, i]
+    for col in trial['columns']:
+        if col not in data:
+            data[col] = trial[col]
+    return pd.DataFrame(data, columns=trial['columns'])
+
+
+def read_trial(csv_path):
+    """
+    Replacement for pd.read_csv on raw trial files.
+    Reads the ingested archive if it is up to date, otherwise parses the CSV. Numeric and bool columns come back
+    with the same dtypes and values either way; text columns (none in the raw trials) come back as str from the
+    archive, with missing values as 'nan'.
+    """
+    if is_ingested(csv_path):
+        return trial_arrays_to_dataframe(load_trial_arrays(csv_path))
+    return pd.read_csv(csv_path)
+
+
+def get_trial_columns(csv_path):
+    """Returns the column names of a trial in file order, without reading its data."""
+    shared_columns = get_shared_columns(csv_path)
+    if shared_columns is not None:
+        return list(shared_columns)
+    if is_ingested(csv_path):
+        with np.load(get_store_path(csv_path), allow_pickle=False) as archive:
+            return archive['columns'].tolist()
+    return pd.read_csv(csv_path, nrows=0).columns.tolist()
+
+
+def map_archive_member(store_path, name):
+    """
+    Memory-maps one array of an .npz archive, so its rows are only read from disk when they are used.
+
+    Arguments:
+    store_path: path of the .npz archive
+    name: name of the array in the archive (eg, 'positions')
+
+    Returns:
+    np.memmap (or np.array, for an empty or compressed member) of the array
+    """
+    with zipfile.ZipFile(store_path) as archive:
+        info = archive.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        with np.load(store_path, allow_pickle=False) as archive:
+            return archive[name]
+    with open(store_path, 'rb') as f:
+        # the member's data follows its local file header (30 bytes, then the file name and extra field)
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = np.frombuffer(f.read(4), dtype='<u2')
+        f.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+        if np.lib.format.read_magic(f) == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(store_path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+
+def iter_trial_chunks(csv_path, columns=None, chunk_size=default_chunk_size):
+    """
+    Chunked counterpart of read_trial, for trials too long to load whole.
+
+    Arguments:
+    csv_path: path of the raw trial CSV (its archive is read instead if it is up to date)
+    columns: column names to read (defaults to all), returned in file order
+    chunk_size: number of rows per chunk
+
+    Yields:
+    pd.DataFrames of consecutive rows (at least one, empty for an empty trial), with the same dtypes as read_trial
+    and a row index continuing from one chunk to the next, so concatenating them gives read_trial(csv_path)[columns]
+    """
+    shared_columns = get_shared_columns(csv_path)
+    if shared_columns is not None:
+        trial = get_shared_trial(csv_path, shared_columns if columns is None else columns)
+        if trial: # every requested column is in shared memory
+            num_rows = len(next(iter(trial.values())))
+            for start in range(0, max(num_rows, 1), chunk_size):
+                stop = min(start + chunk_size, num_rows)
+                data = {col: np.array(view[start:stop]) for col, view in trial.items()}
+                yield pd.DataFrame(data, columns=list(trial), index=pd.RangeIndex(start, stop))
+            return
+
+    if not is_ingested(csv_path):
+        yield from pd.read_csv(csv_path, usecols=columns, chunksize=chunk_size)
+        return
+
+    store_path = get_store_path(csv_path)
+    with np.load(store_path, allow_pickle=False) as archive:
+        all_columns = archive['columns'].tolist()
+        block_columns = {block: archive[block + '_columns'].tolist() for block in ('position', 'quaternion', 'run')}
+    if columns is None:
+        columns = all_columns
+    missing = [col for col in columns if col not in all_columns]
+    if missing:
+        raise ValueError(f"Columns {missing} not found in {csv_path}")
+    columns = [col for col in all_columns if col in columns]
+
+    # column name: (mapped array, column index in a 2-D block or None for a 1-D column)
+    sources = {}
+    for block, block_name in (('position', 'positions'), ('quaternion', 'quaternions'), ('run', 'runs')):
+        wanted = [col for col in block_columns[block] if col in columns]
+        if wanted:
+            array = map_archive_member(store_path, block_name)
+            for col in wanted:
+                sources[col] = (array, block_columns[block].index(col))
+    for col in columns:
+        if col not in sources:
+            sources[col] = (map_archive_member(store_path, 'column_' + col), None)
+
+    num_rows = map_archive_member(store_path, 'positions').shape[0]
+    for start in range(0, max(num_rows, 1), chunk_size):
+        stop = min(start + chunk_size, num_rows)
+        data = {col: np.array(array[start:stop] if i is None else array[start:stop, i]) for col, (array, i) in sources.items()}
+        yield pd.DataFrame(data, columns=columns, index=pd.RangeIndex(start, stop))
+
+
+def ingest_trials(data_dirs=None, overwrite=False):
+    """
+    Converts every raw trial CSV (files named *trialIdentifier*.csv) into the store.
+
+    Arguments:
+    data_dirs: folders to ingest, relative to the project working directory (defaults to raw_data_dirs)
+    overwrite: if True, re-ingest trials even if their archive is up to date
+
+    Returns:
+    number of trials written
+    """
+    if data_dirs is None:
+        data_dirs = raw_data_dirs
+
+    num_written = 0
+    for data_dir in data_dirs:
+        data_path = Path(os.path.join(wd, data_dir))
+        if not data_path.exists():
+            print(f"Warning: {data_path} not found. Skipping...")
+            continue
+        for csv_path in sorted(data_path.rglob('*trialIdentifier*.csv')):
+            if not overwrite and is_ingested(csv_path):
+                continue
+            write_trial(pd.read_csv(csv_path), get_store_path(csv_path))
+            num_written += 1
+    return num_written
+
+profiling.instrument_module(__name__) # times the functions above when profiling is on (see tools/profiling.py)
+
+
+if __name__ == "__main__":
+    num_written = ingest_trials()
+    print(f"Ingested {num_written} trials into {store_dir}")
@@ -4,10 +4,18 @@ import matplotlib.pyplot as plt
 import glob
 import re # regular expressions
 import math
+import itertools # for the permutation tables
+from collections import OrderedDict # for the per-trial cache
 from scipy.spatial.transform import Rotation as R
+from . import profiling # opt-in timers, see instrument_module at the end
 
 exValue = 9999 # an exception value
 repulsion_distance = 10 # distance at which repulsion starts
+trial_cache_budget = 512 * 2**20 # bytes of arrays kept by get_trial_distances and get_trial_headings
+
+_trial_cache = OrderedDict() # key: array, least recently used first
+_trial_cache_bytes = 0
+_permutation_tables = {} # numTargets: table of get_permutation_table
 
 def get_trial_identifier(file_name):
     return re.search(r'(?<=trialIdentifier)\w+', file_name).group(0)[:2]
@@ -45,13 +53,14 @@ def get_order_index(targetFactor):
 def get_num_targets(data, maxTargets):
     """
     Arguments:
-    data: timeseries per trial per participant
+    data: timeseries per trial per participant (pd.DataFrame, or dict of column arrays as from get_shared_trial)
     maxTargets: maximum number of TAs, either 3, 4 or 5 in our experiment
     """
+    columns = data.columns if hasattr(data, 'columns') else data
     numTargets = 0
     for t in range(0, maxTargets):
         col = 't%drun' % (t)
-        if col in data.columns:
+        if col in columns:
             #print("Courses column is present : Yes")
             numTargets = t + 1        
         else:
@@ -60,12 +69,13 @@ def get_num_targets(data, maxTargets):
 
     return numTargets
 
-def get_observed_target_order(data, herderNum, numTargets, at_index = 0):
+def get_observed_target_order(data, herderNum, numTargets, at_index = 0, distances = None):
     """
     Arguments: 
     data: timeseries per participant per trial
     herderNum: the HA ID (0 or 1)
     numTargets: 3, 4, or 5 in our current experiment
+    distances: optional HA-TA distance tensor of the trial for herders p0, p1 (see get_trial_distances)
     
     Returns:
     targetOrder: array of length numTargs, indicating ordered TA ID in which TAs were chased, but only those assigned to the given HA.
@@ -87,7 +97,10 @@ def get_observed_target_order(data, herderNum, numTargets, at_index = 0):
         tcolz = 't%dz' % (t)
         #targetHerderDifferences is an array of length numTargs, with values distances between HA specifed by herderNum, indexed per TA
         #this array is calculated at the time index where the given TA first ran
-        targetHerderDifferences[t] = dist(data[tcolx][targetFactor[t]] - data[hcolx][targetFactor[t]], data[tcolz][targetFactor[t]] - data[hcolz][targetFactor[t]])
+        if distances is None:
+            targetHerderDifferences[t] = dist(data[tcolx][targetFactor[t]] - data[hcolx][targetFactor[t]], data[tcolz][targetFactor[t]] - data[hcolz][targetFactor[t]])
+        else:
+            targetHerderDifferences[t] = distances[herderNum, t, targetFactor[t]] # same row as the lookups above
         if(targetHerderDifferences[t] > 10):
             targetFactor[t] = exValue #if given TA is further than 10m away from the specified HA at the point where it first ran, its targetFactor value is set to exValue (=9999)
 
@@ -96,6 +109,57 @@ def get_observed_target_order(data, herderNum, numTargets, at_index = 0):
     targetSet = targetFactor
     targetSet[targetSet == exValue] = -1 #targetSet is same as targetOrder except it has -1 as exception value instead of 9999.
     return targetOrder, targetSet, targetHerderDifferences
+
+def get_observed_target_orders(trialDatas, numTargets, herderHeaders = ('p0', 'p1'), at_index = 0, distances = None):
+    """
+    Batched get_observed_target_order: every HA of every trial at once.
+
+    Arguments:
+    trialDatas: list of timeseries per trial (pd.DataFrames, or any mappings of column name to array, which are faster to index)
+    numTargets: number of TAs of each trial (int, or one per trial)
+    herderHeaders: column prefixes of the HAs (herderNum h of get_observed_target_order is 'p%d' % h)
+    at_index: time index from which the first runs are searched
+    distances: optional list of the HA-TA distance tensor of each trial for herderHeaders (see get_trial_distances)
+
+    Returns (arrays of maxTargets = max(numTargets) TAs, the TAs a trial does not have are set as if they never ran):
+    targetOrders: int array (numTrials, numHerders, maxTargets), as targetOrder of get_observed_target_order
+    targetSets: int array (numTrials, numHerders, maxTargets), as targetSet of get_observed_target_order
+    targetHerderDifferences: array (numTrials, numHerders, maxTargets) of the HA-TA distances at the first run of each TA,
+    NaN for a TA that never ran (computed on arrays, so they may differ from the row by row ones in the last bit)
+    firstRuns: int array (numTrials, maxTargets) of the time index (from at_index) of the first run of each TA,
+    -1 for a TA that never ran (which get_observed_target_order cannot handle), those TAs are not assigned to any HA
+    """
+    numTrials, numHerders = len(trialDatas), len(herderHeaders)
+    numTargets = np.broadcast_to(np.asarray(numTargets, dtype=int), (numTrials,))
+    maxTargets = int(numTargets.max()) if numTrials > 0 else 0
+    firstRuns = np.full((numTrials, maxTargets), -1)
+    targetHerderDifferences = np.full((numTrials, numHerders, maxTargets), np.nan)
+    for n, data in enumerate(trialDatas):
+        k = numTargets[n]
+        if k == 0:
+            continue
+        running = np.stack([np.asarray(data['t%drun' % (t)], dtype=bool)[at_index:] for t in range(k)])
+        ran = running.any(axis=1)
+        rows = at_index + np.argmax(running, axis=1) # first run of each TA (the first row if it never ran)
+        firstRuns[n, :k] = np.where(ran, rows - at_index, -1)
+        if distances is None:
+            # only the positions at the first runs are needed: each TA's at its own first run, each HA's at every TA's first run
+            targetX = np.array([np.asarray(data['t%dx' % (t)])[rows[t]] for t in range(k)])
+            targetZ = np.array([np.asarray(data['t%dz' % (t)])[rows[t]] for t in range(k)])
+            for h, header in enumerate(herderHeaders):
+                herderX, herderZ = np.asarray(data[header + 'x'])[rows], np.asarray(data[header + 'z'])[rows]
+                targetHerderDifferences[n, h, :k] = np.where(ran, dist(targetX - herderX, targetZ - herderZ), np.nan)
+        else:
+            targetHerderDifferences[n, :, :k] = np.where(ran, distances[n][:, np.arange(k), rows], np.nan)
+
+    # a TA is assigned to a HA if it was within 10 m of it when it first ran; the others get exValue
+    targetFactor = np.broadcast_to(np.where(firstRuns >= 0, firstRuns, exValue)[:, np.newaxis, :], targetHerderDifferences.shape).copy()
+    targetFactor[targetHerderDifferences > 10] = exValue
+    # as get_order_index, with TAs of equal first run in TA ID order
+    targetOrders = np.argsort(targetFactor, axis=-1, kind='stable')
+    targetOrders[np.take_along_axis(targetFactor, targetOrders, axis=-1) == exValue] = -1
+    targetSets = np.where(targetFactor == exValue, -1, targetFactor)
+    return targetOrders, targetSets, targetHerderDifferences, firstRuns
     
 # function to calculate the euclidean distance of a point from the origin
 def dist(x,y):
@@ -132,9 +196,25 @@ def angle_between(vec1, vec2):
 
 
 def quat_to_angle(rotx, roty, rotz, rotw):
-    rotation_object = R.from_quat([rotx, roty, rotz, rotw])
-    playerRot = rotation_object.as_rotvec() # Direction vector
-    return playerRot[1] #left/right heading direction (rotation along y-axis)
+    return quats_to_angles([rotx], [roty], [rotz], [rotw])[0] #left/right heading direction (rotation along y-axis)
+
+def quats_to_angles(rotx, roty, rotz, rotw):
+    """
+    Batched quat_to_angle: converts whole quaternion columns with one scipy Rotation instead of one per sample.
+
+    Arguments:
+    rotx, roty, rotz, rotw: arrays of the quaternion components (e.g. the p0xq, p0yq, p0zq and p0wq columns)
+
+    Returns:
+    headings: float64 array, the left/right heading direction (rotation along y-axis) at every sample,
+    NaN where the quaternion is not finite or zero (scipy would reject the whole batch)
+    """
+    quats = np.column_stack([np.asarray(q, dtype=float).ravel() for q in (rotx, roty, rotz, rotw)])
+    headings = np.full(len(quats), np.nan)
+    valid = np.isfinite(quats).all(axis=1) & (quats != 0).any(axis=1)
+    if valid.any():
+        headings[valid] = R.from_quat(quats[valid]).as_rotvec()[:, 1] # Direction vectors
+    return headings
 
 
 def order_match(ordering1, ordering2): 
@@ -176,6 +256,114 @@ def permutation(lst):
            l.append([m] + p)
     return l
 
+def get_permutation_table(numTargets):
+    """
+    Arguments:
+    numTargets: number of TAs
+
+    Returns:
+    table: read-only int8 array of shape (numTargets!, numTargets), every ordering of the TA IDs in the order of
+    permutation(list(range(numTargets))), built once per process
+    """
+    if numTargets not in _permutation_tables:
+        table = np.array(list(itertools.permutations(range(numTargets))), dtype=np.int8).reshape(-1, numTargets)
+        table.flags.writeable = False
+        _permutation_tables[numTargets] = table
+    return _permutation_tables[numTargets]
+
+def score_target_orders(orders, numTargets):
+    """
+    Batched order_match: scores observed target orders against every ordering of get_permutation_table at once.
+
+    Arguments:
+    orders: int array of shape (..., numTargets) or wider, e.g. the targetOrders of get_observed_target_orders
+    (only the first numTargets entries of the last axis are used, -1 for a TA that never ran)
+    numTargets: number of TAs of the trials
+
+    Returns:
+    matches: int8 array of shape (..., numTargets!), number of positions at which each order agrees with each permutation
+    (order_match is 1 where matches == numTargets)
+    ranks: int array of shape (...), row of the permutation table equal to each order, -1 if the order is incomplete
+    (np.bincount(ranks[ranks >= 0], minlength=len(table)) counts how often each ordering was observed)
+    """
+    table = get_permutation_table(numTargets)
+    orders = np.asarray(orders)[..., :numTargets]
+    matches = (orders[..., np.newaxis, :] == table).sum(axis=-1, dtype=np.int8)
+    ranks = np.where(matches.max(axis=-1, initial=0) == numTargets, matches.argmax(axis=-1), -1)
+    return matches, ranks
+
+def get_grid_indices(X, Z, bin_size, xlim, ylim):
+    """
+    Heatmap cell of each point of a trajectory, binned exactly like the histogram2d of trace
+    (bins closed on the left, the last one also on the right).
+
+    Arguments:
+    X, Z: arrays of x and z coordinates
+    bin_size: cell size of the heatmap
+    xlim, ylim: half dimensions of the field
+
+    Returns:
+    bin_indices: int array, flat index into the heatmap (row-major, rows from +ylim down to -ylim),
+    -1 for points outside the field or NaN
+    """
+    nx, ny = int(120/bin_size), int(90/bin_size)
+    x_edges = np.linspace(-xlim, xlim, nx + 1)
+    z_edges = np.linspace(-ylim, ylim, ny + 1)
+    X = np.asarray(X, dtype=float).flatten()
+    Z = np.asarray(Z, dtype=float).flatten()
+
+    x_bins = np.searchsorted(x_edges, X, side='right') - 1
+    z_bins = np.searchsorted(z_edges, Z, side='right') - 1
+    x_bins[X == x_edges[-1]] -= 1
+    z_bins[Z == z_edges[-1]] -= 1
+
+    valid = (x_bins >= 0) & (x_bins < nx) & (z_bins >= 0) & (z_bins < ny)
+    return np.where(valid, (ny - 1 - z_bins) * nx + x_bins, -1)
+
+def get_occupancy(X, Z, bin_size, xlim, ylim):
+    """
+    Sparse occupancy grid of a trajectory: the cells it visits, instead of a dense histogram that is mostly empty.
+
+    Arguments:
+    X, Z: arrays of x and z coordinates
+    bin_size, xlim, ylim: grid of the heatmap, as in trace
+
+    Returns:
+    occupancy: sorted int32 array of the unique flat indices (see get_grid_indices) of the visited cells
+    """
+    indices = get_grid_indices(X, Z, bin_size, xlim, ylim)
+    return np.unique(indices[indices >= 0]).astype(np.int32)
+
+def get_occupancy_trace(mat, occupancy):
+    """
+    Trace of a trajectory along a heatmap from its occupancy.
+
+    Arguments:
+    mat: heatmap (weighted, or binary as returned by get_binary_heatmap in tools/traj_utils.py)
+    occupancy: as returned by get_occupancy on the grid of mat
+
+    Returns:
+    mean of mat over the visited cells (NaN if the trajectory never enters the field)
+    """
+    if len(occupancy) == 0:
+        return np.nan
+    return np.sum(np.ravel(mat)[occupancy]) / np.float64(len(occupancy))
+
+def get_occupancy_overlap(occupancy_a, occupancy_b):
+    """
+    Overlap of two trajectories on the same grid.
+
+    Arguments:
+    occupancy_a, occupancy_b: as returned by get_occupancy
+
+    Returns:
+    num_shared: number of cells visited by both
+    num_union: number of cells visited by either
+    (num_shared / num_union is their Jaccard index, num_shared / len(occupancy_a) the fraction of a's cells also visited by b)
+    """
+    num_shared = len(np.intersect1d(occupancy_a, occupancy_b, assume_unique=True))
+    return num_shared, len(occupancy_a) + len(occupancy_b) - num_shared
+
 def trace(mat, traj, bin_size, xlim, ylim):
     """
     gets the weighted or non-weigted trace of a trajectory trah along a heatmap
@@ -183,15 +371,18 @@ def trace(mat, traj, bin_size, xlim, ylim):
     mat: heatmap
     traj: set of X,Y points. expected shape: N x 2
     """
-    h, _, _ = np.histogram2d(x = traj[:,0], y = traj[:,1],  bins = (int(120/bin_size), int(90/bin_size)), range = ((-xlim, xlim), (-ylim,ylim)))
-    h = h.T[::-1]
-    h = h > 0
-    h = h*1
-    return np.sum(mat*h)/np.sum(h)
+    return get_occupancy_trace(mat, get_occupancy(traj[:,0], traj[:,1], bin_size, xlim, ylim))
 
 #function to return which HA is chasing curent targetID (0-indexed)
-def get_chaser(data, targetID, simulation_bool):
+#distances: optional HA-TA distance tensor of the trial (or chunk) for herders hA0, hA1 or p0, p1 (see get_trial_distances),
+#with time_index the position of data in it (required with distances: the row labels of chunks continue across chunks)
+def get_chaser(data, targetID, simulation_bool, distances=None, time_index=None):
 
+    if distances is not None:
+        if time_index is None:
+            raise ValueError("get_chaser needs the time_index of data in distances")
+        HA0_dist, HA1_dist = distances[:2, targetID, time_index]
+        return [bool(HA0_dist < repulsion_distance), bool(HA1_dist < repulsion_distance)]
 
     if simulation_bool:
         herder_header = 'hA'
@@ -214,15 +405,23 @@ def get_chaser(data, targetID, simulation_bool):
 
     return [HA0, HA1]
 
-def get_chaser_v2(data, targetID):
+def get_chaser_v2(data, targetID, distances=None, time_index=None):
     """
     Arguments:
     data: timeseries instance at predetermined time point
     targetID: 0-indexed target ID
+    distances: optional HA-TA distance tensor of the trial (or chunk) for herders p0, hA0 (see get_trial_distances)
+    time_index: position of data in distances, required with distances (the row labels of chunks continue across chunks)
 
     Returns:
     HA0, HA1: True if HA0 or HA1 is chasing the given targetID
     """
+    if distances is not None:
+        if time_index is None:
+            raise ValueError("get_chaser_v2 needs the time_index of data in distances")
+        HA0_dist, HA1_dist = distances[:2, targetID, time_index]
+        return [bool(HA0_dist < repulsion_distance), bool(HA1_dist < repulsion_distance)]
+
     TA_pos = (data['t%dx' % (targetID)], data['t%dz' % (targetID)])
     HA0_pos = (data['p0x'], data['p0z'])
     HA1_pos = (data['hA0x'], data['hA0z'])
@@ -238,4 +437,225 @@ def get_chaser_v2(data, targetID):
         HA1 = True
 
     return [HA0, HA1]
-    
\ No newline at end of file
+    
+
+def get_trial_positions(trialData, herderHeaders, numTargets):
+    """
+    Arguments:
+    trialData: timeseries per trial (pd.DataFrame, or any mapping of column name to array)
+    herderHeaders: column prefixes of the HAs, e.g. ['p0', 'p1'], ['hA0', 'hA1'] or ['p0', 'hA0']
+    numTargets: number of TAs in the trial
+
+    Returns:
+    herderPositions: array of shape (numHerders, T, 2), x and z positions of each HA
+    targetPositions: array of shape (numTargets, T, 2), x and z positions of each TA
+    targetRunning: bool array of shape (numTargets, T), the t{n}run flags
+    """
+    numRows = len(trialData[herderHeaders[0] + 'x'])
+    herderPositions = np.stack([np.column_stack([np.asarray(trialData[h + 'x'], dtype=float), np.asarray(trialData[h + 'z'], dtype=float)]) for h in herderHeaders])
+    targetPositions = np.zeros((numTargets, numRows, 2))
+    targetRunning = np.zeros((numTargets, numRows), dtype=bool)
+    for t in range(numTargets):
+        targetPositions[t, :, 0] = np.asarray(trialData['t%dx' % (t)], dtype=float)
+        targetPositions[t, :, 1] = np.asarray(trialData['t%dz' % (t)], dtype=float)
+        targetRunning[t] = np.asarray(trialData['t%drun' % (t)], dtype=bool)
+    return herderPositions, targetPositions, targetRunning
+
+def get_herder_target_distances(herderPositions, targetPositions):
+    """
+    Arguments:
+    herderPositions: array of shape (numHerders, T, 2)
+    targetPositions: array of shape (numTargets, T, 2)
+
+    Returns:
+    distances: array of shape (numHerders, numTargets, T), euclidean HA-TA distance at every time index
+    """
+    difference = targetPositions[np.newaxis, :, :, :] - herderPositions[:, np.newaxis, :, :]
+    return dist(difference[..., 0], difference[..., 1])
+
+def cache_trial_array(key, array):
+    """
+    Memoizes array under key, making it read-only as it is shared by every caller.
+    The least recently used arrays are dropped once they take more than trial_cache_budget bytes.
+    """
+    global _trial_cache_bytes
+    array.flags.writeable = False
+    _trial_cache[key] = array
+    _trial_cache_bytes += array.nbytes
+    while _trial_cache_bytes > trial_cache_budget and len(_trial_cache) > 1:
+        _, evicted = _trial_cache.popitem(last=False)
+        _trial_cache_bytes -= evicted.nbytes
+    return array
+
+def get_cached_trial_array(key):
+    """Returns the array memoized under key, or None."""
+    if key in _trial_cache:
+        _trial_cache.move_to_end(key)
+        return _trial_cache[key]
+    return None
+
+def get_trial_distances(trialData, herderHeaders, numTargets, key=None):
+    """
+    HA-TA distance tensor of a trial, computed once and shared by the engagement, ordering and tie-break functions
+    (get_chaser, get_chaser_v2, get_closest_HA_TA_pair, get_observed_target_order, get_dynamic_policy_array, collapse_engagement).
+
+    Arguments:
+    trialData: timeseries per trial
+    herderHeaders: column prefixes of the HAs, e.g. ['p0', 'p1'] or ['p0', 'hA0']
+    numTargets: number of TAs in the trial
+    key: hashable identifying trialData (e.g. its file path), to memoize the tensor (see cache_trial_array); None to always compute it
+
+    Returns:
+    distances: array of shape (numHerders, numTargets, T), as returned by get_herder_target_distances
+    (float64, like the distances computed row by row, so the repulsion_distance tests give the same engagement)
+    """
+    if key is not None:
+        key = ('distances', key, tuple(herderHeaders), numTargets)
+        distances = get_cached_trial_array(key)
+        if distances is not None:
+            return distances
+
+    herderPositions, targetPositions, _ = get_trial_positions(trialData, herderHeaders, numTargets)
+    distances = get_herder_target_distances(herderPositions, targetPositions)
+    if key is not None:
+        cache_trial_array(key, distances)
+    return distances
+
+def get_trial_headings(trialData, herderHeaders, key=None):
+    """
+    Heading direction of every HA over a whole trial, from its quaternion columns in one batched call per HA.
+
+    Arguments:
+    trialData: timeseries per trial (pd.DataFrame, or any mapping of column name to array)
+    herderHeaders: column prefixes of the HAs, e.g. ['p0', 'p1'] or ['p0', 'hA0']
+    key: hashable identifying trialData (e.g. its file path), to memoize the headings next to its distance tensor; None to always compute them
+
+    Returns:
+    headings: array of shape (numHerders, T), as returned by quats_to_angles for the {h}xq, {h}yq, {h}zq and {h}wq columns
+    """
+    if key is not None:
+        key = ('headings', key, tuple(herderHeaders))
+        headings = get_cached_trial_array(key)
+        if headings is not None:
+            return headings
+
+    headings = np.stack([quats_to_angles(trialData[h + 'xq'], trialData[h + 'yq'], trialData[h + 'zq'], trialData[h + 'wq']) for h in herderHeaders])
+    if key is not None:
+        cache_trial_array(key, headings)
+    return headings
+
+def clear_trial_cache():
+    """Drops every array memoized by get_trial_distances and get_trial_headings."""
+    global _trial_cache_bytes
+    _trial_cache.clear()
+    _trial_cache_bytes = 0
+
+def get_engagement_tensor(herderPositions, targetPositions, targetRunning, distances=None):
+    """
+    Batched get_chaser: evaluates every HA-TA pair at every time index in one pass.
+
+    Arguments:
+    herderPositions, targetPositions, targetRunning: as returned by get_trial_positions
+    distances: optional precomputed output of get_herder_target_distances
+
+    Returns:
+    engagement: bool array of shape (numHerders, numTargets, T), True where the TA is running
+    and the HA is within repulsion_distance of it
+    """
+    if distances is None:
+        distances = get_herder_target_distances(herderPositions, targetPositions)
+    return targetRunning[np.newaxis, :, :] & (distances < repulsion_distance)
+
+def get_dynamic_policy_array(trialData, trial, herderHeaders, maxTargets, distances=None):
+    """
+    Arguments:
+    trialData: timeseries per trial
+    trial: trial number, written to the TrialID column
+    herderHeaders: column prefixes of the HAs, e.g. ['p0', 'p1'] or ['p0', 'hA0']
+    maxTargets: maximum number of TAs, sets the width of the one-hot block of each HA
+    distances: optional HA-TA distance tensor of the trial for herderHeaders (see get_trial_distances)
+
+    Returns:
+    output_array: array of shape (T, 3 + numHerders*maxTargets) with columns
+    time, TrialID, numTargs, then for each HA the 0/1 engagement with TA0 ... TA{maxTargets-1}
+    """
+    numTargets = get_num_targets(trialData, maxTargets)
+    herderPositions, targetPositions, targetRunning = get_trial_positions(trialData, herderHeaders, numTargets)
+    engagement = get_engagement_tensor(herderPositions, targetPositions, targetRunning, distances)
+
+    numHerders, numRows = len(herderHeaders), herderPositions.shape[1]
+    observedOrder = np.zeros((numRows, numHerders, maxTargets))
+    observedOrder[:, :, :numTargets] = engagement.transpose(2, 0, 1)
+
+    output_array = np.zeros((numRows, 3 + numHerders*maxTargets))
+    output_array[:, 0] = np.asarray(trialData['time'], dtype=float)
+    output_array[:, 1] = trial
+    output_array[:, 2] = numTargets
+    output_array[:, 3:] = observedOrder.reshape(numRows, numHerders*maxTargets)
+    return output_array
+
+def get_closest_HA_TA_pair(trialData, i, player, maxTargets = 5, distances = None):
+    """
+    Arguments:
+    trialData: timeseries per trial
+    i: time index
+    player: column prefix of the HA, e.g. 'p0' or 'hA1'
+    distances: optional array of shape (numTargets, T), the HA-TA distances of the HA
+    (ie, get_trial_distances(...)[herderID], as collapse_engagement takes them)
+
+    Returns:
+    ID of the TA closest to the HA at time index i, used when the HA engages more than one TA
+    """
+    if distances is not None:
+        return np.argmin(distances[:, i])
+    numTargs = get_num_targets(trialData, maxTargets)
+    HA_TA_distances = np.zeros(numTargs) - 1
+    for j in range(numTargs):
+        HA_TA_distances[j] = dist(trialData.iloc[i]['t%dx' % (j)] - trialData.iloc[i][player + 'x'], trialData.iloc[i]['t%dz' % (j)] - trialData.iloc[i][player + 'z'])
+    return np.argmin(HA_TA_distances)
+
+def collapse_engagement(oneHot, distances):
+    """
+    Batched collapse of the one-hot HA-TA engagement of one HA into a single engaged TA ID per time index.
+
+    Arguments:
+    oneHot: array of shape (T, maxTargets), the 0/1 engagement of the HA with each TA
+    distances: array of shape (numTargets, T), the HA-TA distances (see get_herder_target_distances)
+
+    Returns:
+    engagement: int array of length T with
+    -1 where the HA engages no TA,
+    the engaged TA ID where it engages exactly one TA,
+    the ID of the closest TA (as in get_closest_HA_TA_pair) where it engages more than one
+    """
+    oneHot = np.asarray(oneHot) == 1
+    numEngaged = oneHot.sum(axis=1)
+    engagement = np.where(numEngaged > 0, np.argmax(oneHot, axis=1), -1)
+
+    multiple = numEngaged > 1
+    if multiple.any():
+        engagement[multiple] = np.argmin(distances[:, multiple], axis=0) # tie-break over all TAs of the trial
+    return engagement.astype(np.int64)
+
+def encode_runs(series):
+    """
+    Run-length encoding of a piecewise-constant series, such as the collapsed engagement of an HA.
+
+    Arguments:
+    series: 1-D array
+
+    Returns:
+    values: array of the value of each run, same dtype as series
+    lengths: int array of the number of samples of each run (decode_runs(values, lengths) gives back series)
+    """
+    series = np.asarray(series)
+    if len(series) == 0:
+        return series[:0], np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, series[1:] != series[:-1]])
+    return series[starts], np.diff(np.r_[starts, len(series)])
+
+def decode_runs(values, lengths):
+    """Inverse of encode_runs: the series of values[i] repeated lengths[i] times."""
+    return np.repeat(values, lengths)
+
+profiling.instrument_module(__name__) # times the functions above when profiling is on (see tools/profiling.py)